@@ -1,4 +1,6 @@
 from __future__ import annotations
+import ipaddress
+import json
 import os
 from flask import Flask, render_template, url_for, redirect
 from flask import request, session, flash, jsonify, current_app
@@ -10,13 +12,24 @@ from flask_login import LoginManager, login_required
 from flask_login import login_user, logout_user, current_user
 
 import modules.extensions as extensions
-from modules.dbms import User, ChatThread, ChatHistory
+import modules.resilience as resilience
+import modules.metrics as metrics
+import modules.providers as providers
+from modules import dbms
+from modules.dbms import User, ChatThread, ThreadSummary
 import modules.ai_endpoints as ai_endpoints
+import modules.commands as commands
+import modules.migrations as migrations
+import modules.archive as archive
+import modules.search_index as search_index
+import modules.static_assets as static_assets
+from modules.password_hashing import HashingBusy
+from modules.user_cache import UserSnapshot
 
 from loginforms import RegisterForm, LoginForm
 
 scriptdir = os.path.dirname(os.path.abspath(__file__))
-dbfile = os.path.join(scriptdir, "users.sqlite3")
+dbfile = os.getenv("DATABASE_PATH") or os.path.join(scriptdir, "users.sqlite3")
 pepfile = os.path.join(scriptdir, "pepper.bin")
 
 with open(pepfile, 'rb') as fin:
@@ -27,50 +40,86 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 app.config['SECRET_KEY'] = 'correcthorsebatterystaple'
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{dbfile}?timeout=10000"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# When set, /metrics requires "Authorization: Bearer <token>"; otherwise only localhost may read it
+app.config['METRICS_TOKEN'] = os.getenv("METRICS_TOKEN")
 
 extensions.init_extensions(
-    claude_model       = os.getenv("CLAUDE_MODEL", "claude-3-haiku-20240307"),
-    claude_key         = os.getenv("CLAUDE_API_KEY"),
-    claude_max_tokens  = int(os.getenv("CLAUDE_MAX_TOKENS", "120")),
-    claude_temperature = float(os.getenv("CLAUDE_TEMPERATURE", "0.2")),
-
-    deepseek_model      = os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
-    deepseek_key        = os.getenv("DEEPSEEK_API_KEY"),
-    deepseek_max_tokens = int(os.getenv("DEEPSEEK_MAX_TOKENS", "120")),
-    deepseek_temperature= float(os.getenv("DEEPSEEK_TEMPERATURE", "0.2")),
-
-    gemini_model       = os.getenv("GEMINI_MODEL", "gemini-2.0-flash"),
-    gemini_key         = os.getenv("GEMINI_API_KEY"),
-    gemini_max_tokens  = int(os.getenv("GEMINI_MAX_TOKENS", "120")),
-    gemini_temperature = float(os.getenv("GEMINI_TEMPERATURE", "0.2")),
-
-    openai_model       = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo"),
-    openai_key         = os.getenv("OPENAI_API_KEY"),
-    openai_max_tokens  = int(os.getenv("OPENAI_MAX_TOKENS", "120")),
-    openai_temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.2")),
-
-    grok_model         = os.getenv("GROK_MODEL", "grok-3-mini"),
-    grok_key           = os.getenv("GROK_API_KEY"),
-    grok_max_tokens    = int(os.getenv("GROK_MAX_TOKENS", "120")),
-    grok_temperature   = float(os.getenv("GROK_TEMPERATURE", "0.2")),
-
-    mistral_model      = os.getenv("MISTRAL_MODEL", "mistral-large-latest"),
-    mistral_key        = os.getenv("MISTRAL_API_KEY"),
-    mistral_max_tokens = int(os.getenv("MISTRAL_MAX_TOKENS", "120")),
-    mistral_temperature= float(os.getenv("MISTRAL_TEMPERATURE", "0.2")),
-
-    llama_model        = os.getenv("LLAMA_MODEL", "meta-llama/Llama-3.3-70B-Instruct-Turbo"),
-    llama_key          = os.getenv("LLAMA_API_KEY"),
-    llama_max_tokens   = int(os.getenv("LLAMA_MAX_TOKENS", "120")),
-    llama_temperature  = float(os.getenv("LLAMA_TEMPERATURE", "0.2")),
-
-    qwen_model         = os.getenv("QWEN_MODEL", "Qwen/Qwen2.5-7B-Instruct-Turbo"),
-    qwen_key           = os.getenv("QWEN_API_KEY"),
-    qwen_max_tokens    = int(os.getenv("QWEN_MAX_TOKENS", "120")),
-    qwen_temperature   = float(os.getenv("QWEN_TEMPERATURE", "0.2")),
-
+    # Model, key and limits per provider come from <PREFIX>_MODEL, _API_KEY, _MAX_TOKENS and
+    # _TEMPERATURE (see modules/providers.py); LLM_PROVIDERS_FILE can add or override providers
+    providers = providers.resolve(providers.load_specs(os.getenv("LLM_PROVIDERS_FILE")), os.environ),
     pepper=pepper_key,
-    flask_app=app)
+    flask_app=app,
+
+    pool_max_connections  = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20")),
+    pool_max_keepalive    = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10")),
+    pool_keepalive_expiry = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "30")),
+    connect_timeout       = float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
+    read_timeout          = float(os.getenv("LLM_READ_TIMEOUT", "60")),
+    warm_connections      = os.getenv("LLM_POOL_WARMUP", "1") == "1",
+
+    reply_cache_size            = int(os.getenv("REPLY_CACHE_SIZE", "1000")),
+    reply_cache_ttl             = float(os.getenv("REPLY_CACHE_TTL", "3600")),
+    reply_cache_db              = os.getenv("REPLY_CACHE_DB") or None,
+    reply_cache_max_temperature = float(os.getenv("REPLY_CACHE_MAX_TEMPERATURE", "0.5")),
+    reply_cache_disabled        = {name.strip() for name in os.getenv("REPLY_CACHE_DISABLED", "").split(",") if name.strip()},
+    reply_cache_purge_interval  = float(os.getenv("REPLY_CACHE_PURGE_INTERVAL", "300")),
+
+    history_codec         = os.getenv("HISTORY_CODEC", "auto"),
+    history_zstd_dict     = os.getenv("HISTORY_ZSTD_DICT", os.path.join(scriptdir, "zstd_dict.bin")),
+    history_zstd_dict_dir = os.getenv("HISTORY_ZSTD_DICT_DIR", os.path.join(scriptdir, "zstd_dicts")),
+
+    sqlite_synchronous = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    sqlite_mmap_size   = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    sqlite_cache_size  = int(os.getenv("SQLITE_CACHE_SIZE", str(-64 * 1024))),
+
+    hash_workers       = int(os.getenv("PWD_HASH_WORKERS", "2")),
+    hash_max_pending   = int(os.getenv("PWD_HASH_MAX_PENDING", "16")),
+    hash_timeout       = float(os.getenv("PWD_HASH_TIMEOUT", "30")),
+    argon2_time_cost   = int(os.getenv("ARGON2_TIME_COST", "10")),
+    argon2_memory_cost = int(os.getenv("ARGON2_MEMORY_COST", "65536")),
+    argon2_parallelism = int(os.getenv("ARGON2_PARALLELISM", "4")),
+
+    user_cache_size = int(os.getenv("USER_CACHE_SIZE", "10000")),
+    user_cache_ttl  = float(os.getenv("USER_CACHE_TTL", "60")),
+
+    history_write_behind   = os.getenv("HISTORY_WRITE_BEHIND", "1") == "1",
+    history_write_batch    = int(os.getenv("HISTORY_WRITE_BATCH", "256")),
+    history_write_delay_ms = float(os.getenv("HISTORY_WRITE_DELAY_MS", "5")),
+    history_write_timeout  = float(os.getenv("HISTORY_WRITE_TIMEOUT", "30")),
+
+    llm_max_concurrency      = int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+    # e.g. "LLAMA=2,QWEN=2" for providers with tighter rate limits
+    llm_provider_concurrency = {name.strip().upper(): int(limit) for name, limit in
+                                (item.split("=") for item in os.getenv("LLM_PROVIDER_CONCURRENCY", "").split(",") if "=" in item)},
+    llm_acquire_timeout      = float(os.getenv("LLM_ACQUIRE_TIMEOUT", "2")),
+    llm_deadline             = float(os.getenv("LLM_DEADLINE", "45")),
+    llm_max_retries          = int(os.getenv("LLM_MAX_RETRIES", "2")),
+    llm_backoff_base         = float(os.getenv("LLM_BACKOFF_BASE", "0.5")),
+    llm_backoff_max          = float(os.getenv("LLM_BACKOFF_MAX", "8")),
+    llm_breaker_failures     = int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+    llm_breaker_reset        = float(os.getenv("LLM_BREAKER_RESET", "30")),
+    llm_hedge                = os.getenv("LLM_HEDGE", "0") == "1",
+    llm_hedge_min_delay      = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1")),
+
+    # History tokens sent with each prompt; CONTEXT_TOKEN_BUDGETS overrides per model, e.g. "CLAUDE=4000"
+    context_token_budget  = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500")),
+    context_token_budgets = {name.strip().upper(): int(budget) for name, budget in
+                             (item.split("=") for item in os.getenv("CONTEXT_TOKEN_BUDGETS", "").split(",") if "=" in item)},
+    context_cache_threads = int(os.getenv("CONTEXT_CACHE_THREADS", "1000")),
+
+    archive_after_days     = float(os.getenv("ARCHIVE_AFTER_DAYS", "90")),
+    archive_retention_days = float(os.getenv("ARCHIVE_RETENTION_DAYS", "0")),
+    archive_interval       = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600")),
+    archive_batch_size     = int(os.getenv("ARCHIVE_BATCH_SIZE", "50")),
+    archive_vacuum_pages   = int(os.getenv("ARCHIVE_VACUUM_PAGES", "2000")),
+    # Of the processes serving this database, the one holding this lock runs the archive passes
+    archive_lock_path      = os.getenv("ARCHIVE_LOCK_FILE", f"{dbfile}.archiver.lock"))
+
+commands.register_commands(app)
+
+# Serves the output of `flask build-assets`, if there is any; STATIC_ASSETS=0 serves the sources
+if os.getenv("STATIC_ASSETS", "1") == "1":
+    static_assets.install(app)
 
 # Prepare and connect the LoginManager to this app
 login_manager = LoginManager()
@@ -79,8 +128,14 @@ login_manager.login_view = 'get_login' # type: ignore
 login_manager.session_protection = "strong"
 
 @login_manager.user_loader
-def load_user(uid: str) -> User | None:
-    return get_user(uid=int(uid))
+def load_user(uid: str) -> UserSnapshot | None:
+    # Runs on every authenticated request, so it's served from the in-process cache
+    assert extensions.user_cache is not None
+    return extensions.user_cache.get_or_load(int(uid), load_user_snapshot)
+
+def load_user_snapshot(uid: int) -> UserSnapshot | None:
+    user: User|None = get_user(uid=uid)
+    return None if user is None else UserSnapshot.of(user)
 
 def get_user(uid: int|None = None, email: str|None = None) -> User | None:
     query: Select[Tuple[User]] = extensions.db.select(User)
@@ -94,50 +149,35 @@ def get_user(uid: int|None = None, email: str|None = None) -> User | None:
 
 with app.app_context():
     extensions.db.create_all()
+    migrations.migrate(extensions.db.engine)
+    dbms.backfill_thread_summaries()
+
+# Sidebar threads per page (first page is rendered into home.html)
+THREAD_PAGE_SIZE = 30
 
 # -----------------------
 # ROUTES
 # -----------------------
 
-@app.post('/api/chatgpt')
-@login_required
-def chatgpt():
-    return ai_endpoints.gpt()
-
-@app.post('/api/gemini')
-@login_required
-def gemini():
-    return ai_endpoints.gemini()
-
-@app.post('/api/claude')
-@login_required
-def claude():
-    return ai_endpoints.claude()
-
-@app.post('/api/mistral')
+@app.post('/api/llm/<string:name>')
 @login_required
-def mistral():
-    return ai_endpoints.mistral()
+def llm(name: str):
+    return ai_endpoints.single(name)
 
-@app.post('/api/grok')
+@app.post('/api/multi')
 @login_required
-def grok():
-    return ai_endpoints.grok()
+def multi():
+    return ai_endpoints.multi_llm_endpoint()
 
-@app.post('/api/deepseek')
+@app.post('/api/multi/stream')
 @login_required
-def deepseek():
-    return ai_endpoints.deepseek()
+def multi_stream():
+    return ai_endpoints.multi_llm_stream_endpoint()
 
-@app.post('/api/llama')
+@app.post('/api/llm/<string:name>/stream')
 @login_required
-def llama_together():
-    return ai_endpoints.llama_together()
-
-@app.post('/api/qwen')
-@login_required
-def qwen_together():
-    return ai_endpoints.qwen_together()
+def llm_stream(name: str):
+    return ai_endpoints.stream(name)
 
 @app.post('/api/ensure_thread')
 @login_required
@@ -148,10 +188,9 @@ def ensure_thread():
     current_models = set(data.get('models', []))
     if 'current_thread_id' in session:
         thread_id = session['current_thread_id']
-        
-        history_models = extensions.db.session.query(ChatHistory.model_name).filter_by(thread_id=thread_id).distinct().all()
-        
-        existing_models = {row[0] for row in history_models}
+
+        summary = extensions.db.session.get(ThreadSummary, thread_id)
+        existing_models = set(summary.models) if summary is not None else set()
         if existing_models and existing_models != current_models:
             session.pop('current_thread_id', None)
         else:
@@ -161,13 +200,7 @@ def ensure_thread():
     # thread title
     thread_name = prompt[:15] + "..." if len(prompt) > 15 else prompt
 
-    new_thread = ChatThread(
-        user_id=current_user.id, #type:ignore
-        thread_name=thread_name, #type:ignore
-        date_created=datetime.now() #type:ignore
-    )
-    extensions.db.session.add(new_thread)
-    extensions.db.session.commit()
+    new_thread = dbms.create_thread(current_user.id, thread_name)
     session['current_thread_id'] = new_thread.id
     
     
@@ -180,6 +213,38 @@ def ensure_thread():
     })
 
 
+@app.get('/api/provider_status')
+@login_required
+def provider_status():
+    return jsonify({name: resilience.guard(name).snapshot() for name in extensions.clients_by_name()})
+
+def is_local_request() -> bool:
+    # A proxy on this host makes every client look local, so anything it forwarded isn't
+    if request.headers.get("X-Forwarded-For") or request.headers.get("Forwarded"):
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or "").is_loopback
+    except ValueError:
+        return False
+
+@app.get('/metrics')
+def prometheus_metrics():
+    # Scrapers can't log in, so this is guarded by a bearer token instead; without one
+    # configured it doesn't exist for anyone but localhost
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get("Authorization") != f"Bearer {token}":
+            return "Unauthorized\n", 401
+    elif not is_local_request():
+        return "Not Found\n", 404
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def hashing_busy(endpoint: str):
+    # The hashing pool is saturated or too slow to answer; turn the user away now instead of queueing them
+    flash('Lots of people are signing in right now. Please try again in a few seconds.')
+    return redirect(url_for(endpoint))
+
 @app.get('/register/')
 def get_register():
     form = RegisterForm()
@@ -191,7 +256,10 @@ def post_register():
     if form.validate():
         user: User|None = get_user(email=form.email.data)
         if user is None:
-            user = User(email=form.email.data, password=form.password.data, status="Free") # type: ignore
+            try:
+                user = User(email=form.email.data, password=form.password.data, status="Free") # type: ignore
+            except (HashingBusy, TimeoutError):
+                return hashing_busy('get_register')
             extensions.db.session.add(user)
             extensions.db.session.commit()
 
@@ -218,7 +286,13 @@ def post_login():
     if form.validate():
         session.pop('current_thread_id', None) # Make a new thread upon login
         user: User|None = get_user(email=form.email.data)
-        if user is not None and user.verify_password(str(form.password.data)):
+        try:
+            valid = user is not None and user.verify_password(str(form.password.data))
+        except (HashingBusy, TimeoutError):
+            return hashing_busy('get_login')
+        if user is not None and valid:
+            # Persists the upgraded hash if verify_password rehashed it
+            extensions.db.session.commit()
             login_user(user)
             next_page = request.args.get('next')
             if next_page is None or not next_page.startswith('/'):
@@ -252,9 +326,11 @@ def account():
 @app.post('/account/upgrade')
 @login_required
 def upgrade_account():
-    # Update the user's status
-    current_user.status = "Premium"
-    extensions.db.session.commit()
+    # current_user is a read-only snapshot; update the row, which also invalidates the cached user
+    user: User|None = get_user(uid=current_user.id)
+    if user is not None:
+        user.status = "Premium"
+        extensions.db.session.commit()
     
     # Optional: Add a flash message
     flash("Successfully upgraded to Premium!")
@@ -267,24 +343,56 @@ def home():
     # Clears current thread to make a new one when refreshing home page
     if 'current_thread_id' in session:
         session.pop('current_thread_id')
-    # Gets all the threads with a SQL Alchemy query
-    current_threads = (
-        extensions.db.session.query(ChatThread)
-        .filter_by(user_id=current_user.id)
-        .order_by(ChatThread.date_created.desc())
-        .all()
-    )
-    for thread in current_threads:
+    # First page of the sidebar in one indexed query; the rest loads as the user scrolls
+    threads, next_cursor = _thread_page(None)
+    return render_template('home.html', current_user=current_user, threads=threads, next_cursor=next_cursor)
+
+def _thread_page(cursor: str | None) -> tuple[list[dict], str | None]:
+    before = None
+    if cursor:
+        last_activity, _, thread_id = cursor.rpartition('_')
+        before = (datetime.fromisoformat(last_activity), int(thread_id))
+    rows = dbms.list_thread_page(current_user.id, before, THREAD_PAGE_SIZE)
+    threads = [
+        {
+            "id": row.id,
+            "name": row.thread_name,
+            "date": row.date_created.strftime('%b %d %I:%M'),
+            "models": ", ".join(name for name in row.model_names.split(",") if name),
+        }
+        for row in rows
+    ]
+    next_cursor = None
+    if len(rows) == THREAD_PAGE_SIZE:
+        last = rows[-1]
+        next_cursor = f"{last.last_activity.isoformat()}_{last.id}"
+    return threads, next_cursor
 
-        models = extensions.db.session.query(ChatHistory.model_name)\
-            .filter_by(thread_id=thread.id)\
-            .distinct().all()
-        
-        # Convert list of rows [('CHATGPT',), ('GEMINI',)] -> "CHATGPT, GEMINI"
-        valid_models = [m[0] for m in models if m[0]] # Filter out None
-        thread.display_models = ", ".join(sorted(valid_models))
-        
-    return render_template('home.html', current_user=current_user, threads=current_threads)
+@app.get('/api/threads')
+@login_required
+def list_threads():
+    try:
+        threads, next_cursor = _thread_page(request.args.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    return jsonify({"threads": threads, "next_cursor": next_cursor})
+
+# Search results per page of /api/search
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+@app.get('/api/search')
+@login_required
+def search_history():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Missing search query"}), 400
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    results, next_offset = search_index.search(
+        extensions.db.session, current_user.id, query, request.args.get('model') or None, limit, offset
+    )
+    return jsonify({"results": results, "next_offset": next_offset})
 
 @app.get('/')
 def default_route():
@@ -296,27 +404,71 @@ def new_thread():
     session.pop('current_thread_id', None)
     return jsonify({"status": "new thread created"}), 200
 
+# History rows per page of /api/thread/<id>
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
 @app.get('/api/thread/<int:thread_id>')
 @login_required
 def switch_thread(thread_id: int):
+    summary = extensions.db.session.get(ThreadSummary, thread_id)
+    if summary is None or summary.user_id != current_user.id:
+        return jsonify({"error": "Thread not found or access denied"}), 403
 
-    # sets current threadID to one that was clicked
-    session['current_thread_id']= thread_id
-
-    # SQL call to get ALL history entries
-    history_entries= ChatHistory.query.filter_by(thread_id=thread_id).order_by(ChatHistory.id).all()
-
-    history = [
-        {
-            "user_input": entry.user_input,
-            "model_name": entry.model_name,
-            "model_response": entry.model_response,
-            "date_saved": entry.date_saved.strftime('%Y-%m-%d %H:%M:%S')
-        }
-        for entry in history_entries
-    ]
-
-    return jsonify({"history": history})
+    # sets current threadID to one that was clicked; hover prefetches leave it alone
+    if not request.args.get('prefetch', type=int):
+        session['current_thread_id'] = thread_id
+    elif archive.is_archived(extensions.db.session, thread_id):
+        # only opening an archived thread restores it, so a hover doesn't undo the archival
+        return current_app.response_class(status=204)
+
+    extensions.ensure_hot_thread(thread_id)
+
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = max(1, min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_MAX_PAGE_SIZE))
+
+    # The summary changes on every write, so it identifies the thread's state without
+    # reading any history blobs
+    etag = f"{thread_id}-{summary.message_count}-{summary.last_activity.timestamp()}-{before_id}-{after_id}-{limit}"
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    # One extra row tells us whether another page exists
+    if after_id is not None:
+        # Only what was saved after the client's cached copy, oldest first
+        rows = dbms.get_history_after(thread_id, after_id, limit + 1)
+        cursor = ("next_after_id", rows[limit - 1].id if len(rows) > limit else None)
+        rows = rows[:limit]
+    else:
+        rows = dbms.get_history_page(thread_id, before_id, limit + 1)
+        cursor = ("next_before_id", rows[limit - 1].id if len(rows) > limit else None)
+        rows = rows[:limit]
+        rows.reverse()
+    message_count = summary.message_count
+
+    def generate():
+        # Each row is decompressed only as it is written out, and each turn's prompt once
+        prompt_of = dbms.PromptDecoder()
+        yield '{"history":['
+        for i, row in enumerate(rows):
+            item = {
+                "id": row.id,
+                "user_input": prompt_of(row),
+                "model_name": row.model_name,
+                "model_response": dbms.db_decode_text(row._model_response),
+                "date_saved": row.date_saved.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            yield ("," if i else "") + json.dumps(item)
+        # The count lets a client check that its cached copy plus this page is the whole thread
+        yield f'],"{cursor[0]}":{json.dumps(cursor[1])},"message_count":{message_count}}}'
+
+    response = current_app.response_class(generate(), mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @app.delete('/api/thread/<int:thread_id>')
@@ -327,9 +479,7 @@ def delete_thread(thread_id):
     if not thread:
         return jsonify({"error": "Thread not found or access denied"}), 403
 
-    extensions.db.session.query(ChatHistory).filter_by(thread_id=thread_id).delete()
-    extensions.db.session.delete(thread)
-    extensions.db.session.commit()
+    archive.delete_threads(extensions.db.session, [thread_id])
     
     if session.get('current_thread_id') == thread_id:
         session.pop('current_thread_id', None)
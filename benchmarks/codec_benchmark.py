@@ -0,0 +1,122 @@
+"""
+Compares the chat history text codecs on sample data.
+
+Run from the repository root:
+    python -m benchmarks.codec_benchmark                     # synthetic chat corpus
+    python -m benchmarks.codec_benchmark --db users.sqlite3  # real history rows
+
+Reports encode/decode throughput and compression ratio for legacy LZMA, raw, zlib, zstd
+and (when zstandard is installed) zstd with a dictionary trained on half of the samples.
+"""
+from __future__ import annotations
+import argparse
+import lzma
+import random
+import sqlite3
+import time
+
+from modules import text_codec
+
+SENTENCES = [
+    "Sure! Here's a concise answer to your question.",
+    "The main difference is how each approach handles state.",
+    "In Python, you can use a list comprehension for this.",
+    "**Key points:**\n- It is fast\n- It is simple\n- It is widely supported",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "The capital of France is Paris.",
+    "Here is an example:\n```python\nfor i in range(10):\n    print(i)\n```",
+    "I hope this helps! Let me know if you have any other questions.",
+    "There are several factors to consider, including cost, latency and reliability.",
+    "In summary, both options work, but the second scales better.",
+]
+
+
+def synthetic_corpus(count: int, seed: int = 7) -> list[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        if rng.random() < 0.4:
+            # Prompts are short
+            corpus.append(rng.choice(SENTENCES)[: rng.randint(10, 60)])
+        else:
+            corpus.append(" ".join(rng.choice(SENTENCES) for _ in range(rng.randint(1, 8))))
+    return corpus
+
+
+def db_corpus(path: str, count: int) -> list[str]:
+    conn = sqlite3.connect(path)
+    blobs = [row[0] for row in conn.execute(
+        "SELECT model_response FROM chat_responses ORDER BY id DESC LIMIT ?", (count,)
+    )]
+    blobs += [row[0] for row in conn.execute(
+        "SELECT user_input FROM chat_turns ORDER BY id DESC LIMIT ?", (count,)
+    )]
+    conn.close()
+    return [text_codec.decode(blob) for blob in blobs]
+
+
+class LegacyLzma(text_codec.TextCodec):
+    """The pre-codec scheme: LZMA for anything over 25 bytes"""
+    tag = 0
+    name = "lzma (legacy)"
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(data) if len(data) > 25 else data
+
+    def decompress(self, payload: bytes) -> bytes:
+        return lzma.decompress(payload) if len(payload) > 25 else payload
+
+
+def bench(name: str, encode, decode, corpus: list[str], repeat: int) -> None:
+    raw_bytes = sum(len(text.encode("utf-8")) for text in corpus)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        blobs = [encode(text) for text in corpus]
+    encode_s = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for blob in blobs:
+            decode(blob)
+    decode_s = (time.perf_counter() - start) / repeat
+
+    stored = sum(len(blob) for blob in blobs)
+    mb = raw_bytes / 1e6
+    print(f"{name:<16} ratio {raw_bytes / stored:5.2f}  avg blob {stored / len(blobs):7.1f} B  "
+          f"encode {mb / encode_s:8.1f} MB/s  decode {mb / decode_s:8.1f} MB/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="SQLite database to sample chat history from")
+    parser.add_argument("--samples", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = db_corpus(args.db, args.samples) if args.db else synthetic_corpus(args.samples)
+    train, test = corpus[::2], corpus[1::2]
+    print(f"{len(test)} test samples, {sum(len(t) for t in test) / len(test):.0f} chars on average\n")
+
+    legacy = LegacyLzma()
+    bench(legacy.name, lambda t: legacy.compress(t.encode("utf-8")), legacy.decompress, test, args.repeat)
+
+    codecs: list[text_codec.TextCodec] = [text_codec.RawCodec(), text_codec.ZlibCodec()]
+    if text_codec.zstandard is not None:
+        codecs.append(text_codec.ZstdCodec())
+        samples = [text.encode("utf-8") for text in train]
+        try:
+            codecs.append(text_codec.ZstdDictCodec(text_codec.train_dictionary(samples, 16384)))
+        except Exception as e:
+            print(f"(skipping zstd-dict: {e})")
+    else:
+        print("(zstandard not installed; skipping zstd codecs)")
+
+    for codec in codecs:
+        if isinstance(codec, text_codec.ZstdDictCodec):
+            text_codec.register_dictionary(codec)
+        bench(codec.name, lambda t, c=codec: text_codec.encode(t, c), text_codec.decode, test, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
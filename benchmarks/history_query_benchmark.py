@@ -0,0 +1,125 @@
+"""
+Measures the hot chat-history queries before and after the schema migrations.
+
+Run from the repository root:
+    python -m benchmarks.history_query_benchmark
+    python -m benchmarks.history_query_benchmark --sizes 10000 100000
+
+For each size a scratch database with the original (index-free) schema is filled with
+synthetic rows. The queries are timed on a plain connection, then the migrations and
+connection pragmas are applied and the same queries are timed again.
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from modules import migrations
+
+ORIGINAL_SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR NOT NULL, pwd_hash BLOB NOT NULL,
+                    status VARCHAR NOT NULL);
+CREATE TABLE chat_threads (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users(id),
+                           thread_name VARCHAR(100) NOT NULL, date_created DATETIME NOT NULL);
+CREATE TABLE chat_history (id INTEGER PRIMARY KEY, thread_id INTEGER NOT NULL REFERENCES chat_threads(id),
+                           user_input BLOB NOT NULL, model_name VARCHAR(100) NOT NULL,
+                           model_response BLOB NOT NULL, date_saved DATETIME NOT NULL);
+"""
+
+MESSAGES_PER_THREAD = 20
+THREADS_PER_USER = 20
+MODELS = ["CHATGPT", "CLAUDE", "GEMINI", "DEEPSEEK"]
+
+
+def populate(path: str, rows: int) -> tuple[int, int]:
+    threads = max(1, rows // MESSAGES_PER_THREAD)
+    users = max(1, threads // THREADS_PER_USER)
+    conn = sqlite3.connect(path)
+    conn.executescript(ORIGINAL_SCHEMA)
+    conn.executemany(
+        "INSERT INTO users VALUES (?, ?, ?, 'Free')",
+        ((i, f"user{i}@example.com", b"x" * 120) for i in range(1, users + 1)),
+    )
+    conn.executemany(
+        "INSERT INTO chat_threads VALUES (?, ?, ?, datetime('now', ?))",
+        ((i, (i % users) + 1, f"thread {i}", f"-{i} minutes") for i in range(1, threads + 1)),
+    )
+    blob = b"\x01" + b"a reply of realistic length " * 8
+    conn.executemany(
+        "INSERT INTO chat_history VALUES (?, ?, ?, ?, ?, datetime('now'))",
+        ((i, (i % threads) + 1, b"\x01prompt", MODELS[i % len(MODELS)], blob) for i in range(1, rows + 1)),
+    )
+    conn.commit()
+    conn.close()
+    return threads, users
+
+
+def time_queries(conn, threads: int, users: int, iterations: int) -> dict[str, tuple[float, float]]:
+    rng = random.Random(1)
+    queries = {
+        "history page": lambda: conn.execute(
+            "SELECT id, user_input, model_name, model_response, date_saved FROM chat_history "
+            "WHERE thread_id = ? ORDER BY id DESC LIMIT 50", (rng.randint(1, threads),)).fetchall(),
+        "user threads": lambda: conn.execute(
+            "SELECT id, thread_name FROM chat_threads WHERE user_id = ? ORDER BY date_created DESC",
+            (rng.randint(1, users),)).fetchall(),
+        "user by email": lambda: conn.execute(
+            "SELECT id FROM users WHERE email = ?", (f"user{rng.randint(1, users)}@example.com",)).fetchall(),
+        "delete thread": lambda: (
+            conn.execute("DELETE FROM chat_history WHERE thread_id = ?", (rng.randint(1, threads),)),
+            conn.rollback(),
+        ),
+    }
+    results = {}
+    for name, run in queries.items():
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            run()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        results[name] = (statistics.mean(samples), samples[int(len(samples) * 0.95) - 1])
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    for rows in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.sqlite3")
+            threads, users = populate(path, rows)
+
+            engine = create_engine(f"sqlite:///{path}")
+            raw = engine.raw_connection()
+            before = time_queries(raw.driver_connection, threads, users, args.iterations)
+            raw.close()
+            engine.dispose()
+
+            engine = create_engine(f"sqlite:///{path}")
+            migrations.install_pragmas(engine, migrations.SqlitePragmas())
+            migrations.migrate(engine)
+            raw = engine.raw_connection()
+            after = time_queries(raw.driver_connection, threads, users, args.iterations)
+            raw.close()
+            engine.dispose()
+
+        print(f"\n{rows:,} history rows ({threads:,} threads, {users:,} users)")
+        print(f"  {'query':<14} {'before mean/p95 ms':>22} {'after mean/p95 ms':>22}")
+        for name in before:
+            b_mean, b_p95 = before[name]
+            a_mean, a_p95 = after[name]
+            print(f"  {name:<14} {b_mean:>11.3f} / {b_p95:<8.3f} {a_mean:>11.3f} / {a_p95:<8.3f}")
+
+
+if __name__ == "__main__":
+    main()
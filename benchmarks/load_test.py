@@ -0,0 +1,410 @@
+"""
+Offline load test: drives the app against local stand-in providers and reports latency.
+
+Run from the repository root:
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --scenarios fanout sidebar --concurrency 32 --requests 500
+    python -m benchmarks.load_test --json results.json
+    python -m benchmarks.load_test --baseline results.json   # exit 1 on regression
+
+Starts the servers from benchmarks/mock_providers.py, then the app (`flask run`) on a scratch
+database with every provider pointed at them, registers test users and seeds a long thread
+and a large sidebar directly in the database. Each scenario then runs a fixed number of
+operations at the given concurrency and reports throughput and p50/p95/p99 latency:
+
+    login_storm   fresh sessions logging in (CSRF page + argon2 verify)
+    fanout        one prompt to all eight models through /api/multi
+    long_thread   reloading a long thread's newest page
+    sidebar       opening /home and paging through the thread list
+
+Prompts are replayed from a JSONL corpus (requests.jsonl by default; "prompt", "body" or
+"title" fields). Use --target/--db to drive an app that is already running instead.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable
+
+import httpx
+
+from benchmarks import mock_providers
+from modules import text_codec
+
+SCENARIOS = ("login_storm", "fanout", "long_thread", "sidebar")
+MODELS = ["CHATGPT", "GEMINI", "CLAUDE", "MISTRAL", "GROK", "DEEPSEEK", "LLAMA", "QWEN"]
+PASSWORD = "load-test-password"
+CSRF_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+FALLBACK_PROMPTS = [
+    "Explain the difference between a process and a thread.",
+    "Summarize the causes of the French Revolution in three sentences.",
+    "Write a Python function that reverses a linked list.",
+]
+
+
+@dataclass
+class ScenarioResult:
+    scenario: str
+    operations: int
+    errors: int
+    seconds: float
+    throughput: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    # Scenario-specific counters, e.g. per-model errors inside a fan-out
+    extra: dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class Fixture:
+    base_url: str
+    emails: list[str]
+    prompts: list[str]
+    long_thread_id: int | None = None
+    sidebar_pages: int = 5
+
+
+def load_prompts(path: str | None) -> list[str]:
+    if not path or not os.path.exists(path):
+        return FALLBACK_PROMPTS
+    prompts = []
+    with open(path, encoding="utf-8") as fin:
+        for line in fin:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            text = item.get("prompt") or item.get("body") or item.get("title")
+            if text:
+                prompts.append(str(text))
+    return prompts or FALLBACK_PROMPTS
+
+
+def login(client: httpx.Client, email: str) -> None:
+    page = client.get("/login/")
+    match = CSRF_PATTERN.search(page.text)
+    if match is None:
+        raise RuntimeError("No CSRF token on the login page")
+    response = client.post("/login/", data={"email": email, "password": PASSWORD, "csrf_token": match.group(1)})
+    if response.status_code != 302 or not response.headers.get("location", "").endswith("/home"):
+        raise RuntimeError(f"Login failed for {email} ({response.status_code})")
+
+
+def register(base_url: str, email: str, attempts: int = 20) -> None:
+    for _ in range(attempts):
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            page = client.get("/register/")
+            token = CSRF_PATTERN.search(page.text)
+            response = client.post("/register/", data={
+                "email": email, "password": PASSWORD, "confirm_password": PASSWORD,
+                "csrf_token": token.group(1) if token else "",
+            })
+            location = response.headers.get("location", "")
+            if location.endswith("/home"):
+                return
+            if location.endswith("/register/"):
+                # Either the hashing pool was busy or the account exists from an earlier run
+                try:
+                    login(client, email)
+                    return
+                except RuntimeError:
+                    time.sleep(0.5)
+                    continue
+        raise RuntimeError(f"Registration failed for {email} ({response.status_code})")
+    raise RuntimeError(f"Registration kept failing for {email}")
+
+
+def seed(db_path: str, email: str, threads: int, turns: int, prompts: list[str]) -> int:
+    """
+    Gives the user `threads` empty threads plus one thread with `turns` replies.
+    Returns the long thread's id.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        user_id = conn.execute("SELECT id FROM users WHERE email = ?", (email,)).fetchone()[0]
+        now = datetime.now().replace(microsecond=0)
+        rows = [(user_id, f"load test {i}", now - timedelta(minutes=i)) for i in range(threads)]
+        for user, name, created in rows:
+            thread_id = conn.execute(
+                "INSERT INTO chat_threads (user_id, thread_name, date_created) VALUES (?, ?, ?)",
+                (user, name, created),
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO chat_thread_summaries (thread_id, user_id, model_names, message_count, last_activity) "
+                "VALUES (?, ?, '', 0, ?)",
+                (thread_id, user, created),
+            )
+
+        long_id = conn.execute(
+            "INSERT INTO chat_threads (user_id, thread_name, date_created) VALUES (?, 'load test long', ?)",
+            (user_id, now),
+        ).lastrowid
+        reply = " ".join(mock_providers.WORDS * 4)
+        for i in range(turns):
+            turn_id = conn.execute(
+                "INSERT INTO chat_turns (thread_id, user_input, date_saved) VALUES (?, ?, ?)",
+                (long_id, text_codec.encode(prompts[i % len(prompts)]), now),
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO chat_responses (turn_id, thread_id, model_name, model_response) VALUES (?, ?, ?, ?)",
+                (turn_id, long_id, MODELS[i % len(MODELS)], text_codec.encode(reply)),
+            )
+        conn.execute(
+            "INSERT INTO chat_thread_summaries (thread_id, user_id, model_names, message_count, last_activity) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (long_id, user_id, ",".join(sorted(MODELS)), turns, now + timedelta(seconds=1)),
+        )
+        conn.commit()
+        return long_id
+    finally:
+        conn.close()
+
+
+# Each operation gets (client, fixture, rng) and returns counters to add to the result's extra
+Operation = Callable[[httpx.Client, Fixture, random.Random], dict[str, int] | None]
+
+
+def op_login_storm(_client: httpx.Client, fixture: Fixture, rng: random.Random) -> None:
+    # A fresh session every time, so nothing is reused from an earlier login
+    with httpx.Client(base_url=fixture.base_url, timeout=120) as client:
+        login(client, rng.choice(fixture.emails))
+
+
+def op_fanout(client: httpx.Client, fixture: Fixture, rng: random.Random) -> dict[str, int]:
+    response = client.post("/api/multi", json={"prompt": rng.choice(fixture.prompts), "models": MODELS})
+    response.raise_for_status()
+    counters = {"model_replies": 0, "model_errors": 0}
+    for line in response.text.splitlines():
+        item = json.loads(line)
+        counters["model_errors" if "error" in item else "model_replies"] += 1
+    return counters
+
+
+def op_long_thread(client: httpx.Client, fixture: Fixture, _rng: random.Random) -> None:
+    response = client.get(f"/api/thread/{fixture.long_thread_id}", params={"limit": 200})
+    response.raise_for_status()
+    response.json()
+
+
+def op_sidebar(client: httpx.Client, fixture: Fixture, _rng: random.Random) -> None:
+    client.get("/home").raise_for_status()
+    cursor = None
+    for _ in range(fixture.sidebar_pages):
+        response = client.get("/api/threads", params={"cursor": cursor} if cursor else None)
+        response.raise_for_status()
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+
+
+OPERATIONS: dict[str, Operation] = {
+    "login_storm": op_login_storm,
+    "fanout": op_fanout,
+    "long_thread": op_long_thread,
+    "sidebar": op_sidebar,
+}
+
+
+def percentile(sorted_values: list[float], share: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(share * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name: str, fixture: Fixture, operations: int, concurrency: int, seed: int) -> ScenarioResult:
+    operation = OPERATIONS[name]
+    latencies: list[float] = []
+    extra: dict[str, int] = {}
+    errors = 0
+    lock = threading.Lock()
+    remaining = iter(range(operations))
+
+    def worker(index: int) -> None:
+        nonlocal errors
+        rng = random.Random(seed * 1000 + index)
+        with httpx.Client(base_url=fixture.base_url, timeout=120) as client:
+            if name != "login_storm":
+                # Fan-outs spread over all test users; thread reads need the seeded one
+                login(client, fixture.emails[index % len(fixture.emails)] if name == "fanout" else fixture.emails[0])
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                started = time.perf_counter()
+                try:
+                    counters = operation(client, fixture, rng)
+                    failed = False
+                except Exception:
+                    counters, failed = None, True
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    errors += failed
+                    for key, value in (counters or {}).items():
+                        extra[key] = extra.get(key, 0) + value
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, i) for i in range(concurrency)]:
+            future.result()
+    seconds = time.perf_counter() - started
+
+    latencies.sort()
+    return ScenarioResult(
+        scenario=name,
+        operations=len(latencies),
+        errors=errors,
+        seconds=round(seconds, 3),
+        throughput=round(len(latencies) / seconds, 2) if seconds else 0.0,
+        p50_ms=round(percentile(latencies, 0.50) * 1000, 1),
+        p95_ms=round(percentile(latencies, 0.95) * 1000, 1),
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 1),
+        extra=extra,
+    )
+
+
+def start_app(env: dict[str, str], port: int, log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port),
+         "--with-threads", "--no-reload", "--no-debugger"],
+        env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/login/", timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.25)
+    process.kill()
+    with open(log_path) as fin:
+        sys.stderr.write(fin.read()[-4000:])
+    raise RuntimeError("The app did not start")
+
+
+def compare(results: list[ScenarioResult], baseline_path: str, tolerance: float) -> list[str]:
+    """Scenarios whose p95 or throughput got worse than the baseline by more than tolerance."""
+    with open(baseline_path) as fin:
+        baseline = {item["scenario"]: item for item in json.load(fin)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get(result.scenario)
+        if before is None:
+            continue
+        if before["p95_ms"] and result.p95_ms > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result.scenario}: p95 {before['p95_ms']} -> {result.p95_ms} ms")
+        if before["throughput"] and result.throughput < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{result.scenario}: throughput {before['throughput']} -> {result.throughput}/s")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Operations per scenario.")
+    parser.add_argument("--users", type=int, default=16, help="Test accounts to register.")
+    parser.add_argument("--sidebar-threads", type=int, default=3000)
+    parser.add_argument("--sidebar-pages", type=int, default=5)
+    parser.add_argument("--long-thread-turns", type=int, default=2000)
+    parser.add_argument("--corpus", default="requests.jsonl", help="JSONL file of prompts to replay.")
+    parser.add_argument("--port", type=int, default=5055, help="Port for the app under test.")
+    parser.add_argument("--target", help="Base URL of an already running app (configured by the caller).")
+    parser.add_argument("--db", help="Database of the --target app, for seeding.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--baseline", help="Earlier --json output; exit 1 if a scenario regressed.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression vs. the baseline.")
+    mock_providers.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    profile, overrides = mock_providers.profile_from_arguments(args)
+    servers = mock_providers.start_mock_providers(profile, overrides, seed=args.seed)
+    prompts = load_prompts(args.corpus)
+    emails = [f"loadtest{i}@example.com" for i in range(max(1, args.users))]
+
+    with tempfile.TemporaryDirectory(prefix="load-test-") as scratch:
+        process = None
+        if args.target:
+            base_url, db_path = args.target.rstrip("/"), args.db
+        else:
+            base_url, db_path = f"http://127.0.0.1:{args.port}", os.path.join(scratch, "users.sqlite3")
+            env = {
+                **mock_providers.app_environment(servers),
+                "DATABASE_PATH": db_path,
+                # Every prompt should reach a provider, and nothing should dial the real hosts
+                "REPLY_CACHE_SIZE": "0",
+                "LLM_POOL_WARMUP": "0",
+            }
+            process = start_app(env, args.port, os.path.join(scratch, "app.log"))
+
+        try:
+            print(f"Registering {len(emails)} users...", flush=True)
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(lambda email: register(base_url, email), emails))
+
+            scenarios = list(args.scenarios)
+            fixture = Fixture(base_url, emails, prompts, sidebar_pages=args.sidebar_pages)
+            if {"long_thread", "sidebar"} & set(scenarios):
+                if db_path is None:
+                    print("No --db given; skipping long_thread and sidebar", file=sys.stderr)
+                    scenarios = [name for name in scenarios if name not in ("long_thread", "sidebar")]
+                else:
+                    print("Seeding threads...", flush=True)
+                    fixture.long_thread_id = seed(db_path, emails[0], args.sidebar_threads,
+                                                  args.long_thread_turns, prompts)
+
+            results = []
+            for name in scenarios:
+                print(f"Running {name}...", flush=True)
+                results.append(run_scenario(name, fixture, args.requests, args.concurrency, args.seed))
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    print()
+    print(f"{'scenario':<12} {'ops':>6} {'errors':>6} {'ops/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for result in results:
+        print(f"{result.scenario:<12} {result.operations:>6} {result.errors:>6} {result.throughput:>8.2f} "
+              f"{result.p50_ms:>9.1f} {result.p95_ms:>9.1f} {result.p99_ms:>9.1f}"
+              + (f"  {result.extra}" if result.extra else ""))
+    print()
+    for provider, server in servers.items():
+        stats = server.stats
+        print(f"mock {provider:<10} requests={stats.requests} streams={stats.streams} errors={stats.errors}")
+
+    if args.json:
+        with open(args.json, "w") as fout:
+            json.dump({
+                "when": datetime.now().isoformat(timespec="seconds"),
+                "config": {"concurrency": args.concurrency, "requests": args.requests,
+                           "profile": asdict(profile)},
+                "results": [asdict(result) for result in results],
+            }, fout, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+Local stand-ins for the LLM provider APIs, for load tests that shouldn't need API keys.
+
+Run from the repository root:
+    python -m benchmarks.mock_providers
+    python -m benchmarks.mock_providers --first-token-ms 800 --error-rate 0.02
+
+One HTTP server is started per provider, speaking its wire format (OpenAI-compatible chat
+completions for OpenAI, DeepSeek, Mistral, Together and xAI's REST API; Anthropic messages;
+Gemini generateContent), streaming included. Each reply waits for a log-normally distributed
+time to first token and then emits chunks at a fixed interval; a share of requests can be
+made to fail. The printed environment variables point the app's clients at the servers.
+"""
+from __future__ import annotations
+import argparse
+import dataclasses
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+WORDS = (
+    "the quick answer is that it depends on how the data is accessed and how often it "
+    "changes so a cache in front of the slow path usually helps more than tuning the query"
+).split()
+
+
+@dataclass
+class LatencyProfile:
+    # Median; the actual delay is log-normal around it
+    first_token_ms: float = 400.0
+    sigma: float = 0.5
+    chunk_ms: float = 20.0
+    chunks: int = 24
+    error_rate: float = 0.0
+    error_status: int = 503
+
+
+@dataclass
+class ServerStats:
+    requests: int = 0
+    streams: int = 0
+    errors: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+# Provider -> (wire format, environment variable the app reads, path appended to the server URL)
+PROVIDERS: dict[str, tuple[str, str, str]] = {
+    "openai": ("openai", "OPENAI_BASE_URL", "/v1"),
+    "deepseek": ("openai", "DEEPSEEK_BASE_URL", "/v1"),
+    "mistral": ("openai", "MISTRAL_BASE_URL", ""),
+    "together": ("openai", "TOGETHER_BASE_URL", "/v1"),
+    "xai": ("openai", "XAI_BASE_URL", "/v1"),
+    "anthropic": ("anthropic", "ANTHROPIC_BASE_URL", ""),
+    "gemini": ("gemini", "GEMINI_BASE_URL", ""),
+}
+
+# Keys the app needs before it will call a provider at all
+API_KEY_VARS = (
+    "OPENAI_API_KEY", "DEEPSEEK_API_KEY", "MISTRAL_API_KEY", "LLAMA_API_KEY", "QWEN_API_KEY",
+    "GROK_API_KEY", "CLAUDE_API_KEY", "GEMINI_API_KEY",
+)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, provider: str, wire_format: str, address: tuple[str, int], profile: LatencyProfile,
+                 seed: int | None = None):
+        super().__init__(address, _Handler)
+        self.provider = provider
+        self.wire_format = wire_format
+        self.profile = profile
+        self.stats = ServerStats()
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def plan(self) -> tuple[bool, float]:
+        """(should fail, seconds to first token) for one request."""
+        profile = self.profile
+        with self._rng_lock:
+            failed = self._rng.random() < profile.error_rate
+            delay = self._rng.lognormvariate(math.log(max(profile.first_token_ms, 0.001)), profile.sigma)
+        return failed, delay / 1000
+
+    def next_id(self) -> str:
+        return f"mock-{self.provider}-{next(self._ids)}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockServer
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = urlsplit(self.path).path
+        server = self.server
+        stream = bool(body.get("stream")) or path.endswith(":streamGenerateContent")
+        with server.stats.lock:
+            server.stats.requests += 1
+            server.stats.streams += stream
+
+        failed, first_token = server.plan()
+        if failed:
+            time.sleep(first_token)
+            with server.stats.lock:
+                server.stats.errors += 1
+            status = server.profile.error_status
+            self._send_json(status, {"error": {"code": status, "message": "mock provider failure",
+                                               "type": "overloaded_error", "status": "UNAVAILABLE"}})
+            return
+
+        prompt_tokens = max(1, len(json.dumps(body)) // 4)
+        pieces = [" ".join(WORDS[(i * 3) % len(WORDS):(i * 3) % len(WORDS) + 3]) + " "
+                  for i in range(server.profile.chunks)]
+        if server.wire_format == "anthropic" and path.endswith("/messages"):
+            self._anthropic(body, stream, first_token, pieces, prompt_tokens)
+        elif server.wire_format == "gemini" and (":generateContent" in path or ":streamGenerateContent" in path):
+            self._gemini(path, stream, first_token, pieces, prompt_tokens)
+        elif server.wire_format == "openai" and path.endswith("/chat/completions"):
+            self._openai(body, stream, first_token, pieces, prompt_tokens)
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {path}"}})
+
+    def _send_json(self, status: int, payload: dict) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, first_token: float, events) -> None:
+        """Sends SSE events with chunked encoding, pacing them per the latency profile."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(first_token)
+        for i, event in enumerate(events):
+            if i:
+                time.sleep(self.server.profile.chunk_ms / 1000)
+            data = event.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _reply_delay(self, first_token: float) -> None:
+        profile = self.server.profile
+        time.sleep(first_token + profile.chunks * profile.chunk_ms / 1000)
+
+    def _openai(self, body: dict, stream: bool, first_token: float, pieces: list[str], prompt_tokens: int) -> None:
+        model, reply_id, created = body.get("model", "mock"), self.server.next_id(), int(time.time())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(pieces) * 3,
+            "total_tokens": prompt_tokens + len(pieces) * 3,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        if not stream:
+            self._reply_delay(first_token)
+            self._send_json(200, {
+                "id": reply_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        def chunk(choices: list, **extra) -> str:
+            payload = {"id": reply_id, "object": "chat.completion.chunk", "created": created,
+                       "model": model, "choices": choices, **extra}
+            return f"data: {json.dumps(payload)}\n\n"
+
+        events = [chunk([{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}])
+                  for piece in pieces]
+        events.append(chunk([{"index": 0, "delta": {"content": ""}, "finish_reason": "stop"}]))
+        # Usage arrives on a final choice-less chunk, as with stream_options.include_usage
+        events.append(chunk([], usage=usage))
+        events.append("data: [DONE]\n\n")
+        self._stream(first_token, events)
+
+    def _anthropic(self, body: dict, stream: bool, first_token: float, pieces: list[str], prompt_tokens: int) -> None:
+        model, reply_id = body.get("model", "mock"), self.server.next_id()
+        usage = {"input_tokens": prompt_tokens, "output_tokens": len(pieces) * 3,
+                 "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+        message = {"id": reply_id, "type": "message", "role": "assistant", "model": model,
+                   "stop_reason": "end_turn", "stop_sequence": None}
+        if not stream:
+            self._reply_delay(first_token)
+            self._send_json(200, {**message, "content": [{"type": "text", "text": "".join(pieces)}], "usage": usage})
+            return
+
+        def event(name: str, payload: dict) -> str:
+            return f"event: {name}\ndata: {json.dumps({'type': name, **payload})}\n\n"
+
+        events = [
+            event("message_start", {"message": {**message, "content": [], "stop_reason": None,
+                                                 "usage": {**usage, "output_tokens": 0}}}),
+            event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}}),
+        ]
+        events += [event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": piece}})
+                   for piece in pieces]
+        events += [
+            event("content_block_stop", {"index": 0}),
+            event("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                    "usage": {"output_tokens": usage["output_tokens"]}}),
+            event("message_stop", {}),
+        ]
+        self._stream(first_token, events)
+
+    def _gemini(self, path: str, stream: bool, first_token: float, pieces: list[str], prompt_tokens: int) -> None:
+        model = path.rsplit("/", 1)[-1].split(":", 1)[0]
+
+        def response(text: str, done: bool, output_tokens: int) -> dict:
+            candidate: dict = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+            if done:
+                candidate["finishReason"] = "STOP"
+            return {
+                "candidates": [candidate],
+                "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                                  "totalTokenCount": prompt_tokens + output_tokens, "cachedContentTokenCount": 0},
+                "modelVersion": model,
+            }
+
+        if not stream:
+            self._reply_delay(first_token)
+            self._send_json(200, response("".join(pieces), True, len(pieces) * 3))
+            return
+        events = [f"data: {json.dumps(response(piece, i == len(pieces) - 1, (i + 1) * 3))}\r\n\r\n"
+                  for i, piece in enumerate(pieces)]
+        self._stream(first_token, events)
+
+
+def start_mock_providers(profile: LatencyProfile, overrides: dict[str, LatencyProfile] | None = None,
+                         host: str = "127.0.0.1", base_port: int = 0,
+                         seed: int | None = None) -> dict[str, MockServer]:
+    """
+    Starts one server per provider in background threads. base_port=0 picks free ports.
+    """
+    servers: dict[str, MockServer] = {}
+    for i, (provider, (wire_format, _, _)) in enumerate(PROVIDERS.items()):
+        port = base_port + i if base_port else 0
+        server = MockServer(provider, wire_format, (host, port), (overrides or {}).get(provider, profile),
+                            None if seed is None else seed + i)
+        threading.Thread(target=server.serve_forever, name=f"mock-{provider}", daemon=True).start()
+        servers[provider] = server
+    return servers
+
+
+def app_environment(servers: dict[str, MockServer]) -> dict[str, str]:
+    """
+    Environment variables that point the app's clients at the servers, with dummy keys.
+    """
+    env = {var: "mock-key" for var in API_KEY_VARS}
+    for provider, server in servers.items():
+        _, var, suffix = PROVIDERS[provider]
+        env[var] = server.url + suffix
+    return env
+
+
+def parse_overrides(items: list[str], profile: LatencyProfile) -> dict[str, LatencyProfile]:
+    """
+    Turns ["anthropic.first_token_ms=900", "gemini.error_rate=0.1"] into per-provider profiles.
+    """
+    overrides: dict[str, LatencyProfile] = {}
+    for item in items:
+        target, _, value = item.partition("=")
+        provider, _, name = target.partition(".")
+        if provider not in PROVIDERS or name not in LatencyProfile.__dataclass_fields__:
+            raise ValueError(f"Bad override {item!r}; expected <provider>.<field>=<value>")
+        current = overrides.get(provider, profile)
+        kind = type(getattr(current, name))
+        overrides[provider] = dataclasses.replace(current, **{name: kind(value)})
+    return overrides
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = LatencyProfile()
+    parser.add_argument("--first-token-ms", type=float, default=defaults.first_token_ms,
+                        help="Median time to first token.")
+    parser.add_argument("--sigma", type=float, default=defaults.sigma,
+                        help="Spread of the log-normal first-token delay.")
+    parser.add_argument("--chunk-ms", type=float, default=defaults.chunk_ms, help="Delay between streamed chunks.")
+    parser.add_argument("--chunks", type=int, default=defaults.chunks, help="Chunks per reply.")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="Share of requests that fail.")
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    parser.add_argument("--override", action="append", default=[], metavar="PROVIDER.FIELD=VALUE",
+                        help="Per-provider profile change, e.g. anthropic.first_token_ms=900. Repeatable.")
+
+
+def profile_from_arguments(args: argparse.Namespace) -> tuple[LatencyProfile, dict[str, LatencyProfile]]:
+    profile = LatencyProfile(args.first_token_ms, args.sigma, args.chunk_ms, args.chunks,
+                             args.error_rate, args.error_status)
+    return profile, parse_overrides(args.override, profile)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100, help="First port; one per provider follows it.")
+    parser.add_argument("--seed", type=int, default=None)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    profile, overrides = profile_from_arguments(args)
+    servers = start_mock_providers(profile, overrides, args.host, args.port, args.seed)
+    for var, value in sorted(app_environment(servers).items()):
+        print(f"export {var}={value}")
+    print("# Serving; Ctrl-C to stop", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
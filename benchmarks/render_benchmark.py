@@ -0,0 +1,59 @@
+"""
+Serves the browser micro-benchmark of the reply renderer (benchmarks/render_benchmark.html).
+
+Run from the repository root:
+    python -m benchmarks.render_benchmark
+    python -m benchmarks.render_benchmark --columns 8 --words 1000 --open
+
+and press "Run all" on the printed page. Every column types a generated markdown reply of
+--words words at once, first with the old renderer (one <span> and one chained setTimeout
+per word, with a forced reflow each), then with StreamingRenderer fed a few words every
+--token-ms, and then with StreamingRenderer given the whole reply at once. The table shows
+frame times while they run (p50/p95/p99/max and frames over 50 ms) and the DOM nodes left
+behind. window.runBenchmark(["timers", "streamed", "whole"]) runs the same from a script.
+"""
+from __future__ import annotations
+import argparse
+import functools
+import os
+import webbrowser
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--words", type=int, default=1000, help="Words per reply.")
+    parser.add_argument("--delay", type=int, default=30, help="Milliseconds per word for the old renderer.")
+    parser.add_argument("--token-ms", type=int, default=20, help="Milliseconds between streamed tokens.")
+    parser.add_argument("--words-per-token", type=int, default=3)
+    parser.add_argument("--open", action="store_true", help="Open the page in the default browser.")
+    args = parser.parse_args()
+
+    # The page imports the app's own compiled renderer from /static
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), functools.partial(QuietHandler, directory=ROOT))
+    query = urlencode({"columns": args.columns, "words": args.words, "delay": args.delay,
+                       "tokenMs": args.token_ms, "wordsPerToken": args.words_per_token})
+    url = f"http://127.0.0.1:{server.server_port}/benchmarks/render_benchmark.html?{query}"
+    print(f"serving {url}\nCtrl+C to stop")
+    if args.open:
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Measures chat-history search through the FTS5 side index against decompressing and
+scanning a user's history, which was the only way to search before.
+
+Run from the repository root:
+    python -m benchmarks.search_benchmark
+    python -m benchmarks.search_benchmark --rows 1000000 --iterations 200
+
+A scratch database is filled with compressed synthetic history (Zipf-distributed words
+across many users), indexed with the same backfill `flask backfill-search` runs, and then
+queried with one-word, two-word, prefix and model-filtered searches for random users.
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import string
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from modules import extensions, migrations, search_index, text_codec
+
+MESSAGES_PER_THREAD = 20
+THREADS_PER_USER = 20
+MODELS = ["CHATGPT", "CLAUDE", "GEMINI", "DEEPSEEK"]
+VOCABULARY = 20_000
+PROMPT_WORDS = 12
+REPLY_WORDS = 80
+
+
+def vocabulary(rng: random.Random) -> tuple[list[str], list[float]]:
+    words = sorted({"".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+                    for _ in range(VOCABULARY)})
+    rng.shuffle(words)
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    cumulative, total = [], 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return words, cumulative
+
+
+def populate(path: str, rows: int, words: list[str], cumulative: list[float], seed: int) -> tuple[int, int]:
+    rng = random.Random(seed)
+    threads = max(1, rows // MESSAGES_PER_THREAD)
+    users = max(1, threads // THREADS_PER_USER)
+
+    def sentence(count: int) -> str:
+        return " ".join(rng.choices(words, cum_weights=cumulative, k=count))
+
+    # Let the app create the current schema, then fill it in bulk
+    engine = create_engine(f"sqlite:///{path}")
+    extensions.db.metadata.create_all(engine)
+    migrations.migrate(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO users (id, email, pwd_hash, status) VALUES (?, ?, ?, 'Free')",
+        ((i, f"user{i}@example.com", b"x" * 120) for i in range(1, users + 1)),
+    )
+    conn.executemany(
+        "INSERT INTO chat_threads (id, user_id, thread_name, date_created) VALUES (?, ?, ?, datetime('now'))",
+        ((i, (i % users) + 1, f"thread {i}") for i in range(1, threads + 1)),
+    )
+    conn.executemany(
+        "INSERT INTO chat_turns (id, thread_id, user_input, date_saved) VALUES (?, ?, ?, datetime('now'))",
+        ((i, (i % threads) + 1, text_codec.encode(sentence(PROMPT_WORDS))) for i in range(1, rows + 1)),
+    )
+    conn.executemany(
+        "INSERT INTO chat_responses (id, turn_id, thread_id, model_name, model_response) VALUES (?, ?, ?, ?, ?)",
+        ((i, i, (i % threads) + 1, MODELS[i % len(MODELS)], text_codec.encode(sentence(REPLY_WORDS)))
+         for i in range(1, rows + 1)),
+    )
+    # The index predates none of these rows, so all of them are the backfill's job
+    conn.execute("UPDATE search_backfill SET last_id = 0, upto = ?", (rows,))
+    conn.commit()
+    conn.close()
+    return threads, users
+
+
+def percentile(samples: list[float], share: float) -> float:
+    return sorted(samples)[max(0, int(len(samples) * share) - 1)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=5000, help="Backfill batch size.")
+    parser.add_argument("--scan-iterations", type=int, default=10, help="Runs of the decompress-and-scan baseline.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words, cumulative = vocabulary(rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "search.sqlite3")
+        started = time.perf_counter()
+        threads, users = populate(path, args.rows, words, cumulative, args.seed)
+        print(f"{args.rows:,} history rows ({threads:,} threads, {users:,} users) "
+              f"written in {time.perf_counter() - started:.1f}s")
+
+        engine = create_engine(f"sqlite:///{path}")
+        migrations.install_pragmas(engine, migrations.SqlitePragmas())
+        with Session(engine) as session:
+            started = time.perf_counter()
+            total = 0
+            while True:
+                indexed, last_id, upto = search_index.backfill_batch(session, args.batch_size)
+                total += indexed
+                if last_id >= upto:
+                    break
+            elapsed = time.perf_counter() - started
+            print(f"backfill: {total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s), "
+                  f"database {os.path.getsize(path) / 2**20:.0f} MiB")
+
+            # Mid-frequency words: common enough to match a lot, rare enough to be a real query
+            common = words[20:2000]
+            queries = {
+                "one word": lambda: (rng.choice(common), None),
+                "two words": lambda: (f"{rng.choice(common)} {rng.choice(common)}", None),
+                "prefix": lambda: (rng.choice(common)[:3] + "*", None),
+                "one word + model": lambda: (rng.choice(common), rng.choice(MODELS)),
+            }
+            print(f"\n  {'search':<18} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'avg hits':>9}")
+            for name, make in queries.items():
+                samples, hits = [], []
+                for _ in range(args.iterations):
+                    query, model = make()
+                    user_id = rng.randint(1, users)
+                    start = time.perf_counter()
+                    results, _ = search_index.search(session, user_id, query, model, limit=20)
+                    samples.append((time.perf_counter() - start) * 1000)
+                    hits.append(len(results))
+                print(f"  {name:<18} {statistics.median(samples):>8.2f} {percentile(samples, 0.95):>8.2f} "
+                      f"{percentile(samples, 0.99):>8.2f} {statistics.mean(hits):>9.1f}")
+
+        # What a search cost before: decode every one of the user's rows and look for the word
+        conn = sqlite3.connect(path)
+        samples = []
+        for _ in range(args.scan_iterations):
+            word, user_id = rng.choice(common), rng.randint(1, users)
+            start = time.perf_counter()
+            rows = conn.execute(
+                "SELECT p.user_input, r.model_response FROM chat_responses r JOIN chat_turns p ON p.id = r.turn_id "
+                "JOIN chat_threads t ON t.id = r.thread_id WHERE t.user_id = ?", (user_id,)).fetchall()
+            [row for row in rows if any(word in text_codec.decode(blob) for blob in row)]
+            samples.append((time.perf_counter() - start) * 1000)
+        conn.close()
+        engine.dispose()
+        print(f"  {'scan (no index)':<18} {statistics.median(samples):>8.2f} {percentile(samples, 0.95):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures app startup time and resident memory with lazy vs. eager provider SDK imports.
+
+Run from the repository root:
+    python -m benchmarks.startup_benchmark
+    python -m benchmarks.startup_benchmark --runs 10 --workers 8
+
+Every sample imports the app in a fresh interpreter (as each pre-fork worker does when the
+app isn't preloaded) and reports the median wall time and the resident set size afterwards.
+"eager" first imports all six provider SDKs, which is what every worker paid before the SDK
+imports moved into the clients; "lazy" is the current behaviour. Both are measured with no
+API keys, one key and every key set.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks import mock_providers
+
+PROBE = r"""
+import json, os, sys, time
+started = time.perf_counter()
+if os.environ.get("STARTUP_EAGER") == "1":
+    import openai, anthropic, xai_sdk, mistralai, together
+    from google import genai
+import app
+elapsed = time.perf_counter() - started
+rss_kib = 0
+with open("/proc/self/status") as fin:
+    for line in fin:
+        if line.startswith("VmRSS:"):
+            rss_kib = int(line.split()[1])
+sdks = [name for name in ("openai", "anthropic", "xai_sdk", "mistralai", "together", "google.genai")
+        if name in sys.modules]
+print(json.dumps({"seconds": elapsed, "rss_kib": rss_kib, "sdks": sdks}))
+"""
+
+KEY_SETS = {
+    "no keys": [],
+    "one key": ["OPENAI_API_KEY"],
+    "all keys": list(mock_providers.API_KEY_VARS),
+}
+
+
+def sample(eager: bool, keys: list[str], db_path: str) -> dict:
+    env = {name: value for name, value in os.environ.items()
+           if name not in mock_providers.API_KEY_VARS}
+    env.update({name: "benchmark-key" for name in keys})
+    env.update({"STARTUP_EAGER": "1" if eager else "0", "DATABASE_PATH": db_path, "LLM_POOL_WARMUP": "0"})
+    output = subprocess.run([sys.executable, "-c", PROBE], env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per configuration.")
+    parser.add_argument("--workers", type=int, default=4, help="Pre-fork workers to project memory for.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="startup-") as scratch:
+        db_path = os.path.join(scratch, "users.sqlite3")
+        # One throwaway start creates the schema so every sample measures the same work
+        sample(False, [], db_path)
+
+        print(f"{'configuration':<20} {'startup ms':>11} {'RSS MiB':>9} {f'x{args.workers} MiB':>10}  SDKs loaded")
+        results: dict[tuple[str, bool], tuple[float, float]] = {}
+        for label, keys in KEY_SETS.items():
+            for eager in (True, False):
+                runs = [sample(eager, keys, db_path) for _ in range(args.runs)]
+                seconds = statistics.median(run["seconds"] for run in runs)
+                rss = statistics.median(run["rss_kib"] for run in runs) / 1024
+                results[label, eager] = seconds, rss
+                name = f"{label}, {'eager' if eager else 'lazy'}"
+                print(f"{name:<20} {seconds * 1000:>11.0f} {rss:>9.1f} {rss * args.workers:>10.1f}  "
+                      f"{len(runs[-1]['sdks'])}")
+
+    print()
+    for label in KEY_SETS:
+        (eager_s, eager_rss), (lazy_s, lazy_rss) = results[label, True], results[label, False]
+        print(f"{label}: lazy saves {(eager_s - lazy_s) * 1000:.0f} ms and {eager_rss - lazy_rss:.1f} MiB per worker "
+              f"({(eager_rss - lazy_rss) * args.workers:.1f} MiB across {args.workers} workers)")
+
+
+if __name__ == "__main__":
+    main()
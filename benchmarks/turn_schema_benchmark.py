@@ -0,0 +1,177 @@
+"""
+Measures chat history stored one row per reply (chat_history, a copy of the prompt in
+every row) against the turn schema (one chat_turns row per prompt, chat_responses per reply).
+
+Run from the repository root:
+    python -m benchmarks.turn_schema_benchmark
+    python -m benchmarks.turn_schema_benchmark --prompts 20000 --models 8
+
+A scratch database is filled with compressed synthetic history in chat_history, where each
+prompt was sent to --models models. History pages are read and decoded the way
+/api/thread/<id> does it, then the rows are moved with the same code `flask migrate-turns`
+runs, and the same pages are read again. Sizes are compared after a VACUUM of each.
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from modules import extensions, migrations, text_codec, turn_migration
+
+PROMPTS_PER_THREAD = 20
+MODELS = ["CHATGPT", "CLAUDE", "GEMINI", "DEEPSEEK", "GROK", "MISTRAL", "LLAMA", "QWEN"]
+WORDS = ("the model context token stream render frame layout column reply prompt cache latency budget "
+         "paragraph browser thread history markdown query index schema turn response").split()
+
+LEGACY_PAGE = (
+    "SELECT id, user_input, model_name, model_response, date_saved FROM chat_history "
+    "WHERE thread_id = ? ORDER BY id DESC LIMIT ?"
+)
+TURN_PAGE = (
+    "SELECT r.id, r.turn_id, t.user_input, r.model_name, r.model_response, t.date_saved "
+    "FROM chat_responses r JOIN chat_turns t ON t.id = r.turn_id "
+    "WHERE r.thread_id = ? ORDER BY r.id DESC LIMIT ?"
+)
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def populate(path: str, prompts: int, models: int, prompt_words: int, reply_words: int, seed: int) -> int:
+    rng = random.Random(seed)
+    threads = max(1, prompts // PROMPTS_PER_THREAD)
+    engine = create_engine(f"sqlite:///{path}")
+    extensions.db.metadata.create_all(engine)
+    migrations.migrate(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO users (id, email, pwd_hash, status) VALUES (1, 'bench@example.com', x'00', 'Free')")
+    conn.executemany(
+        "INSERT INTO chat_threads (id, user_id, thread_name, date_created) VALUES (?, 1, ?, datetime('now'))",
+        ((i, f"thread {i}") for i in range(1, threads + 1)),
+    )
+    started = datetime(2025, 1, 1)
+    rows = []
+    for i in range(prompts):
+        prompt = text_codec.encode(sentence(rng, prompt_words))
+        # Each model's reply was saved as it finished
+        saved = started + timedelta(minutes=i)
+        for j, model in enumerate(MODELS[:models]):
+            rows.append(((i % threads) + 1, prompt, model, text_codec.encode(sentence(rng, reply_words)),
+                         saved + timedelta(seconds=j)))
+    conn.executemany(
+        "INSERT INTO chat_history (thread_id, user_input, model_name, model_response, date_saved) "
+        "VALUES (?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+    return threads
+
+
+def read_pages(conn: sqlite3.Connection, query: str, threads: int, page: int, iterations: int,
+               seed: int, per_turn: bool) -> tuple[list[float], int]:
+    """
+    Times reading and decoding one page of a random thread. Returns the samples in ms and
+    how many prompts were decoded per page on average.
+    """
+    rng = random.Random(seed)
+    samples, decoded = [], 0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        rows = conn.execute(query, (rng.randint(1, threads), page)).fetchall()
+        prompts: dict[int, str] = {}
+        for row in rows:
+            if per_turn:
+                if row[1] not in prompts:
+                    prompts[row[1]] = text_codec.decode(row[2])
+                text_codec.decode(row[4])
+            else:
+                prompts[row[0]] = text_codec.decode(row[1])
+                text_codec.decode(row[3])
+        samples.append((time.perf_counter() - started) * 1000)
+        decoded += len(prompts)
+    return samples, decoded // iterations
+
+
+def size_after_vacuum(path: str) -> int:
+    conn = sqlite3.connect(path)
+    conn.execute("VACUUM")
+    conn.close()
+    return os.path.getsize(path)
+
+
+def percentile(samples: list[float], share: float) -> float:
+    return sorted(samples)[max(0, int(len(samples) * share) - 1)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prompts", type=int, default=5000)
+    parser.add_argument("--models", type=int, default=8, choices=range(1, len(MODELS) + 1))
+    parser.add_argument("--prompt-words", type=int, default=60)
+    parser.add_argument("--reply-words", type=int, default=120)
+    parser.add_argument("--page", type=int, default=50, help="Responses per history page.")
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--batch-size", type=int, default=50, help="Threads converted per transaction.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "turns.sqlite3")
+        threads = populate(path, args.prompts, args.models, args.prompt_words, args.reply_words, args.seed)
+        print(f"{args.prompts:,} prompts x {args.models} models in {threads:,} threads")
+
+        conn = sqlite3.connect(path)
+        legacy_bytes = conn.execute(
+            "SELECT SUM(LENGTH(user_input)), SUM(LENGTH(model_response)) FROM chat_history"
+        ).fetchone()
+        legacy = read_pages(conn, LEGACY_PAGE, threads, args.page, args.iterations, args.seed, per_turn=False)
+        conn.close()
+        legacy_size = size_after_vacuum(path)
+
+        engine = create_engine(f"sqlite:///{path}")
+        migrations.install_pragmas(engine, migrations.SqlitePragmas())
+        started = time.perf_counter()
+        moved = 0
+        with Session(engine) as session:
+            while True:
+                converted, rows = turn_migration.convert_batch(session, args.batch_size)
+                if not converted:
+                    break
+                moved += rows
+        elapsed = time.perf_counter() - started
+        engine.dispose()
+        print(f"migration: {moved:,} rows in {elapsed:.1f}s ({moved / elapsed:,.0f} rows/s)")
+
+        conn = sqlite3.connect(path)
+        turn_bytes = (
+            conn.execute("SELECT SUM(LENGTH(user_input)) FROM chat_turns").fetchone()[0],
+            conn.execute("SELECT SUM(LENGTH(model_response)) FROM chat_responses").fetchone()[0],
+        )
+        turns = read_pages(conn, TURN_PAGE, threads, args.page, args.iterations, args.seed, per_turn=True)
+        conn.close()
+        turn_size = size_after_vacuum(path)
+
+    print(f"  {'layout':<12} {'file MiB':>9} {'prompt MiB':>11} {'reply MiB':>10} "
+          f"{'page p50 ms':>12} {'p95 ms':>8} {'prompts decoded':>16}")
+    for name, size, (prompt_bytes, reply_bytes), (samples, decoded) in (
+        ("chat_history", legacy_size, legacy_bytes, legacy),
+        ("turns", turn_size, turn_bytes, turns),
+    ):
+        print(f"  {name:<12} {size / 2**20:>9.1f} {prompt_bytes / 2**20:>11.1f} {reply_bytes / 2**20:>10.1f} "
+              f"{statistics.median(samples):>12.2f} {percentile(samples, 0.95):>8.2f} {decoded:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -52,12 +52,13 @@ class DropboxHasher:
 
 class UpdatedHasher:
     """Upgrades the Dropbox for modern systems using Argon2"""
-    def __init__(self, pepper_key: bytes):
+    def __init__(self, pepper_key: bytes, time_cost: int = 10, memory_cost: int = 65536, parallelism: int = 4):
         self.pepper = Fernet(pepper_key)
+        self.argon2 = argon2.using(rounds=time_cost, memory_cost=memory_cost, parallelism=parallelism)
 
     def hash(self, pwd: str) -> bytes:
         # hash with argon2
-        hash: str = argon2.using(rounds=10).hash(pwd)
+        hash: str = self.argon2.hash(pwd)
         # convert this unicode hash string into bytes before encryption
         hashb: bytes = hash.encode('utf-8')
         # encrypt this hash using the global pepper
@@ -72,6 +73,11 @@ class UpdatedHasher:
         # check if the given password matches this hash
         return argon2.verify(pwd, hash)
 
+    def needs_update(self, pep_hash: bytes) -> bool:
+        # true if the hash was made with different argon2 parameters than ours
+        hash: str = self.pepper.decrypt(pep_hash).decode('utf-8')
+        return self.argon2.needs_update(hash)
+
     @staticmethod
     def random_pepper() -> bytes:
         return Fernet.generate_key()
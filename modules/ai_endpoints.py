@@ -1,51 +1,166 @@
-from flask import request, session, jsonify, current_app, Response
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator
+from flask import request, session, jsonify, current_app, Response, stream_with_context
 import flask
 from modules import dbms
-from modules.dbms import ChatThread, ChatHistory
+from modules.dbms import ChatThread
 from flask_login import current_user
 import modules.extensions as extensions
-from modules.llm_client import LLMClient
+from modules.history_writer import ReplyStats
+from modules.llm_client import CallUsage, LLMClient
+from modules import metrics, resilience
+from modules.resilience import ProviderUnavailable
 
 db = extensions.db
 debug_ai_messages = False
 
+# Shared pool for /api/multi so a burst of fan-outs can't spawn unbounded threads
+fanout_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LLM_FANOUT_WORKERS", "16")),
+    thread_name_prefix="llm-fanout",
+)
+# Extra time a fan-out stream waits past the providers' own deadlines, for their final events
+STREAM_GRACE_SECONDS = 5.0
+
 
 def _get_or_create_thread(prompt: str) -> ChatThread:
     thread_id = session.get("current_thread_id")
     if thread_id is not None:
         thread = db.session.get(ChatThread, thread_id)
         if thread:
+            extensions.ensure_hot_thread(thread.id)
             return thread
 
     thread_title = prompt[:10] + ("..." if len(prompt) > 50 else "")
-    thread = ChatThread(user_id=current_user.id, thread_name=thread_title)
-    db.session.add(thread)
-    db.session.commit()
+    thread = dbms.create_thread(current_user.id, thread_title)
     session["current_thread_id"] = thread.id
     return thread
 
 
-def _save_history(thread_id: int, prompt: str, model_name: str, reply: str) -> None:
-    new_message = ChatHistory(
-        thread_id=thread_id,
-        user_input=prompt,
-        model_name=model_name,
-        model_response=reply,
-    )
-    db.session.add(new_message)
-    db.session.commit()
+def _save_history(thread_id: int, prompt: str, model_name: str, reply: str,
+                  stats: dict[str, ReplyStats] | None = None) -> list[int]:
+    """
+    Saves one reply and waits until it is committed. Returns the new response id.
+    """
+    return _save_history_batch(thread_id, prompt, [(model_name, reply)], stats=stats)
+
+
+def _save_history_batch(thread_id: int, prompt: str, replies: list[tuple[str, str]],
+                        wait: bool = True, stats: dict[str, ReplyStats] | None = None) -> list[int]:
+    """
+    Saves several (model_name, reply) pairs for the same prompt as one turn through the
+    group-commit writer. With wait=False the rows are only queued and no ids are returned.
+    """
+    writer = extensions.history_writer
+    assert writer is not None
+    if not wait:
+        writer.submit(thread_id, prompt, replies, stats)
+        return []
+    started = time.perf_counter()
+    ids = writer.save(thread_id, prompt, replies, stats)
+    metrics.HISTORY_SAVE_SECONDS.observe(time.perf_counter() - started)
+    return ids
 
 
-def _get_history_context(max_messages: int) -> list[tuple[str, str]]:
+def _get_history_context(client: LLMClient) -> list[tuple[str, str]]:
+    """
+    This model's own prior turns in the current thread, fitted to its token budget.
+    """
     thread_id = flask.session.get("current_thread_id")
-    if thread_id is None:
+    if thread_id is None or extensions.turn_cache is None:
         return []
-    messages: list[tuple[str, str]] = []
-    for entry in dbms.get_history_entries(thread_id):
-        if len(messages) >= max_messages:
-            break
-        messages.append((entry.user_input, entry.model_response))
-    return messages
+    budget = extensions.context_budgets.get(client.name, extensions.context_budget)
+    return extensions.turn_cache.build(thread_id, client.name, budget)
+
+
+def _cache_key(client: LLMClient, system_prompt: str, prompt: str,
+               history: list[tuple[str, str]]) -> str | None:
+    """
+    Returns the reply-cache key for this call, or None when caching is off for the client.
+    """
+    cache = extensions.reply_cache
+    if cache is None:
+        return None
+    if not cache.enabled_for(client):
+        cache.note_bypass()
+        return None
+    return cache.key(client, system_prompt, prompt, history)
+
+
+def _note_stats(stats: dict[str, ReplyStats] | None, client: LLMClient, started: float,
+                usage: CallUsage) -> None:
+    """
+    Records how long the reply took and, if a provider call reported them, its tokens.
+    Cache hits get a latency but no tokens.
+    """
+    if stats is None:
+        return
+    stats[client.name] = ReplyStats(
+        latency_ms=round((time.perf_counter() - started) * 1000),
+        input_tokens=usage.input_tokens if usage.calls else None,
+        output_tokens=usage.output_tokens if usage.calls else None,
+    )
+
+
+def _cached_reply(client: LLMClient, prompt: str, history: list[tuple[str, str]],
+                  stats: dict[str, ReplyStats] | None = None) -> str:
+    started = time.perf_counter()
+    usage = CallUsage()
+    system_prompt = client.system_prompt()
+    key = _cache_key(client, system_prompt, prompt, history)
+    if key is not None:
+        cached = extensions.reply_cache.get(key)  # type: ignore[union-attr]
+        if cached is not None:
+            _note_stats(stats, client, started, usage)
+            return cached
+
+    with metrics.LLMCall(client.name):
+        reply = resilience.guard(client.name).call(
+            lambda: usage.call(
+                lambda: client.get_reply(system_prompt=system_prompt, user_prompt=prompt, history=history)
+            )
+        )
+    if key is not None and reply:
+        extensions.reply_cache.put(key, reply)  # type: ignore[union-attr]
+    _note_stats(stats, client, started, usage)
+    return reply
+
+
+def _cached_stream(client: LLMClient, prompt: str, history: list[tuple[str, str]],
+                   stats: dict[str, ReplyStats] | None = None) -> Iterator[str]:
+    """
+    stream_reply with the reply cache in front. A hit is sent as a single chunk.
+    """
+    started = time.perf_counter()
+    usage = CallUsage()
+    system_prompt = client.system_prompt()
+    key = _cache_key(client, system_prompt, prompt, history)
+    if key is not None:
+        cached = extensions.reply_cache.get(key)  # type: ignore[union-attr]
+        if cached is not None:
+            _note_stats(stats, client, started, usage)
+            yield cached
+            return
+
+    parts: list[str] = []
+    guard = resilience.guard(client.name)
+    with metrics.LLMCall(client.name) as call:
+        for delta in guard.stream(
+            lambda: usage.stream(
+                client.stream_reply(system_prompt=system_prompt, user_prompt=prompt, history=history)
+            )
+        ):
+            call.first_token()
+            parts.append(delta)
+            yield delta
+    if key is not None and parts:
+        extensions.reply_cache.put(key, "".join(parts))  # type: ignore[union-attr]
+    _note_stats(stats, client, started, usage)
 
 
 def single_llm_endpoint(client: LLMClient | None) -> Response:
@@ -71,23 +186,305 @@ def single_llm_endpoint(client: LLMClient | None) -> Response:
         return jsonify({"reply": reply}), 200
 
     try:
-        reply = client.get_reply(
-            system_prompt=client.system_prompt(),
-            user_prompt=prompt,
-            history=_get_history_context(2),
-        )
-        _save_history(current_thread.id, prompt, client.name, reply)
+        stats: dict[str, ReplyStats] = {}
+        reply = _cached_reply(client, prompt, _get_history_context(client), stats)
+        _save_history(current_thread.id, prompt, client.name, reply, stats)
         return jsonify({"reply": reply}), 200
+    except ProviderUnavailable as e:
+        current_app.logger.warning("%s", e)
+        return jsonify(_error_payload(e)), 503
     except Exception as e:
         current_app.logger.exception("%s request failed", client.name)
         return jsonify({"error": str(e)}), 500
 
 
-def gpt()      -> Response: return single_llm_endpoint(extensions.gpt_client)
-def gemini()   -> Response: return single_llm_endpoint(extensions.gemini_client)
-def claude()   -> Response: return single_llm_endpoint(extensions.claude_client)
-def grok()     -> Response: return single_llm_endpoint(extensions.grok_client)
-def deepseek() -> Response: return single_llm_endpoint(extensions.deepseek_client)
-def mistral()  -> Response: return single_llm_endpoint(extensions.mistral_client)
-def llama_together() -> Response: return single_llm_endpoint(extensions.llama_client)
-def qwen_together() -> Response: return single_llm_endpoint(extensions.qwen_client)
\ No newline at end of file
+def _error_payload(error: BaseException) -> dict:
+    """
+    Error body for a failed model call. "degraded" tells the UI the provider itself is
+    struggling, as opposed to this particular request failing.
+    """
+    payload: dict = {"error": str(error)}
+    if isinstance(error, ProviderUnavailable):
+        payload["degraded"] = True
+    return payload
+
+
+def _parse_multi_request() -> tuple[tuple[str, dict[str, LLMClient], list[str]] | None, tuple[Response, int] | None]:
+    """
+    Reads {prompt, models[]} from the request body. Returns ((prompt, clients by name, unknown
+    names), None), or (None, error response) when the body is unusable.
+    """
+    data = request.get_json(force=True)
+    prompt = data.get("prompt", "").strip()
+    if not prompt:
+        return None, (jsonify({"error": "Empty prompt"}), 400)
+
+    requested = data.get("models", [])
+    if not isinstance(requested, list) or not requested:
+        return None, (jsonify({"error": "No models selected"}), 400)
+    names = list(dict.fromkeys(str(name).upper() for name in requested))
+
+    available = extensions.clients_by_name()
+    clients = {name: available[name] for name in names if name in available}
+    unknown = [name for name in names if name not in available]
+    return (prompt, clients, unknown), None
+
+
+def multi_llm_endpoint() -> Response:
+    """
+    Sends one prompt to every requested model in parallel. Results are streamed back as
+    newline-delimited JSON, one {"model", "reply"|"error"} object per model as each finishes.
+    """
+    parsed, error = _parse_multi_request()
+    if error is not None:
+        return error
+    prompt, clients, unknown = parsed
+
+    # The thread is resolved once for the whole fan-out; history is per model
+    current_thread = _get_or_create_thread(prompt)
+    thread_id = current_thread.id
+    histories = {name: _get_history_context(client) for name, client in clients.items()}
+    current_app.logger.info(
+        "multi endpoint called; models=%s prompt_len=%d",
+        ",".join(clients),
+        len(prompt),
+    )
+
+    def generate():
+        for name in unknown:
+            yield json.dumps({"model": name, "error": _missing_message(name)}) + "\n"
+
+        if debug_ai_messages:
+            replies = [(f"{client.model}-debug", f"This is a {name} response from debug mode.")
+                       for name, client in clients.items()]
+            _save_history_batch(thread_id, prompt, replies)
+            for name, (_, reply) in zip(clients, replies):
+                yield json.dumps({"model": name, "reply": reply}) + "\n"
+            return
+
+        stats: dict[str, ReplyStats] = {}
+        futures = {
+            fanout_executor.submit(_cached_reply, client, prompt, histories[name], stats): name
+            for name, client in clients.items()
+        }
+        replies: list[tuple[str, str]] = []
+        try:
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    reply = future.result()
+                except Exception as e:
+                    current_app.logger.exception("%s request failed", name)
+                    yield json.dumps({"model": name, **_error_payload(e)}) + "\n"
+                    continue
+                replies.append((name, reply))
+                yield json.dumps({"model": name, "reply": reply}) + "\n"
+        finally:
+            # Runs even if the browser disconnects mid-stream, so finished replies are kept
+            for future in futures:
+                future.cancel()
+            # The replies have already been sent, so there's nothing to wait for
+            _save_history_batch(thread_id, prompt, replies, wait=False, stats=stats)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def _sse_response(events) -> Response:
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _debug_stream(name: str) -> tuple[str, list[str]]:
+    reply = f"This is a {name} response from debug mode."
+    return reply, [word + " " for word in reply.split(" ")]
+
+
+def single_llm_stream_endpoint(client: LLMClient | None) -> Response:
+    """
+    Server-Sent-Events variant of single_llm_endpoint. Emits a "token" event per chunk,
+    then "done" once the reply has been saved, or "error".
+    """
+    if client is None:
+        return jsonify({"error": "Unknown LLM"}), 400
+
+    data = request.get_json(force=True)
+    prompt = data.get("prompt", "").strip()
+    if not prompt:
+        return jsonify({"error": "Empty prompt"}), 400
+
+    current_thread = _get_or_create_thread(prompt)
+    thread_id = current_thread.id
+    history = _get_history_context(client)
+    current_app.logger.info(
+        "%s stream endpoint called; model=%s prompt_len=%d",
+        client.name,
+        client.model,
+        len(prompt),
+    )
+
+    def generate():
+        if debug_ai_messages:
+            reply, chunks = _debug_stream(client.name)
+            for chunk in chunks:
+                yield _sse("token", {"delta": chunk})
+            _save_history(thread_id, prompt, f"{client.model}-debug", reply)
+            yield _sse("done", {})
+            return
+
+        parts: list[str] = []
+        stats: dict[str, ReplyStats] = {}
+        try:
+            for delta in _cached_stream(client, prompt, history, stats):
+                parts.append(delta)
+                yield _sse("token", {"delta": delta})
+        except Exception as e:
+            current_app.logger.exception("%s stream failed", client.name)
+            yield _sse("error", _error_payload(e))
+            return
+
+        # History is written once, after the last token
+        _save_history(thread_id, prompt, client.name, "".join(parts), stats)
+        yield _sse("done", {})
+
+    return _sse_response(generate())
+
+
+def _pump_stream(name: str, client: LLMClient, prompt: str, history: list[tuple[str, str]],
+                 events: queue.Queue, cancelled: threading.Event, stats: dict[str, ReplyStats]) -> None:
+    """
+    Runs on the fan-out executor: copies one client's token stream onto the shared event queue.
+    """
+    parts: list[str] = []
+    try:
+        for delta in _cached_stream(client, prompt, history, stats):
+            if cancelled.is_set():
+                return
+            parts.append(delta)
+            events.put((name, "token", delta))
+    except Exception as e:
+        events.put((name, "error", e))
+        return
+    events.put((name, "done", "".join(parts)))
+
+
+def _stream_budget(names) -> float:
+    """
+    Seconds a fan-out stream waits for its models: the longest slot wait plus deadline among
+    them. Providers only check their deadline between chunks, so one stuck inside a read
+    would otherwise hold the response open.
+    """
+    policies = [resilience.guard(name).policy for name in names]
+    return max((policy.acquire_timeout + policy.deadline for policy in policies), default=0.0) + STREAM_GRACE_SECONDS
+
+
+def multi_llm_stream_endpoint() -> Response:
+    """
+    Server-Sent-Events variant of multi_llm_endpoint. Token events from every model are
+    interleaved as they arrive; each carries the model name. All replies are saved in one
+    transaction after the last model finishes. Models still running when the request's
+    deadline passes get an error event and are cancelled.
+    """
+    parsed, error = _parse_multi_request()
+    if error is not None:
+        return error
+    prompt, clients, unknown = parsed
+
+    current_thread = _get_or_create_thread(prompt)
+    thread_id = current_thread.id
+    histories = {name: _get_history_context(client) for name, client in clients.items()}
+    current_app.logger.info(
+        "multi stream endpoint called; models=%s prompt_len=%d",
+        ",".join(clients),
+        len(prompt),
+    )
+
+    def generate():
+        for name in unknown:
+            yield _sse("error", {"model": name, "error": _missing_message(name)})
+
+        if debug_ai_messages:
+            replies: list[tuple[str, str]] = []
+            for name, client in clients.items():
+                reply, chunks = _debug_stream(name)
+                for chunk in chunks:
+                    yield _sse("token", {"model": name, "delta": chunk})
+                replies.append((f"{client.model}-debug", reply))
+                yield _sse("done", {"model": name})
+            _save_history_batch(thread_id, prompt, replies)
+            return
+
+        events: queue.Queue = queue.Queue()
+        cancelled = threading.Event()
+        stats: dict[str, ReplyStats] = {}
+        futures = [
+            fanout_executor.submit(_pump_stream, name, client, prompt, histories[name], events, cancelled, stats)
+            for name, client in clients.items()
+        ]
+        replies = []
+        running = set(clients)
+        budget = _stream_budget(running)
+        deadline = time.monotonic() + budget
+        try:
+            while running:
+                try:
+                    name, kind, value = events.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if kind == "token":
+                    yield _sse("token", {"model": name, "delta": value})
+                elif kind == "done":
+                    running.discard(name)
+                    replies.append((name, value))
+                    yield _sse("done", {"model": name})
+                else:
+                    running.discard(name)
+                    current_app.logger.error("%s stream failed", name, exc_info=value)
+                    yield _sse("error", {"model": name, **_error_payload(value)})
+
+            # Deadline passed: the stragglers' partial replies aren't saved
+            cancelled.set()
+            for name in sorted(running):
+                current_app.logger.warning("%s stream still running after %.0fs; giving up", name, budget)
+                error = ProviderUnavailable(name, f"reply not finished within {budget:.0f}s")
+                yield _sse("error", {"model": name, **_error_payload(error)})
+        finally:
+            # Stop the remaining provider streams if the browser went away
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            # The replies have already been sent, so there's nothing to wait for
+            _save_history_batch(thread_id, prompt, replies, wait=False, stats=stats)
+
+    return _sse_response(generate())
+
+
+def _missing_message(name: str) -> str:
+    name = name.upper()
+    if name in extensions.unconfigured:
+        return f"{name} has no API key configured"
+    return "Unknown LLM"
+
+
+def _missing_client(name: str) -> tuple[Response, int]:
+    return jsonify({"error": _missing_message(name)}), 400
+
+
+def single(name: str) -> Response:
+    client = extensions.clients_by_name().get(name.upper())
+    if client is None:
+        return _missing_client(name)
+    return single_llm_endpoint(client)
+
+
+def stream(name: str) -> Response:
+    client = extensions.clients_by_name().get(name.upper())
+    if client is None:
+        return _missing_client(name)
+    return single_llm_stream_endpoint(client)
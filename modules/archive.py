@@ -0,0 +1,417 @@
+"""
+Cold storage, retention and space reclamation for chat history.
+
+Threads nobody has touched for a while are packed into one compressed segment each
+(archived_threads) and their turns and responses are deleted, so the hot tables, their
+indexes and SQLite's page cache only carry conversations people still use. Opening an
+archived thread puts its rows back first. Archived messages stay searchable; see
+modules/search_index.py.
+
+The same module deletes threads in bulk, for retention and for wiping a user's history, and
+hands freed pages back to the filesystem with incremental VACUUM. Archiver runs a pass
+periodically on a background thread; `flask archive-threads` runs one by hand.
+"""
+from __future__ import annotations
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable
+from datetime import datetime, timedelta
+
+from flask import Flask
+from sqlalchemy import Engine, delete, insert, text
+from sqlalchemy.orm import Session
+
+from modules import dbms, search_index, turn_migration
+from modules.dbms import (db, ArchivedMessage, ArchivedThread, ChatHistory, ChatResponse, ChatThread, ChatTurn,
+                          ThreadSummary)
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fork, so a single process always runs the passes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Threads deleted per transaction
+DELETE_BATCH = 200
+
+# Called with the ids of threads whose hot rows were removed, so in-process caches drop them
+_removed_listeners: list[Callable[[list[int]], None]] = []
+
+
+@dataclass
+class ArchivePolicy:
+    # Threads idle this long are archived; 0 turns archiving off
+    archive_after_days: float = 90.0
+    # Threads idle this long are deleted, archived or not; 0 keeps history forever
+    retention_days: float = 0.0
+    # Threads archived per transaction
+    batch_size: int = 50
+    # Free pages released per pass; 0 skips the incremental vacuum
+    vacuum_pages: int = 2000
+
+
+@dataclass
+class ArchiveStats:
+    passes: int = 0
+    threads_archived: int = 0
+    messages_archived: int = 0
+    threads_rehydrated: int = 0
+    threads_deleted: int = 0
+    pages_vacuumed: int = 0
+    last_pass_ms: float = 0.0
+    failures: int = 0
+
+
+def on_removed(listener: Callable[[list[int]], None]) -> None:
+    _removed_listeners.append(listener)
+
+
+def _removed(thread_ids: list[int]) -> None:
+    for listener in _removed_listeners:
+        listener(thread_ids)
+
+
+def _hot_rows(session: Session, thread_id: int):
+    return session.execute(
+        db.select(ChatResponse.id, ChatResponse.turn_id, ChatThread.user_id, ChatResponse.model_name,
+                  ChatTurn._user_input, ChatResponse._model_response.label("reply"), ChatTurn.date_saved,
+                  ChatResponse.latency_ms, ChatResponse.input_tokens, ChatResponse.output_tokens)
+        .join(ChatTurn, ChatTurn.id == ChatResponse.turn_id)
+        .join(ChatThread, ChatThread.id == ChatResponse.thread_id)
+        .where(ChatResponse.thread_id == thread_id)
+        .order_by(ChatResponse.id)
+    ).all()
+
+
+def archive_thread(session: Session, thread_id: int) -> int:
+    """
+    Moves a thread's history into a segment inside the caller's transaction. Returns the
+    number of messages archived.
+    """
+    # A thread can't normally be written while archived, but fold in any rows that raced in
+    rehydrate(session, thread_id)
+    turn_migration.convert_threads(session, [thread_id])
+    rows = _hot_rows(session, thread_id)
+    if not rows:
+        return 0
+    user_id = rows[0].user_id
+    prompt_of = dbms.PromptDecoder()
+    messages = [
+        (row.id, row.model_name, prompt_of(row), dbms.db_decode_text(row.reply), row.date_saved,
+         (row.latency_ms, row.input_tokens, row.output_tokens))
+        for row in rows
+    ]
+    session.add(ArchivedThread(
+        thread_id=thread_id, message_count=len(messages), archived_at=datetime.now(),
+        segment=dbms.encode_segment(messages),
+    ))  # type: ignore
+    session.flush()
+    message_ids = session.execute(
+        insert(ArchivedMessage).returning(ArchivedMessage.id, sort_by_parameter_order=True),
+        [{"thread_id": thread_id, "position": position} for position in range(len(messages))],
+    ).scalars().all()
+
+    search_index.remove_rows(session, (
+        (row_id, user_id, model_name, prompt, reply) for row_id, model_name, prompt, reply, _, _ in messages
+    ))
+    search_index.index_rows(session, (
+        (-message_id, user_id, model_name, prompt, reply)
+        for message_id, (_, model_name, prompt, reply, _, _) in zip(message_ids, messages)
+    ))
+    # Only the rows read above; anything written since stays hot
+    session.execute(delete(ChatResponse).where(ChatResponse.id.in_([row.id for row in rows])))
+    session.execute(delete(ChatTurn).where(
+        ChatTurn.id.in_({row.turn_id for row in rows}),
+        ~db.exists().where(ChatResponse.turn_id == ChatTurn.id),
+    ))
+    return len(messages)
+
+
+def rehydrate(session: Session, thread_id: int) -> int:
+    """
+    Puts an archived thread's turns and responses back inside the caller's transaction.
+    Returns the number of messages restored, 0 if the thread wasn't archived.
+    """
+    archived = session.get(ArchivedThread, thread_id)
+    if archived is None:
+        return 0
+    user_id = session.execute(db.select(ChatThread.user_id).filter_by(id=thread_id)).scalar_one()
+    messages = dbms.decode_segment(archived.segment)
+    search_index.remove_rows(session, search_index.archived_rows(session, [thread_id]))
+
+    turns = turn_migration.group_turns(messages, lambda message: (thread_id, message[2], message[1], message[4]))
+    turn_table = ChatTurn.__table__
+    turn_ids = session.execute(
+        insert(turn_table).returning(turn_table.c.id, sort_by_parameter_order=True),
+        [{"thread_id": thread_id, "user_input": dbms.db_encode_text(turn[0][2]), "date_saved": turn[0][4]}
+         for turn in turns],
+    ).scalars().all()
+    ordered = [message for turn in turns for message in turn]
+    params = [
+        {"id": row_id, "turn_id": turn_id, "thread_id": thread_id, "model_name": model_name,
+         "model_response": dbms.db_encode_text(reply), "latency_ms": latency_ms, "input_tokens": input_tokens,
+         "output_tokens": output_tokens}
+        for turn_id, turn in zip(turn_ids, turns)
+        for row_id, model_name, _, reply, _, (latency_ms, input_tokens, output_tokens) in turn
+    ]
+    table = ChatResponse.__table__
+    taken = session.execute(
+        db.select(db.func.count()).select_from(table).where(table.c.id.in_([row_id for row_id, *_ in messages]))
+    ).scalar_one()
+    if taken:
+        # The original ids were handed out again after newer rows were deleted. Renumber,
+        # and bump the summary so cached history pages with the old ids are revalidated.
+        for row in params:
+            del row["id"]
+        session.execute(
+            db.update(ThreadSummary).filter_by(thread_id=thread_id).values(last_activity=datetime.now())
+        )
+    ids = session.execute(
+        insert(table).returning(table.c.id, sort_by_parameter_order=True), params
+    ).scalars().all()
+    search_index.index_rows(session, (
+        (row_id, user_id, model_name, prompt, reply)
+        for row_id, (_, model_name, prompt, reply, _, _) in zip(ids, ordered)
+    ))
+
+    session.execute(delete(ArchivedMessage).where(ArchivedMessage.thread_id == thread_id))
+    session.delete(archived)
+    return len(messages)
+
+
+def is_archived(session: Session, thread_id: int) -> bool:
+    return session.execute(
+        db.select(ArchivedThread.thread_id).filter_by(thread_id=thread_id)
+    ).scalar_one_or_none() is not None
+
+
+def ensure_hot(session: Session, thread_id: int) -> bool:
+    """
+    Rehydrates and commits the thread if it is archived. Returns whether it was.
+    """
+    if not is_archived(session, thread_id):
+        return False
+    restored = rehydrate(session, thread_id)
+    session.commit()
+    logger.info("Rehydrated archived thread %d (%d messages)", thread_id, restored)
+    return True
+
+
+def delete_threads(session: Session, thread_ids: list[int]) -> int:
+    """
+    Deletes threads with all their history, hot or archived, and commits. Returns how many
+    threads were deleted.
+    """
+    deleted = 0
+    for start in range(0, len(thread_ids), DELETE_BATCH):
+        batch = thread_ids[start:start + DELETE_BATCH]
+        search_index.remove_threads(session, batch)
+        session.execute(delete(ChatResponse).where(ChatResponse.thread_id.in_(batch)))
+        session.execute(delete(ChatTurn).where(ChatTurn.thread_id.in_(batch)))
+        session.execute(delete(ChatHistory).where(ChatHistory.thread_id.in_(batch)))
+        session.execute(delete(ArchivedMessage).where(ArchivedMessage.thread_id.in_(batch)))
+        session.execute(delete(ArchivedThread).where(ArchivedThread.thread_id.in_(batch)))
+        session.execute(delete(ThreadSummary).where(ThreadSummary.thread_id.in_(batch)))
+        deleted += session.execute(delete(ChatThread).where(ChatThread.id.in_(batch))).rowcount
+        session.commit()
+        _removed(batch)
+    return deleted
+
+
+def delete_user_history(session: Session, user_id: int) -> int:
+    thread_ids = session.execute(db.select(ChatThread.id).filter_by(user_id=user_id)).scalars().all()
+    return delete_threads(session, list(thread_ids))
+
+
+def archive_inactive(session: Session, idle: timedelta, batch_size: int) -> tuple[int, int]:
+    """
+    Archives every thread idle for longer than `idle`, committing per batch. Returns
+    (threads, messages) archived.
+    """
+    last_id, upto = search_index.backfill_progress(session)
+    if last_id < upto:
+        # Archiving moves index entries, which needs the rows to be indexed already
+        logger.warning("Not archiving until `flask backfill-search` has finished")
+        return 0, 0
+    cutoff = datetime.now() - idle
+    threads = messages = 0
+    while True:
+        thread_ids = session.execute(
+            db.select(ThreadSummary.thread_id)
+            .outerjoin(ArchivedThread, ArchivedThread.thread_id == ThreadSummary.thread_id)
+            .where(ThreadSummary.last_activity < cutoff, ThreadSummary.message_count > 0,
+                   ArchivedThread.thread_id.is_(None))
+            .limit(batch_size)
+        ).scalars().all()
+        if not thread_ids:
+            return threads, messages
+        for thread_id in thread_ids:
+            messages += archive_thread(session, thread_id)
+        session.commit()
+        _removed(list(thread_ids))
+        threads += len(thread_ids)
+
+
+def apply_retention(session: Session, retention: timedelta) -> int:
+    """
+    Deletes every thread idle for longer than `retention`. Returns how many were deleted.
+    """
+    cutoff = datetime.now() - retention
+    deleted = 0
+    while True:
+        thread_ids = session.execute(
+            db.select(ThreadSummary.thread_id).where(ThreadSummary.last_activity < cutoff).limit(DELETE_BATCH)
+        ).scalars().all()
+        if not thread_ids:
+            return deleted
+        deleted += delete_threads(session, list(thread_ids))
+
+
+def incremental_vacuum(session: Session, pages: int) -> int:
+    """
+    Returns up to `pages` free pages to the filesystem. Returns how many were released; a
+    database that isn't in auto_vacuum=INCREMENTAL mode releases none (see full_vacuum).
+    """
+    if session.execute(text("PRAGMA auto_vacuum")).scalar_one() != 2:
+        return 0
+    before = session.execute(text("PRAGMA freelist_count")).scalar_one()
+    session.commit()
+    # sqlite3's execute() stops after the first step, which frees a single page;
+    # executescript() runs the pragma to completion
+    session.connection().connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    session.commit()
+    return before - session.execute(text("PRAGMA freelist_count")).scalar_one()
+
+
+def full_vacuum(engine: Engine) -> None:
+    """
+    Rebuilds the database file with auto_vacuum=INCREMENTAL, which an existing database only
+    picks up through a VACUUM. This rewrites the whole file and blocks writers while it runs.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+        conn.execute(text("VACUUM"))
+
+
+def run_pass(session: Session, policy: ArchivePolicy) -> ArchiveStats:
+    """
+    One round of retention, archiving and incremental vacuum.
+    """
+    stats = ArchiveStats()
+    started = time.monotonic()
+    if policy.retention_days > 0:
+        stats.threads_deleted += apply_retention(session, timedelta(days=policy.retention_days))
+    if policy.archive_after_days > 0:
+        threads, messages = archive_inactive(session, timedelta(days=policy.archive_after_days), policy.batch_size)
+        stats.threads_archived += threads
+        stats.messages_archived += messages
+    if policy.vacuum_pages > 0:
+        stats.pages_vacuumed += incremental_vacuum(session, policy.vacuum_pages)
+    stats.passes += 1
+    stats.last_pass_ms = (time.monotonic() - started) * 1000
+    return stats
+
+
+class Archiver:
+    """
+    Runs run_pass every `interval` seconds on a daemon thread. The first pass waits a full
+    interval so startup isn't slowed down.
+
+    Nothing starts until start() is called, which the app does on its first request: CLI
+    commands and a preloading master never run passes, and a forked worker doesn't inherit
+    the thread. Of the processes sharing lock_path only the one holding the lock on it runs
+    passes, so a multi-worker server archives from exactly one of them.
+    """
+    def __init__(self, flask_app: Flask, policy: ArchivePolicy, interval: float, lock_path: str | None = None):
+        self.app = flask_app
+        self.policy = policy
+        self.interval = interval
+        self.lock_path = lock_path
+        self.stats = ArchiveStats()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        # Process that last tried to start the thread, and the lock file it holds if it won
+        self._pid: int | None = None
+        self._lock_file = None
+
+    def start(self) -> bool:
+        """
+        Starts the thread in this process unless another process holds the lock. Cheap to
+        call on every request. Returns whether this process runs the passes.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._pid = pid
+                    self._thread, self._lock_file = None, None
+                    if not self._stop.is_set() and self._take_lock():
+                        self._thread = threading.Thread(target=self._run, name="archiver", daemon=True)
+                        self._thread.start()
+        return self._thread is not None
+
+    def _take_lock(self) -> bool:
+        if self.lock_path is None or fcntl is None:
+            return True
+        # A file of our own: the copy inherited from a parent would share the parent's lock
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    result = run_pass(db.session, self.policy)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Archive pass failed")
+                    with self._lock:
+                        self.stats.failures += 1
+                    continue
+            with self._lock:
+                stats = self.stats
+                stats.passes += 1
+                stats.threads_archived += result.threads_archived
+                stats.messages_archived += result.messages_archived
+                stats.threads_deleted += result.threads_deleted
+                stats.pages_vacuumed += result.pages_vacuumed
+                stats.last_pass_ms = result.last_pass_ms
+
+    def note_rehydrated(self) -> None:
+        with self._lock:
+            self.stats.threads_rehydrated += 1
+
+    def close(self) -> None:
+        self._stop.set()
+        with self._lock:
+            if self._pid == os.getpid() and self._lock_file is not None:
+                self._lock_file.close()
+            self._lock_file = None
+
+    def snapshot(self) -> dict[str, int | float]:
+        with self._lock:
+            stats = self.stats
+            return {
+                "archive_after_days": self.policy.archive_after_days,
+                "retention_days": self.policy.retention_days,
+                "interval_seconds": self.interval,
+                "passes": stats.passes,
+                "threads_archived": stats.threads_archived,
+                "messages_archived": stats.messages_archived,
+                "threads_rehydrated": stats.threads_rehydrated,
+                "threads_deleted": stats.threads_deleted,
+                "pages_vacuumed": stats.pages_vacuumed,
+                "last_pass_ms": stats.last_pass_ms,
+                "failures": stats.failures,
+            }
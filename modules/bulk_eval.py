@@ -0,0 +1,302 @@
+"""
+Runs a JSONL prompt suite through the configured LLM clients, outside of any request.
+
+Results are appended to a JSONL file as each call finishes, and that file is also the
+checkpoint: a later run skips every (prompt id, model) pair that already has a reply, so a
+crashed run resumes without paying for finished calls again. Failed calls are written too
+and are retried by the next run. The last row written for a pair wins.
+
+When replies are imported into a chat thread, each prompt becomes one turn: its replies are
+saved together once all of its calls in the run have finished, and a prompt that already
+has a turn from an earlier run gets the new replies added to that turn.
+"""
+from __future__ import annotations
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Iterable
+
+from modules import dbms, metrics, resilience
+from modules.history_writer import HistoryWriter, ReplyStats
+from modules.llm_client import LLMClient
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet export is optional; JSONL is always written
+    pyarrow = None
+
+# Column order of result rows, also used for the Parquet schema
+FIELDS = ("id", "model", "model_version", "prompt", "reply", "error", "seconds", "finished_at",
+          "thread_id", "history_id")
+
+
+@dataclass(frozen=True)
+class EvalItem:
+    id: str
+    prompt: str
+    # Restricts the item to these providers; None runs it against every configured one
+    models: tuple[str, ...] | None = None
+
+
+@dataclass
+class EvalStats:
+    succeeded: int = 0
+    failed: int = 0
+    skipped: int = 0
+    imported: int = 0
+    unconfigured: set[str] = field(default_factory=set)
+
+
+def load_items(path: str) -> list[EvalItem]:
+    """
+    Reads one prompt per line: {"id": ..., "prompt": ...}, optionally with "models". Backlog
+    style entries ({"request_id", "title", "body"}) are accepted too, with the title and body
+    joined into the prompt. Lines without an id are numbered by position.
+    """
+    items: list[EvalItem] = []
+    seen: set[str] = set()
+    with open(path, encoding="utf-8") as fin:
+        for number, line in enumerate(fin, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            item_id = str(entry.get("id") or entry.get("request_id") or f"line-{number}")
+            prompt = entry.get("prompt")
+            if prompt is None:
+                prompt = "\n\n".join(str(entry[key]) for key in ("title", "body") if entry.get(key))
+            if not prompt:
+                raise ValueError(f"{path}:{number}: no prompt")
+            if item_id in seen:
+                raise ValueError(f"{path}:{number}: duplicate id {item_id!r}")
+            seen.add(item_id)
+            models = entry.get("models")
+            items.append(EvalItem(item_id, prompt, tuple(name.upper() for name in models) if models else None))
+    return items
+
+
+def load_results(path: str) -> dict[tuple[str, str], dict[str, Any]]:
+    """
+    The latest row for each (id, model) in an existing results file. A line torn by a crash
+    mid-write is cut off so the next append starts on a clean line.
+    """
+    rows: dict[tuple[str, str], dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return rows
+    good_bytes = 0
+    with open(path, "rb") as fin:
+        for line in fin:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise ValueError(f"{path}: unreadable result at byte {good_bytes}") from None
+            good_bytes += len(line)
+            rows[row["id"], row["model"]] = row
+    if good_bytes != os.path.getsize(path):
+        with open(path, "r+b") as fout:
+            fout.truncate(good_bytes)
+    return rows
+
+
+class ResultWriter:
+    """
+    Appends result rows to a JSONL file. Every row is flushed to the OS as soon as it is
+    written, so a killed process loses nothing; fsync runs every sync_interval seconds to
+    bound what a power loss can take.
+    """
+    def __init__(self, path: str, sync_interval: float = 1.0):
+        self._file = open(path, "a", encoding="utf-8")
+        self.sync_interval = sync_interval
+        self._last_sync = time.monotonic()
+
+    def write(self, row: dict[str, Any]) -> None:
+        self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if time.monotonic() - self._last_sync >= self.sync_interval:
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
+
+    def close(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def _import_turn(history: HistoryWriter, thread_id: int, rows: list[dict[str, Any]],
+                 earlier: list[int]) -> None:
+    """
+    Saves one prompt's replies as a turn of the thread, or adds them to the turn of the
+    earlier imported responses if it is still there.
+    """
+    try:
+        stats = {row["model"]: ReplyStats(latency_ms=round(row["seconds"] * 1000))
+                 for row in rows if row.get("seconds") is not None}
+        ids = history.save(thread_id, rows[0]["prompt"], [(row["model"], row["reply"]) for row in rows],
+                           stats, dbms.turn_of(thread_id, earlier))
+        for row, history_id in zip(rows, ids):
+            row["history_id"] = history_id
+            row["thread_id"] = thread_id
+    except Exception as e:
+        # The replies are paid for; keep them and let a later run retry just the import
+        for row in rows:
+            row["error"] = f"import failed: {type(e).__name__}: {e}"
+
+
+def _evaluate(client: LLMClient, item: EvalItem) -> dict[str, Any]:
+    row: dict[str, Any] = dict.fromkeys(FIELDS)
+    row.update(id=item.id, model=client.name, model_version=client.model, prompt=item.prompt)
+    started = time.perf_counter()
+    try:
+        system_prompt = client.system_prompt()
+        with metrics.LLMCall(client.name):
+            row["reply"] = resilience.guard(client.name).call(
+                lambda: client.get_reply(system_prompt=system_prompt, user_prompt=item.prompt, history=[])
+            )
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["seconds"] = round(time.perf_counter() - started, 3)
+    row["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    return row
+
+
+def provider_limits(names: Iterable[str], requested: dict[str, int], default: int | None) -> dict[str, int]:
+    """
+    In-flight cap per provider: the requested one, else default, else the provider's guard
+    limit. Never above the guard limit, since extra calls would only be rejected as busy.
+    """
+    limits = {}
+    for name in names:
+        cap = resilience.guard(name).policy.max_concurrency
+        limits[name] = max(1, min(requested.get(name) or default or cap, cap))
+    return limits
+
+
+def run(
+    items: list[EvalItem],
+    clients: dict[str, LLMClient],
+    output: str,
+    concurrency: int = 16,
+    limits: dict[str, int] | None = None,
+    history: HistoryWriter | None = None,
+    thread_id: int | None = None,
+    on_result: Callable[[dict[str, Any]], None] | None = None,
+) -> EvalStats:
+    """
+    Evaluates every pending (item, provider) pair and appends the rows to output. With a
+    history writer and thread_id, replies are also saved to that chat thread, including
+    earlier replies that were checkpointed without being imported.
+
+    At most `concurrency` calls run at once, and at most limits[name] per provider. Work is
+    handed out round-robin across providers, and only when the provider has a free slot, so
+    a slow provider never ties up the shared workers.
+    """
+    stats = EvalStats()
+    previous = load_results(output)
+    limits = limits or provider_limits(clients, {}, None)
+    pending: dict[str, deque[EvalItem]] = {name: deque() for name in clients}
+    # Calls still to finish per item in this run, before its replies are imported
+    outstanding: Counter[str] = Counter()
+    for item in items:
+        for name in item.models or clients:
+            if name not in clients:
+                stats.unconfigured.add(name)
+            elif (previous.get((item.id, name)) or {}).get("reply") is not None:
+                stats.skipped += 1
+            else:
+                pending[name].append(item)
+                outstanding[item.id] += 1
+
+    importing = history is not None and thread_id is not None
+    # Replies of earlier runs, by item: imported ones (to find their turn) and ones still to import
+    imported: dict[str, list[int]] = {}
+    unimported: dict[str, list[dict[str, Any]]] = {}
+    for row in previous.values():
+        if row.get("reply") is None:
+            continue
+        if row.get("history_id") is not None:
+            imported.setdefault(row["id"], []).append(row["history_id"])
+        else:
+            unimported.setdefault(row["id"], []).append({**dict.fromkeys(FIELDS), **row, "error": None})
+    finished: dict[str, list[dict[str, Any]]] = {}
+
+    writer = ResultWriter(output)
+
+    def record(row: dict[str, Any]) -> None:
+        writer.write(row)
+        if row["reply"] is None:
+            stats.failed += 1
+        else:
+            stats.succeeded += 1
+        if on_result is not None:
+            on_result(row)
+
+    def import_item(item_id: str, rows: list[dict[str, Any]]) -> None:
+        assert history is not None and thread_id is not None
+        _import_turn(history, thread_id, rows, imported.get(item_id, []))
+        for row in rows:
+            # Rewritten with the ids; the last row written for a pair wins
+            writer.write(row)
+            if row["history_id"] is not None:
+                stats.imported += 1
+                imported.setdefault(item_id, []).append(row["history_id"])
+
+    try:
+        if importing:
+            # Items still being evaluated are imported together with their new replies
+            for item_id, rows in unimported.items():
+                if not outstanding[item_id]:
+                    import_item(item_id, rows)
+
+        in_flight: Counter[str] = Counter()
+        running: dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-eval") as pool:
+            while running or any(pending.values()):
+                submitted = True
+                while submitted and len(running) < concurrency:
+                    submitted = False
+                    for name, queue in pending.items():
+                        if queue and in_flight[name] < limits[name] and len(running) < concurrency:
+                            future = pool.submit(_evaluate, clients[name], queue.popleft())
+                            running[future] = name
+                            in_flight[name] += 1
+                            submitted = True
+                finished_calls, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished_calls:
+                    in_flight[running.pop(future)] -= 1
+                    row = future.result()
+                    record(row)
+                    if not importing:
+                        continue
+                    item_id = row["id"]
+                    if row["reply"] is not None:
+                        finished.setdefault(item_id, []).append(row)
+                    outstanding[item_id] -= 1
+                    if not outstanding[item_id]:
+                        rows = unimported.pop(item_id, []) + finished.pop(item_id, [])
+                        if rows:
+                            import_item(item_id, rows)
+    finally:
+        writer.close()
+    return stats
+
+
+def export_parquet(results_path: str, parquet_path: str) -> int:
+    """
+    Writes the latest row per (id, model) from a results file to Parquet. Returns the row count.
+    """
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    rows = [{name: row.get(name) for name in FIELDS} for row in load_results(results_path).values()]
+    schema = pyarrow.schema([
+        (name, pyarrow.float64() if name == "seconds" else
+         pyarrow.int64() if name in ("thread_id", "history_id") else pyarrow.string())
+        for name in FIELDS
+    ])
+    pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows, schema=schema), parquet_path)
+    return len(rows)
@@ -0,0 +1,378 @@
+from __future__ import annotations
+import os
+import subprocess
+import time
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, text
+
+from modules import (archive, bulk_eval, dbms, extensions, migrations, password_hashing, search_index, static_assets,
+                     text_codec, turn_migration)
+from modules.dbms import db, ChatHistory, ChatResponse, ChatThread, ChatTurn
+
+
+@click.command("recompress-history")
+@with_appcontext
+@click.option("--batch-size", default=500, show_default=True, help="Rows re-encoded per transaction.")
+@click.option("--pause", default=0.05, show_default=True,
+              help="Seconds to sleep between batches so live requests can take the write lock.")
+def recompress_history(batch_size: int, pause: float) -> None:
+    """Re-encode stored chat history with the configured text codec."""
+    target = text_codec.current_codec().name
+
+    def reencode(blob: bytes) -> bytes:
+        # zstd-dict blobs of an earlier dictionary move onto the current one
+        if text_codec.codec_of(blob) == "raw" or text_codec.is_current(blob):
+            return blob
+        return text_codec.encode(text_codec.decode(blob))
+
+    # Prompts live on turns and replies on responses; chat_history only until migrate-turns is done
+    tables = [
+        (ChatTurn.__table__, ("user_input",)),
+        (ChatResponse.__table__, ("model_response",)),
+        (ChatHistory.__table__, ("user_input", "model_response")),
+    ]
+    scanned, changed, before_bytes, after_bytes = 0, 0, 0, 0
+    for table, columns in tables:
+        update = (
+            table.update()
+            .where(table.c.id == bindparam("row_id"))
+            .values({column: bindparam(f"new_{column}") for column in columns})
+        )
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                db.select(table.c.id, *(table.c[column] for column in columns))
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+
+            updates = []
+            for row_id, *blobs in rows:
+                encoded = [reencode(blob) for blob in blobs]
+                before_bytes += sum(len(blob) for blob in blobs)
+                after_bytes += sum(len(blob) for blob in encoded)
+                if encoded != blobs:
+                    values = {f"new_{column}": blob for column, blob in zip(columns, encoded)}
+                    updates.append({"row_id": row_id, **values})
+
+            if updates:
+                db.session.execute(update, updates)
+            db.session.commit()
+
+            scanned += len(rows)
+            changed += len(updates)
+            last_id = rows[-1].id
+            click.echo(f"re-encoded {changed}/{scanned} rows (up to {table.name} id {last_id})")
+            time.sleep(pause)
+
+    click.echo(f"done: {changed} rows re-encoded with {target}; {before_bytes} -> {after_bytes} bytes")
+
+
+@click.command("train-zstd-dict")
+@with_appcontext
+@click.option("--dict-dir", default=None, type=click.Path(file_okay=False),
+              help="Directory of trained dictionaries. Default: HISTORY_ZSTD_DICT_DIR.")
+@click.option("--samples", default=5000, show_default=True, help="Most recent history rows to train on.")
+@click.option("--size", "dict_size", default=112640, show_default=True, help="Dictionary size in bytes.")
+def train_zstd_dict(dict_dir: str | None, samples: int, dict_size: int) -> None:
+    """Train a zstd dictionary on recent chat history and make it the one new writes use."""
+    dict_dir = dict_dir or text_codec.dictionary_dir()
+    if dict_dir is None:
+        raise click.ClickException("No dictionary directory configured; pass --dict-dir")
+    blobs = db.session.execute(
+        db.select(ChatResponse._model_response).order_by(ChatResponse.id.desc()).limit(samples)
+    ).scalars().all()
+    blobs += db.session.execute(
+        db.select(ChatTurn._user_input).order_by(ChatTurn.id.desc()).limit(samples)
+    ).scalars().all()
+    if len(blobs) < 2 * samples:
+        # Not migrated yet, or not much history since
+        table = ChatHistory.__table__
+        rows = db.session.execute(
+            db.select(table.c.user_input, table.c.model_response)
+            .order_by(table.c.id.desc())
+            .limit(samples)
+        ).all()
+        blobs += [blob for row in rows for blob in row]
+    corpus = [text_codec.decode(blob).encode("utf-8") for blob in blobs]
+    if len(corpus) < 10:
+        raise click.ClickException("Not enough chat history to train a dictionary")
+
+    dict_data = text_codec.train_dictionary(corpus, dict_size)
+    # Earlier dictionaries stay in the directory: rows and archive segments written with them need them
+    codec = text_codec.save_dictionary(dict_dir, dict_data)
+    text_codec.use(codec)
+    click.echo(f"wrote {len(dict_data)} byte dictionary {codec.dict_id} trained on {len(corpus)} samples to {dict_dir}; "
+               f"restart the app to write with it and run recompress-history to move existing rows onto it")
+
+
+@click.command("migrate-turns")
+@with_appcontext
+@click.option("--batch-size", default=50, show_default=True, help="Threads converted per transaction.")
+@click.option("--pause", default=0.05, show_default=True,
+              help="Seconds to sleep between batches so live requests can take the write lock.")
+def migrate_turns(batch_size: int, pause: float) -> None:
+    """Move chat_history rows into turns and responses while the app keeps running."""
+    threads, rows = 0, 0
+    while True:
+        converted, moved = turn_migration.convert_batch(db.session, batch_size)
+        if not converted:
+            break
+        threads += converted
+        rows += moved
+        click.echo(f"converted {threads} threads ({rows} rows); {turn_migration.remaining(db.session)} rows left")
+        time.sleep(pause)
+    click.echo(f"done: {rows} rows in {threads} threads moved to the turn schema")
+
+
+@click.command("archive-threads")
+@with_appcontext
+@click.option("--days", type=float, default=None,
+              help="Archive threads idle this many days. Default: ARCHIVE_AFTER_DAYS.")
+@click.option("--retention-days", type=float, default=None,
+              help="Delete threads idle this many days. Default: ARCHIVE_RETENTION_DAYS.")
+@click.option("--vacuum-pages", type=int, default=None,
+              help="Free pages to release afterwards. Default: ARCHIVE_VACUUM_PAGES.")
+def archive_threads(days: float | None, retention_days: float | None, vacuum_pages: int | None) -> None:
+    """Archive idle threads, apply retention and release free pages once."""
+    configured = extensions.archiver.policy if extensions.archiver is not None else archive.ArchivePolicy()
+    policy = archive.ArchivePolicy(
+        archive_after_days=configured.archive_after_days if days is None else days,
+        retention_days=configured.retention_days if retention_days is None else retention_days,
+        batch_size=configured.batch_size,
+        vacuum_pages=configured.vacuum_pages if vacuum_pages is None else vacuum_pages,
+    )
+    stats = archive.run_pass(db.session, policy)
+    click.echo(f"archived {stats.threads_archived} threads ({stats.messages_archived} messages), "
+               f"deleted {stats.threads_deleted} threads, released {stats.pages_vacuumed} pages "
+               f"in {stats.last_pass_ms / 1000:.1f}s")
+
+
+@click.command("delete-user-history")
+@with_appcontext
+@click.argument("email")
+@click.option("--yes", is_flag=True, help="Don't ask for confirmation.")
+def delete_user_history(email: str, yes: bool) -> None:
+    """Delete every thread of a user, archived ones included."""
+    user = db.session.execute(db.select(dbms.User).filter_by(email=email)).scalar_one_or_none()
+    if user is None:
+        raise click.ClickException(f"No user with email {email}")
+    if not yes:
+        click.confirm(f"Delete all chat history of {email}?", abort=True)
+    click.echo(f"deleted {archive.delete_user_history(db.session, user.id)} threads")
+
+
+@click.command("vacuum-db")
+@with_appcontext
+@click.option("--full", is_flag=True,
+              help="Rebuild the whole file and switch it to incremental auto-vacuum. Blocks writers while it runs.")
+@click.option("--pages", default=10000, show_default=True, help="Free pages to release without --full.")
+def vacuum_db(full: bool, pages: int) -> None:
+    """Return free database pages to the filesystem."""
+    mode = db.session.execute(text("PRAGMA auto_vacuum")).scalar_one()
+    if full:
+        archive.full_vacuum(db.engine)
+        click.echo("database rebuilt with auto_vacuum=INCREMENTAL")
+    elif mode != 2:
+        raise click.ClickException("This database isn't in incremental auto-vacuum mode; run once with --full")
+    else:
+        click.echo(f"released {archive.incremental_vacuum(db.session, pages)} pages")
+
+
+@click.command("purge-reply-cache")
+@with_appcontext
+def purge_reply_cache() -> None:
+    """Drop expired replies from the persistent reply cache."""
+    if extensions.reply_cache is None:
+        raise click.ClickException("The reply cache is disabled (REPLY_CACHE_SIZE=0)")
+    click.echo(f"purged {extensions.reply_cache.purge_expired()} expired replies")
+
+
+@click.command("build-assets")
+@with_appcontext
+@click.option("--esbuild", default=None, help="esbuild binary. Default: esbuild on PATH.")
+@click.option("--prune", is_flag=True, help="Delete files of earlier builds.")
+def build_assets(esbuild: str | None, prune: bool) -> None:
+    """Bundle, minify, fingerprint and precompress the static assets with esbuild."""
+    try:
+        built = static_assets.build(current_app.static_folder, esbuild, prune)
+    except static_assets.EsbuildMissing as e:
+        raise click.ClickException(str(e))
+    except subprocess.CalledProcessError as e:
+        raise click.ClickException(f"esbuild failed:\n{e.stderr}")
+    for asset in built:
+        brotli_size = "-" if asset.brotli_size is None else f"{asset.brotli_size:,}"
+        click.echo(f"{asset.path:<44} {asset.source_bytes:>8,} -> {asset.size:>8,} bytes, "
+                   f"gzip {asset.gzip_size:>7,}, br {brotli_size:>7}")
+    click.echo(f"wrote {static_assets.DIST_DIR}/{static_assets.MANIFEST}; restart the app to serve the new build")
+
+
+@click.command("backfill-search")
+@with_appcontext
+@click.option("--batch-size", default=1000, show_default=True, help="Rows indexed per transaction.")
+@click.option("--pause", default=0.05, show_default=True,
+              help="Seconds to sleep between batches so live requests can take the write lock.")
+def backfill_search(batch_size: int, pause: float) -> None:
+    """Add chat history written before the search index existed to it."""
+    total = 0
+    while True:
+        indexed, last_id, upto = search_index.backfill_batch(db.session, batch_size)
+        total += indexed
+        if last_id >= upto:
+            break
+        click.echo(f"indexed {total} rows (up to id {last_id} of {upto})")
+        time.sleep(pause)
+    click.echo(f"done: {total} rows indexed; search covers all chat history")
+
+
+@click.command("migrate-db")
+@click.option("--status", is_flag=True, help="Only list pending migrations.")
+@with_appcontext
+def migrate_db(status: bool) -> None:
+    """Apply pending schema migrations."""
+    todo = migrations.pending(db.engine)
+    if status or not todo:
+        for number, description in todo:
+            click.echo(f"pending {number}: {description}")
+        if not todo:
+            click.echo("database schema is up to date")
+        return
+    for number in migrations.migrate(db.engine):
+        click.echo(f"applied migration {number}")
+
+
+@click.command("calibrate-hashing")
+@click.option("--target-ms", default=250.0, show_default=True, help="Target time for one password hash.")
+@click.option("--max-memory", "max_memory_mib", default=256, show_default=True,
+              help="Upper bound for argon2 memory cost in MiB.")
+@click.option("--parallelism", default=4, show_default=True, help="argon2 lanes.")
+def calibrate_hashing(target_ms: float, max_memory_mib: int, parallelism: int) -> None:
+    """Pick argon2 parameters that take about --target-ms on this host."""
+    params, elapsed = password_hashing.calibrate(target_ms, max_memory_mib * 1024, parallelism)
+    click.echo(f"time_cost={params.time_cost} memory_cost={params.memory_cost} KiB "
+               f"parallelism={params.parallelism}: {elapsed:.0f} ms per hash")
+    click.echo("Set these in the environment; existing hashes are upgraded as users log in:")
+    click.echo(f"ARGON2_TIME_COST={params.time_cost}")
+    click.echo(f"ARGON2_MEMORY_COST={params.memory_cost}")
+    click.echo(f"ARGON2_PARALLELISM={params.parallelism}")
+
+
+def _parse_limits(values: tuple[str, ...]) -> dict[str, int]:
+    limits = {}
+    for value in values:
+        name, sep, limit = value.partition("=")
+        if not sep or not limit.isdigit():
+            raise click.BadParameter(f"expected NAME=N, got {value!r}", param_hint="--provider-concurrency")
+        limits[name.strip().upper()] = int(limit)
+    return limits
+
+
+def _import_thread(email: str, thread_name: str, previous: dict) -> int:
+    """
+    The thread an earlier run imported into, if it still exists, else a new one.
+    """
+    user = db.session.execute(db.select(dbms.User).filter_by(email=email)).scalar_one_or_none()
+    if user is None:
+        raise click.ClickException(f"No user with email {email}")
+    for thread_id in {row["thread_id"] for row in previous.values() if row.get("thread_id") is not None}:
+        thread = db.session.get(ChatThread, thread_id)
+        if thread is not None and thread.user_id == user.id:
+            # New replies may join turns of earlier runs, which must not be archived
+            extensions.ensure_hot_thread(thread.id)
+            return thread.id
+    return dbms.create_thread(user.id, thread_name[:100]).id
+
+
+@click.command("eval-prompts")
+@with_appcontext
+@click.argument("prompts", type=click.Path(exists=True, dir_okay=False))
+@click.option("--output", required=True, type=click.Path(dir_okay=False),
+              help="Results JSONL; also the checkpoint an interrupted run resumes from.")
+@click.option("--models", default="", help="Comma separated providers to run. Default: every configured one.")
+@click.option("--concurrency", default=16, show_default=True, help="Calls in flight across all providers.")
+@click.option("--per-provider", type=int, default=None,
+              help="Calls in flight per provider. Default: the provider's LLM concurrency limit.")
+@click.option("--provider-concurrency", "provider_concurrency", multiple=True, metavar="NAME=N",
+              help="Per-provider override of --per-provider; repeatable.")
+@click.option("--parquet", type=click.Path(dir_okay=False), default=None,
+              help="Also write the results to this Parquet file when the run ends (needs pyarrow).")
+@click.option("--import-user", default=None, metavar="EMAIL",
+              help="Save replies to a chat thread of this user.")
+@click.option("--thread-name", default=None, help="Name of the imported thread. Default: eval: <prompts file>.")
+def eval_prompts(prompts: str, output: str, models: str, concurrency: int, per_provider: int | None,
+                 provider_concurrency: tuple[str, ...], parquet: str | None, import_user: str | None,
+                 thread_name: str | None) -> None:
+    """Run every prompt in a JSONL file against the configured models."""
+    if parquet and bulk_eval.pyarrow is None:
+        raise click.ClickException("--parquet needs pyarrow (pip install pyarrow)")
+    try:
+        items = bulk_eval.load_items(prompts)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    clients = extensions.clients_by_name()
+    if models:
+        wanted = [name.strip().upper() for name in models.split(",") if name.strip()]
+        missing = [name for name in wanted if name not in clients]
+        if missing:
+            raise click.ClickException(f"Not configured: {', '.join(missing)}")
+        clients = {name: clients[name] for name in wanted}
+    if not clients:
+        raise click.ClickException("No LLM providers are configured; set their API keys (or *_BASE_URL for mocks)")
+    limits = bulk_eval.provider_limits(clients, _parse_limits(provider_concurrency), per_provider)
+
+    thread_id = None
+    if import_user:
+        previous = bulk_eval.load_results(output)
+        thread_id = _import_thread(import_user, thread_name or f"eval: {os.path.basename(prompts)}", previous)
+
+    started = time.monotonic()
+    finished = 0
+
+    def report(row: dict) -> None:
+        nonlocal finished
+        finished += 1
+        outcome = "ok" if row["error"] is None else row["error"][:120]
+        click.echo(f"{finished:>6} {row['model']:<10} {row['id']}: {outcome} ({row['seconds']}s)")
+
+    click.echo(f"{len(items)} prompts x {len(clients)} models; limits "
+               + ", ".join(f"{name}={limit}" for name, limit in limits.items()))
+    stats = bulk_eval.run(items, clients, output, concurrency, limits,
+                          extensions.history_writer if thread_id is not None else None, thread_id, report)
+
+    click.echo(f"done in {time.monotonic() - started:.1f}s: {stats.succeeded} replies, {stats.failed} failed, "
+               f"{stats.skipped} already done" + (f", {stats.imported} imported into thread {thread_id}"
+                                                  if thread_id is not None else ""))
+    if stats.unconfigured:
+        click.echo(f"skipped unconfigured models: {', '.join(sorted(stats.unconfigured))}")
+    for name, client in clients.items():
+        usage = client.usage_snapshot()
+        if not usage["calls"]:
+            continue
+        click.echo(f"{name}: {usage['input_tokens']} input tokens ({usage['cached_input_tokens']} cached), "
+                   f"{usage['output_tokens']} output tokens")
+    if parquet:
+        click.echo(f"wrote {bulk_eval.export_parquet(output, parquet)} rows to {parquet}")
+    if stats.failed:
+        raise click.ClickException(f"{stats.failed} calls failed; run the command again to retry them")
+
+
+def register_commands(app: Flask) -> None:
+    app.cli.add_command(archive_threads)
+    app.cli.add_command(backfill_search)
+    app.cli.add_command(build_assets)
+    app.cli.add_command(calibrate_hashing)
+    app.cli.add_command(delete_user_history)
+    app.cli.add_command(eval_prompts)
+    app.cli.add_command(migrate_db)
+    app.cli.add_command(migrate_turns)
+    app.cli.add_command(purge_reply_cache)
+    app.cli.add_command(recompress_history)
+    app.cli.add_command(train_zstd_dict)
+    app.cli.add_command(vacuum_db)
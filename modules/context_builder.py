@@ -0,0 +1,239 @@
+"""
+Builds the conversation history sent with each prompt.
+
+Each model only sees its own prior turns, newest first, until its token budget is spent.
+Turns that no longer fit are folded into a short rolling summary that is sent as the first
+turn instead. Decoded turns and their token counts are cached per thread, so a new prompt
+only fetches and decodes the responses saved since the last one. A prompt answered by several
+models is decoded once and its text shared between their turns. The cache lives in one
+process, so every lookup first checks the thread's owner and response ids against the
+database and starts over if another process deleted, archived or restored the thread.
+
+The window doesn't slide one turn per prompt: when it overflows it jumps forward far enough
+to leave headroom, so the summary and older turns stay byte-identical for the next several
+prompts and provider-side prompt caches keep hitting.
+"""
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from modules import dbms
+
+# Rough chars-per-token for English text; no provider tokenizer is installed here
+CHARS_PER_TOKEN = 4
+# Role markers and separators each message costs on top of its text
+MESSAGE_OVERHEAD_TOKENS = 4
+# Share of the budget the rolling summary may use
+SUMMARY_SHARE = 0.25
+# After the window slides, summary + kept turns fill at most this share of the budget
+WINDOW_REFILL = 0.6
+SUMMARY_PROMPT_CHARS = 80
+SUMMARY_REPLY_CHARS = 160
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+@dataclass(frozen=True)
+class Turn:
+    id: int
+    model_name: str
+    prompt: str
+    reply: str
+    tokens: int
+
+
+def _make_turn(row, prompt: str) -> Turn:
+    reply = dbms.db_decode_text(row._model_response)
+    return Turn(
+        id=row.id,
+        model_name=row.model_name,
+        prompt=prompt,
+        reply=reply,
+        tokens=estimate_tokens(prompt) + estimate_tokens(reply) + 2 * MESSAGE_OVERHEAD_TOKENS,
+    )
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+@dataclass
+class _Summary:
+    # Turns with id <= upto_id are covered
+    upto_id: int = 0
+    lines: list[str] = field(default_factory=list)
+    tokens: int = 0
+
+
+@dataclass
+class _ThreadTurns:
+    last_id: int = 0
+    # What the rows were loaded for; see TurnCache._is_stale
+    owner: int | None = None
+    first_id: int | None = None
+    by_model: dict[str, list[Turn]] = field(default_factory=dict)
+    summaries: dict[str, _Summary] = field(default_factory=dict)
+    # Id of the oldest turn still sent verbatim, per model
+    window_start: dict[str, int] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+@dataclass
+class TurnCacheStats:
+    hits: int = 0
+    loads: int = 0
+    rows_decoded: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+class TurnCache:
+    """
+    LRU of decoded turns per thread. On each lookup only rows newer than the last one seen
+    are fetched, through the (thread_id, id) index.
+    """
+    def __init__(self, max_threads: int = 1000, max_turns: int = 500):
+        self.max_threads = max_threads
+        # Turns kept per model and thread; older ones only live on in the summary
+        self.max_turns = max_turns
+        self.stats = TurnCacheStats()
+        self._threads: OrderedDict[int, _ThreadTurns] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, thread_id: int) -> tuple[_ThreadTurns, bool]:
+        with self._lock:
+            entry = self._threads.get(thread_id)
+            cached = entry is not None
+            if entry is None:
+                entry = _ThreadTurns()
+                self._threads[thread_id] = entry
+                while len(self._threads) > self.max_threads:
+                    self._threads.popitem(last=False)
+                    self.stats.evictions += 1
+            self._threads.move_to_end(thread_id)
+            if cached:
+                self.stats.hits += 1
+            else:
+                self.stats.loads += 1
+            return entry, cached
+
+    @staticmethod
+    def _is_stale(entry: _ThreadTurns, owner: int | None, first_id: int | None, last_id: int | None) -> bool:
+        # A thread id reused by a new thread, rows renumbered on rehydration or rows removed
+        return (
+            owner != entry.owner
+            or (entry.first_id is not None and first_id != entry.first_id)
+            or (last_id or 0) < entry.last_id
+        )
+
+    def _refresh(self, thread_id: int, entry: _ThreadTurns, cached: bool) -> None:
+        # Caller holds entry.lock
+        owner, first_id, last_id = dbms.history_bounds(thread_id)
+        if cached and self._is_stale(entry, owner, first_id, last_id):
+            entry.last_id = 0
+            entry.by_model.clear()
+            entry.summaries.clear()
+            entry.window_start.clear()
+            cached = False
+            with self._lock:
+                self.stats.invalidations += 1
+        entry.owner, entry.first_id = owner, first_id
+        if cached:
+            rows = dbms.get_history_after(thread_id, entry.last_id)
+        else:
+            # Cold start: only the most recent rows can matter for any budget
+            rows = list(reversed(dbms.get_history_page(thread_id, None, self.max_turns)))
+        prompt_of = dbms.PromptDecoder()
+        for row in rows:
+            turn = _make_turn(row, prompt_of(row))
+            turns = entry.by_model.setdefault(turn.model_name, [])
+            turns.append(turn)
+            if len(turns) > self.max_turns:
+                del turns[0]
+            entry.last_id = max(entry.last_id, turn.id)
+        with self._lock:
+            self.stats.rows_decoded += len(rows)
+
+    def build(self, thread_id: int, model_name: str, budget: int) -> list[tuple[str, str]]:
+        """
+        (prompt, reply) pairs for model_name, oldest first, within budget tokens. When older
+        turns had to be left out, the first pair carries a summary of them.
+        """
+        entry, cached = self._entry(thread_id)
+        with entry.lock:
+            self._refresh(thread_id, entry, cached)
+            turns = entry.by_model.get(model_name, [])
+            start = entry.window_start.get(model_name, 0)
+            kept = [turn for turn in turns if turn.id >= start]
+            summary = entry.summaries.get(model_name)
+
+            used = sum(turn.tokens for turn in kept) + (summary.tokens if summary else 0)
+            if used > budget:
+                summary_budget = int(budget * SUMMARY_SHARE)
+                room = int(budget * WINDOW_REFILL) - summary_budget
+                selected: list[Turn] = []
+                for turn in reversed(kept):
+                    if room - turn.tokens < 0:
+                        break
+                    selected.append(turn)
+                    room -= turn.tokens
+                selected.reverse()
+                dropped = kept[:len(kept) - len(selected)]
+                summary = self._roll_summary(entry, model_name, dropped, summary_budget)
+                kept = selected
+                entry.window_start[model_name] = kept[0].id if kept else dropped[-1].id + 1
+
+            history = [(turn.prompt, turn.reply) for turn in kept]
+            if summary is None or not summary.lines:
+                return history
+            return [(
+                "Summary of our earlier conversation:\n" + "\n".join(summary.lines),
+                "Understood, I'll keep that context in mind.",
+            )] + history
+
+    def _roll_summary(self, entry: _ThreadTurns, model_name: str, dropped: list[Turn],
+                      budget: int) -> _Summary:
+        """
+        Extends the cached summary with turns that have fallen out of the window since it
+        was last built, then trims its oldest lines to fit.
+        """
+        summary = entry.summaries.setdefault(model_name, _Summary())
+        for turn in dropped:
+            if turn.id <= summary.upto_id:
+                continue
+            summary.lines.append(
+                f"- User: {_clip(turn.prompt, SUMMARY_PROMPT_CHARS)} / "
+                f"You: {_clip(turn.reply, SUMMARY_REPLY_CHARS)}"
+            )
+            summary.upto_id = turn.id
+
+        def cost() -> int:
+            if not summary.lines:
+                return 0
+            return estimate_tokens("\n".join(summary.lines)) + 2 * MESSAGE_OVERHEAD_TOKENS + 16
+
+        summary.tokens = cost()
+        while summary.lines and summary.tokens > budget:
+            summary.lines.pop(0)
+            summary.tokens = cost()
+        return summary
+
+    def forget(self, thread_id: int) -> None:
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "threads": len(self._threads),
+                "max_threads": self.max_threads,
+                "hits": self.stats.hits,
+                "loads": self.stats.loads,
+                "rows_decoded": self.stats.rows_decoded,
+                "evictions": self.stats.evictions,
+                "invalidations": self.stats.invalidations,
+            }
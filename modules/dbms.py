@@ -1,11 +1,14 @@
 from __future__ import annotations
+import json
+from sqlalchemy import and_, func, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Mapped, mapped_column
 from flask_login import UserMixin
 import modules.extensions as extensions
 from datetime import datetime
-import base64
-import lzma
 from flask_sqlalchemy import SQLAlchemy
+from modules import text_codec
+from modules.password_hashing import HashingBusy
 
 
 db = SQLAlchemy()
@@ -13,22 +16,16 @@ db = SQLAlchemy()
 
 def db_encode_text(input: str) -> bytes:
     """
-    Encodes text to store as binary in the database. Text over 25 bytes in size will be compressed using LZMA.
+    Encodes text to store as binary in the database. The first byte tags the codec used
+    (see modules/text_codec.py); short or incompressible text is stored raw.
     """
-    input_bytes = input.encode("utf-8")
-    if len(input_bytes) > 25:
-        return lzma.compress(input_bytes)
-    else:
-        return input_bytes
+    return text_codec.encode(input)
 
 def db_decode_text(input: bytes) -> str:
     """
-    Decodes text stored in the database
+    Decodes text stored in the database, including blobs written before codec tags existed
     """
-    if len(input) > 25:
-        return lzma.decompress(input).decode("utf-8")
-    else:
-        return input.decode("utf-8")
+    return text_codec.decode(input)
 
 
 class User(UserMixin, db.Model):
@@ -40,6 +37,11 @@ class User(UserMixin, db.Model):
 
     threads: Mapped[list['ChatThread']] = db.relationship(back_populates='user')  # type: ignore
 
+    # Index names match modules/migrations.py, which adds them to older databases
+    __table_args__ = (
+        db.Index('ux_users_email', 'email', unique=True),
+    )
+
     @property
     def password(self):
         raise AttributeError("password is write-only")
@@ -51,9 +53,20 @@ class User(UserMixin, db.Model):
         self.pwd_hash = extensions.pwd_hasher.hash(pwd)
 
     def verify_password(self, pwd: str) -> bool:
+        """
+        Checks the password, upgrading the stored hash if it was made with outdated argon2
+        parameters. The caller commits the session.
+        """
         if extensions.pwd_hasher is None:
             raise RuntimeError("Password hasher not initialized. Call init_extensions(...) before using models.")
-        return extensions.pwd_hasher.check(pwd, self.pwd_hash)
+        ok, needs_rehash = extensions.pwd_hasher.verify(pwd, self.pwd_hash)
+        if ok and needs_rehash:
+            try:
+                self.pwd_hash = extensions.pwd_hasher.hash(pwd)
+                extensions.pwd_hasher.note_rehash()
+            except (HashingBusy, TimeoutError):
+                pass  # Keep the old hash; we'll upgrade it on a quieter login
+        return ok
 
 
 class ChatThread(db.Model):
@@ -61,21 +74,33 @@ class ChatThread(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(db.ForeignKey('users.id'), nullable=False)
     thread_name: Mapped[str] = mapped_column(db.String(100), nullable=False)
-    date_created: Mapped[datetime] = mapped_column(default=datetime.now(), nullable=False)
+    date_created: Mapped[datetime] = mapped_column(default=datetime.now, nullable=False)
 
     user: Mapped[User] = db.relationship(back_populates='threads')  # type: ignore
-    messages: Mapped[list['ChatHistory']] = db.relationship(
+    turns: Mapped[list['ChatTurn']] = db.relationship(
+        back_populates='thread',
+        cascade="all, delete-orphan",
+        order_by='ChatTurn.id'
+    )  # type: ignore
+    summary: Mapped['ThreadSummary'] = db.relationship(
         back_populates='thread',
         cascade="all, delete-orphan",
-        order_by='ChatHistory.id'
+        uselist=False,
     )  # type: ignore
 
+    __table_args__ = (
+        db.Index('ix_chat_threads_user_id_date_created', 'user_id', 'date_created'),
+    )
 
-class ChatHistory(db.Model):
-    __tablename__ = 'chat_history'
+
+class ChatTurn(db.Model):
+    """
+    One prompt sent to a thread. The prompt is stored once however many models answered it.
+    """
+    __tablename__ = 'chat_turns'
     id: Mapped[int] = mapped_column(primary_key=True)
     thread_id: Mapped[int] = mapped_column(db.ForeignKey('chat_threads.id'), nullable=False)
-    
+
     # User prompt
     _user_input: Mapped[bytes] = mapped_column("user_input", db.BLOB, nullable=False)
     @property
@@ -83,24 +108,376 @@ class ChatHistory(db.Model):
     @user_input.setter
     def user_input(self, value: str): self._user_input = db_encode_text(value)
 
+    # Date the replies were saved
+    date_saved: Mapped[datetime] = mapped_column(default=datetime.now, nullable=False)
+
+    thread: Mapped[ChatThread] = db.relationship(back_populates='turns')  # type: ignore
+    responses: Mapped[list['ChatResponse']] = db.relationship(
+        back_populates='turn',
+        cascade="all, delete-orphan",
+        order_by='ChatResponse.id'
+    )  # type: ignore
+
+    __table_args__ = (
+        db.Index('ix_chat_turns_thread_id_id', 'thread_id', 'id'),
+    )
+
+
+class ChatResponse(db.Model):
+    """
+    One model's reply to a turn. Its id is the message id the API, the search index and
+    archived segments refer to, so ids are never reused (AUTOINCREMENT). thread_id repeats
+    the turn's so a thread's history pages straight off the (thread_id, id) index.
+    """
+    __tablename__ = 'chat_responses'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    turn_id: Mapped[int] = mapped_column(db.ForeignKey('chat_turns.id'), nullable=False)
+    thread_id: Mapped[int] = mapped_column(db.ForeignKey('chat_threads.id'), nullable=False)
+
     # Model name
     model_name: Mapped[str] = mapped_column(db.String(100), nullable=False)
-    
-    # Model response 
+
+    # Model response
     _model_response: Mapped[bytes] = mapped_column("model_response", db.BLOB, nullable=False)
-    @property 
+    @property
     def model_response(self): return db_decode_text(self._model_response)
     @model_response.setter
     def model_response(self, value: str): self._model_response = db_encode_text(value)
-    
-    # Date of response
-    date_saved: Mapped[datetime] = mapped_column(default=datetime.now(), nullable=False)
 
-    # Associated thread
-    thread: Mapped[ChatThread] = db.relationship(back_populates='messages')  # type: ignore
+    # Wall time of the provider call and the tokens it reported; NULL when unknown
+    latency_ms: Mapped[int | None] = mapped_column(nullable=True)
+    input_tokens: Mapped[int | None] = mapped_column(nullable=True)
+    output_tokens: Mapped[int | None] = mapped_column(nullable=True)
+
+    turn: Mapped[ChatTurn] = db.relationship(back_populates='responses')  # type: ignore
+
+    # Index names match modules/migrations.py, which creates these tables in older databases
+    __table_args__ = (
+        db.Index('ix_chat_responses_thread_id_id', 'thread_id', 'id'),
+        db.Index('ix_chat_responses_turn_id', 'turn_id'),
+        {'sqlite_autoincrement': True},
+    )
 
 
-def get_history_entries(thread_id):
-    history_entries = ChatHistory.query.filter_by(thread_id=thread_id).order_by(ChatHistory.id.desc()).limit(2).all()
-    history_entries.reverse()
-    return history_entries
\ No newline at end of file
+class ChatHistory(db.Model):
+    """
+    The schema before turns: one row per reply, each with its own copy of the prompt. Rows
+    are moved into chat_turns/chat_responses under their own ids (see modules/turn_migration.py),
+    so the table only has rows in databases that haven't finished that migration.
+    """
+    __tablename__ = 'chat_history'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    thread_id: Mapped[int] = mapped_column(db.ForeignKey('chat_threads.id'), nullable=False)
+    _user_input: Mapped[bytes] = mapped_column("user_input", db.BLOB, nullable=False)
+    model_name: Mapped[str] = mapped_column(db.String(100), nullable=False)
+    _model_response: Mapped[bytes] = mapped_column("model_response", db.BLOB, nullable=False)
+    date_saved: Mapped[datetime] = mapped_column(default=datetime.now, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_chat_history_thread_id_id', 'thread_id', 'id'),
+    )
+
+
+class ThreadSummary(db.Model):
+    """
+    Denormalized per-thread sidebar data, maintained on every history write so the sidebar
+    never has to scan the history tables. message_count counts responses.
+    """
+    __tablename__ = 'chat_thread_summaries'
+    thread_id: Mapped[int] = mapped_column(db.ForeignKey('chat_threads.id'), primary_key=True)
+    user_id: Mapped[int] = mapped_column(db.ForeignKey('users.id'), nullable=False)
+
+    # Sorted, comma separated model names that have replied in this thread
+    model_names: Mapped[str] = mapped_column(db.String(400), nullable=False, default='')
+    message_count: Mapped[int] = mapped_column(nullable=False, default=0)
+    last_activity: Mapped[datetime] = mapped_column(default=datetime.now, nullable=False)
+
+    thread: Mapped[ChatThread] = db.relationship(back_populates='summary')  # type: ignore
+
+    __table_args__ = (
+        db.Index('ix_thread_summary_user_activity', 'user_id', 'last_activity', 'thread_id'),
+    )
+
+    @property
+    def models(self) -> list[str]:
+        return [name for name in self.model_names.split(",") if name]
+
+    @property
+    def display_models(self) -> str:
+        return ", ".join(self.models)
+
+
+class ArchivedThread(db.Model):
+    """
+    A cold thread's whole history packed into one compressed segment (see modules/archive.py).
+    Its turns and responses are removed while it is archived.
+    """
+    __tablename__ = 'archived_threads'
+    thread_id: Mapped[int] = mapped_column(db.ForeignKey('chat_threads.id'), primary_key=True)
+    message_count: Mapped[int] = mapped_column(nullable=False)
+    archived_at: Mapped[datetime] = mapped_column(default=datetime.now, nullable=False)
+    segment: Mapped[bytes] = mapped_column(db.BLOB, nullable=False)
+
+
+class ArchivedMessage(db.Model):
+    """
+    One message inside an archived segment. The search index refers to it by -id, so ids
+    are never reused (AUTOINCREMENT) and can't collide with response ids.
+    """
+    __tablename__ = 'archived_messages'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    thread_id: Mapped[int] = mapped_column(db.ForeignKey('archived_threads.thread_id'), nullable=False)
+    # Index into the segment's message list
+    position: Mapped[int] = mapped_column(nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_archived_messages_thread_id', 'thread_id'),
+        {'sqlite_autoincrement': True},
+    )
+
+
+# Latency in ms, input tokens and output tokens of a response; each may be unknown
+ResponseStats = tuple[int | None, int | None, int | None]
+NO_STATS: ResponseStats = (None, None, None)
+
+# (response id, model name, prompt, reply, date saved, stats)
+SegmentMessage = tuple[int, str, str, str, datetime, ResponseStats]
+
+
+def encode_segment(messages: list[SegmentMessage]) -> bytes:
+    """
+    Packs a thread's messages, oldest first, into one blob. Compressing them together
+    shares the dictionary across messages, so a segment is much smaller than its rows were.
+    """
+    return text_codec.encode(json.dumps(
+        [
+            [row_id, model_name, prompt, reply, saved.isoformat(), *(stats if stats != NO_STATS else ())]
+            for row_id, model_name, prompt, reply, saved, stats in messages
+        ],
+        ensure_ascii=False,
+    ))
+
+
+def decode_segment(segment: bytes) -> list[SegmentMessage]:
+    # Segments written before responses had stats carry five fields
+    return [
+        (row_id, model_name, prompt, reply, datetime.fromisoformat(saved), tuple(stats) if stats else NO_STATS)
+        for row_id, model_name, prompt, reply, saved, *stats in json.loads(text_codec.decode(segment))
+    ]
+
+
+def create_thread(user_id: int, thread_name: str) -> ChatThread:
+    """
+    Creates and commits a thread together with its (empty) summary row.
+    """
+    now = datetime.now()
+    thread = ChatThread(user_id=user_id, thread_name=thread_name, date_created=now)  # type: ignore
+    thread.summary = ThreadSummary(user_id=user_id, model_names="", message_count=0, last_activity=now)  # type: ignore
+    db.session.add(thread)
+    db.session.commit()
+    return thread
+
+
+def record_thread_activity(thread_id: int, model_names: list[str], when: datetime | None = None) -> None:
+    """
+    Folds newly saved replies into the thread summary. Runs inside the caller's transaction,
+    so it must be called before the commit that saves the history rows.
+    """
+    when = when or datetime.now()
+    user_id = db.session.execute(
+        db.select(ChatThread.user_id).filter_by(id=thread_id)
+    ).scalar_one()
+
+    # Counter upsert first: it takes SQLite's write lock, so the read-merge-write of the
+    # model set below can't interleave with another writer
+    upsert = sqlite_insert(ThreadSummary).values(
+        thread_id=thread_id,
+        user_id=user_id,
+        model_names="",
+        message_count=len(model_names),
+        last_activity=when,
+    )
+    db.session.execute(upsert.on_conflict_do_update(
+        index_elements=[ThreadSummary.thread_id],
+        set_={
+            "message_count": ThreadSummary.message_count + upsert.excluded.message_count,
+            "last_activity": upsert.excluded.last_activity,
+        },
+    ))
+
+    current = db.session.execute(
+        db.select(ThreadSummary.model_names).filter_by(thread_id=thread_id)
+    ).scalar_one()
+    merged = ",".join(sorted(set(filter(None, current.split(","))) | set(model_names)))
+    if merged != current:
+        db.session.execute(
+            db.update(ThreadSummary).filter_by(thread_id=thread_id).values(model_names=merged)
+        )
+
+
+def backfill_thread_summaries(batch_size: int = 500) -> int:
+    """
+    Builds summaries for threads created before summaries existed. Returns how many were added.
+    """
+    added = 0
+    while True:
+        missing = db.session.execute(
+            db.select(ChatThread.id, ChatThread.user_id, ChatThread.date_created)
+            .outerjoin(ThreadSummary, ThreadSummary.thread_id == ChatThread.id)
+            .where(ThreadSummary.thread_id.is_(None))
+            .limit(batch_size)
+        ).all()
+        if not missing:
+            return added
+
+        thread_ids = [row.id for row in missing]
+        stats = db.session.execute(
+            db.select(
+                ChatResponse.thread_id,
+                ChatResponse.model_name,
+                func.count(),
+                func.max(ChatTurn.date_saved),
+            )
+            .join(ChatTurn, ChatTurn.id == ChatResponse.turn_id)
+            .where(ChatResponse.thread_id.in_(thread_ids))
+            .group_by(ChatResponse.thread_id, ChatResponse.model_name)
+        ).all()
+        # These threads predate summaries, so their rows are likely still in the old table
+        stats += db.session.execute(
+            db.select(
+                ChatHistory.thread_id,
+                ChatHistory.model_name,
+                func.count(),
+                func.max(ChatHistory.date_saved),
+            )
+            .where(ChatHistory.thread_id.in_(thread_ids))
+            .group_by(ChatHistory.thread_id, ChatHistory.model_name)
+        ).all()
+        per_thread: dict[int, tuple[set[str], int, datetime | None]] = {}
+        for thread_id, model_name, count, last_saved in stats:
+            models, total, latest = per_thread.get(thread_id, (set(), 0, None))
+            models.add(model_name)
+            latest = last_saved if latest is None or (last_saved and last_saved > latest) else latest
+            per_thread[thread_id] = (models, total + count, latest)
+
+        for row in missing:
+            models, total, latest = per_thread.get(row.id, (set(), 0, None))
+            db.session.add(ThreadSummary(
+                thread_id=row.id,
+                user_id=row.user_id,
+                model_names=",".join(sorted(models)),
+                message_count=total,
+                last_activity=latest or row.date_created,
+            ))  # type: ignore
+        db.session.commit()
+        added += len(missing)
+
+
+def list_thread_page(user_id: int, before: tuple[datetime, int] | None, limit: int):
+    """
+    One keyset-paginated page of a user's threads, most recently active first.
+    `before` is the (last_activity, thread_id) of the last row of the previous page.
+    """
+    query = (
+        db.select(
+            ChatThread.id,
+            ChatThread.thread_name,
+            ChatThread.date_created,
+            ThreadSummary.model_names,
+            ThreadSummary.message_count,
+            ThreadSummary.last_activity,
+        )
+        .join(ChatThread, ChatThread.id == ThreadSummary.thread_id)
+        .where(ThreadSummary.user_id == user_id)
+        .order_by(ThreadSummary.last_activity.desc(), ThreadSummary.thread_id.desc())
+        .limit(limit)
+    )
+    if before is not None:
+        last_activity, thread_id = before
+        query = query.where(or_(
+            ThreadSummary.last_activity < last_activity,
+            and_(ThreadSummary.last_activity == last_activity, ThreadSummary.thread_id < thread_id),
+        ))
+    return db.session.execute(query).all()
+
+
+def _history_select():
+    # Responses of one turn share the prompt blob; callers decode it once per turn_id
+    return (
+        db.select(
+            ChatResponse.id,
+            ChatResponse.turn_id,
+            ChatTurn._user_input,
+            ChatResponse.model_name,
+            ChatResponse._model_response,
+            ChatTurn.date_saved,
+        )
+        .join(ChatTurn, ChatTurn.id == ChatResponse.turn_id)
+    )
+
+
+def get_history_page(thread_id: int, before_id: int | None, limit: int):
+    """
+    Column-only query for one page of a thread's responses, newest first. Rows carry the
+    still-compressed text so callers decode only what they actually send.
+    """
+    query = (
+        _history_select()
+        .where(ChatResponse.thread_id == thread_id)
+        .order_by(ChatResponse.id.desc())
+        .limit(limit)
+    )
+    if before_id is not None:
+        query = query.where(ChatResponse.id < before_id)
+    return db.session.execute(query).all()
+
+
+def get_history_after(thread_id: int, after_id: int, limit: int = 1000):
+    """
+    Responses of a thread saved after `after_id`, oldest first, with the text still encoded.
+    """
+    return db.session.execute(
+        _history_select()
+        .where(ChatResponse.thread_id == thread_id, ChatResponse.id > after_id)
+        .order_by(ChatResponse.id)
+        .limit(limit)
+    ).all()
+
+
+def history_bounds(thread_id: int) -> tuple[int | None, int | None, int | None]:
+    """
+    (owner, first response id, last response id) of a thread, with None for what doesn't exist.
+    """
+    responses = db.select(ChatResponse.id).where(ChatResponse.thread_id == thread_id)
+    return db.session.execute(db.select(
+        db.select(ChatThread.user_id).where(ChatThread.id == thread_id).scalar_subquery(),
+        responses.order_by(ChatResponse.id).limit(1).scalar_subquery(),
+        responses.order_by(ChatResponse.id.desc()).limit(1).scalar_subquery(),
+    )).one().tuple()
+
+
+def turn_of(thread_id: int, response_ids: list[int]) -> int | None:
+    """
+    The turn of the first of these responses that is still in the thread's hot tables.
+    """
+    if not response_ids:
+        return None
+    return db.session.execute(
+        db.select(ChatResponse.turn_id)
+        .where(ChatResponse.thread_id == thread_id, ChatResponse.id.in_(response_ids))
+        .limit(1)
+    ).scalar_one_or_none()
+
+
+class PromptDecoder:
+    """
+    Decodes the prompt of each history row, once per turn.
+    """
+    def __init__(self) -> None:
+        self._prompts: dict[int, str] = {}
+
+    def __call__(self, row) -> str:
+        prompt = self._prompts.get(row.turn_id)
+        if prompt is None:
+            prompt = self._prompts[row.turn_id] = db_decode_text(row._user_input)
+        return prompt
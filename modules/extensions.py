@@ -1,87 +1,240 @@
 from __future__ import annotations
+import dataclasses
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
-from hashing_examples import UpdatedHasher
-from modules import dbms
-from modules.llm_client import (
-    GPTClient,
-    GeminiClient,
-    GrokClient,
-    ClaudeClient,
-    DeepseekClient,
-    MistralClient,
-    TogetherLlamaClient,
-    TogetherQwenClient,
-)
+from modules import archive, dbms, metrics, migrations, resilience, text_codec, transport, turn_migration
+from modules.archive import Archiver, ArchivePolicy
+from modules.password_hashing import Argon2Params, PasswordHashingService
+from modules.context_builder import TurnCache
+from modules.history_writer import HistoryWriter
+from modules.reply_cache import ReplyCache
+from modules.user_cache import UserCache
+from modules.llm_client import LLMClient
+from modules.providers import ProviderConfig, create_client
 
 db = dbms.db
 
-gpt_client: GPTClient | None = None
-gemini_client: GeminiClient | None = None
-grok_client: GrokClient | None = None
-claude_client: ClaudeClient | None = None
-deepseek_client: DeepseekClient | None = None
-mistral_client: MistralClient | None = None
-pwd_hasher: UpdatedHasher | None = None
-llama_client: TogetherLlamaClient | None = None
-qwen_client: TogetherQwenClient | None = None
+# Configured providers by name; providers without an API key are left out
+clients: dict[str, LLMClient] = {}
+# Known providers that were skipped for lack of an API key
+unconfigured: set[str] = set()
+pwd_hasher: PasswordHashingService | None = None
+reply_cache: ReplyCache | None = None
+user_cache: UserCache | None = None
+history_writer: HistoryWriter | None = None
+turn_cache: TurnCache | None = None
+context_budget: int = 1500
+context_budgets: dict[str, int] = {}
+archiver: Archiver | None = None
 
 def init_extensions(
-    claude_model: str | None,
-    claude_key: str | None,
-    claude_max_tokens: int,
-    claude_temperature: float,
-
-    deepseek_model: str | None,
-    deepseek_key: str | None,
-    deepseek_max_tokens: int,
-    deepseek_temperature: float,
-
-    gemini_model: str | None,
-    gemini_key: str | None,
-    gemini_max_tokens: int,
-    gemini_temperature: float,
-
-    openai_model: str | None,
-    openai_key: str | None,
-    openai_max_tokens: int,
-    openai_temperature: float,
-
-    grok_model: str | None,
-    grok_key: str | None,
-    grok_max_tokens: int,
-    grok_temperature: float,
-
-    mistral_model: str | None,
-    mistral_key: str | None,
-    mistral_max_tokens: int,
-    mistral_temperature: float,
-
-    llama_model: str | None,
-    llama_key: str | None,
-    llama_max_tokens: int,
-    llama_temperature: float,
-
-    qwen_model: str | None,
-    qwen_key: str | None,
-    qwen_max_tokens: int,
-    qwen_temperature: float,
-
+    providers: list[ProviderConfig],
     pepper: bytes,
     flask_app: Flask,
+
+    pool_max_connections: int = 20,
+    pool_max_keepalive: int = 10,
+    pool_keepalive_expiry: float = 30.0,
+    connect_timeout: float = 5.0,
+    read_timeout: float = 60.0,
+    warm_connections: bool = True,
+
+    reply_cache_size: int = 0,
+    reply_cache_ttl: float = 3600.0,
+    reply_cache_db: str | None = None,
+    reply_cache_max_temperature: float = 0.5,
+    reply_cache_disabled: set[str] | None = None,
+    reply_cache_purge_interval: float = 300.0,
+
+    history_codec: str = "auto",
+    history_zstd_dict: str | None = None,
+    history_zstd_dict_dir: str | None = None,
+
+    sqlite_synchronous: str = "NORMAL",
+    sqlite_mmap_size: int = 256 * 1024 * 1024,
+    sqlite_cache_size: int = -64 * 1024,
+
+    hash_workers: int = 2,
+    hash_max_pending: int = 16,
+    hash_timeout: float = 30.0,
+    argon2_time_cost: int = 10,
+    argon2_memory_cost: int = 65536,
+    argon2_parallelism: int = 4,
+
+    user_cache_size: int = 10000,
+    user_cache_ttl: float = 60.0,
+
+    history_write_behind: bool = True,
+    history_write_batch: int = 256,
+    history_write_delay_ms: float = 5.0,
+    history_write_timeout: float = 30.0,
+
+    llm_max_concurrency: int = 8,
+    llm_provider_concurrency: dict[str, int] | None = None,
+    llm_acquire_timeout: float = 2.0,
+    llm_deadline: float = 45.0,
+    llm_max_retries: int = 2,
+    llm_backoff_base: float = 0.5,
+    llm_backoff_max: float = 8.0,
+    llm_breaker_failures: int = 5,
+    llm_breaker_reset: float = 30.0,
+    llm_hedge: bool = False,
+    llm_hedge_min_delay: float = 1.0,
+
+    context_token_budget: int = 1500,
+    context_token_budgets: dict[str, int] | None = None,
+    context_cache_threads: int = 1000,
+
+    archive_after_days: float = 90.0,
+    archive_retention_days: float = 0.0,
+    archive_interval: float = 3600.0,
+    archive_batch_size: int = 50,
+    archive_vacuum_pages: int = 2000,
+    archive_lock_path: str | None = None,
 ) -> None:
-    global gpt_client, gemini_client, grok_client, claude_client
-    global deepseek_client, mistral_client, pwd_hasher, llama_client, qwen_client
-
-    gpt_client = GPTClient(openai_model or "", openai_max_tokens, openai_temperature, openai_key)
-    gemini_client = GeminiClient(gemini_model or "", gemini_max_tokens, gemini_temperature, gemini_key)
-    grok_client = GrokClient(grok_model or "", grok_max_tokens, grok_temperature, grok_key)
-    claude_client = ClaudeClient(claude_model or "", claude_max_tokens, claude_temperature, claude_key)
-    deepseek_client = DeepseekClient(deepseek_model or "", deepseek_max_tokens, deepseek_temperature, deepseek_key)
-    mistral_client = MistralClient(mistral_model, mistral_max_tokens, mistral_temperature, mistral_key)
-    llama_client = TogetherLlamaClient(llama_model, llama_max_tokens, llama_temperature, llama_key)
-    qwen_client = TogetherQwenClient(qwen_model, qwen_max_tokens, qwen_temperature, qwen_key)
-
-    pwd_hasher = UpdatedHasher(pepper)
-    db.init_app(flask_app)
\ No newline at end of file
+    global clients, unconfigured, pwd_hasher
+    global reply_cache, user_cache, history_writer
+    global turn_cache, context_budget, context_budgets, archiver
+
+    # Pools must be configured before the clients below pick them up
+    transport.configure(transport.TransportConfig(
+        max_connections=pool_max_connections,
+        max_keepalive=pool_max_keepalive,
+        keepalive_expiry=pool_keepalive_expiry,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+    ))
+
+    policy = resilience.ResiliencePolicy(
+        max_concurrency=llm_max_concurrency,
+        acquire_timeout=llm_acquire_timeout,
+        deadline=llm_deadline,
+        max_retries=llm_max_retries,
+        backoff_base=llm_backoff_base,
+        backoff_max=llm_backoff_max,
+        breaker_failures=llm_breaker_failures,
+        breaker_reset=llm_breaker_reset,
+        hedge=llm_hedge,
+        hedge_min_delay=llm_hedge_min_delay,
+    )
+    # Per-provider limits from the registry; LLM_PROVIDER_CONCURRENCY takes precedence
+    limits = {config.name: config.max_concurrency for config in providers if config.max_concurrency}
+    limits.update(llm_provider_concurrency or {})
+    resilience.configure(policy, {
+        name: dataclasses.replace(policy, max_concurrency=limit) for name, limit in limits.items()
+    })
+
+    clients = {config.name: create_client(config) for config in providers if config.key}
+    unconfigured = {config.name for config in providers if not config.key}
+
+    reply_cache = ReplyCache(
+        max_entries=reply_cache_size,
+        ttl_seconds=reply_cache_ttl,
+        db_path=reply_cache_db,
+        max_temperature=reply_cache_max_temperature,
+        disabled_providers=reply_cache_disabled,
+        purge_interval=reply_cache_purge_interval,
+    ) if reply_cache_size > 0 else None
+
+    text_codec.configure(history_codec, history_zstd_dict, history_zstd_dict_dir)
+
+    turn_cache = TurnCache(max_threads=context_cache_threads)
+    context_budget = context_token_budget
+    context_budgets = {name.upper(): budget for name, budget in (context_token_budgets or {}).items()}
+
+    user_cache = UserCache(max_entries=user_cache_size, ttl_seconds=user_cache_ttl)
+    user_cache.watch(dbms.User)
+
+    pwd_hasher = PasswordHashingService(
+        pepper,
+        Argon2Params(argon2_time_cost, argon2_memory_cost, argon2_parallelism),
+        workers=hash_workers,
+        max_pending=hash_max_pending,
+        timeout=hash_timeout,
+    )
+    db.init_app(flask_app)
+    metrics.instrument_app(flask_app)
+    with flask_app.app_context():
+        metrics.instrument_engine(db.engine)
+        migrations.install_pragmas(db.engine, migrations.SqlitePragmas(
+            synchronous=sqlite_synchronous,
+            mmap_size=sqlite_mmap_size,
+            cache_size=sqlite_cache_size,
+        ))
+
+    if history_writer is not None:
+        history_writer.close()
+    history_writer = HistoryWriter(
+        flask_app,
+        max_batch=history_write_batch,
+        max_delay_ms=history_write_delay_ms,
+        enabled=history_write_behind,
+        wait_timeout=history_write_timeout,
+    )
+
+    if archiver is not None:
+        archiver.close()
+    archiver = Archiver(flask_app, ArchivePolicy(
+        archive_after_days=archive_after_days,
+        retention_days=archive_retention_days,
+        batch_size=archive_batch_size,
+        vacuum_pages=archive_vacuum_pages,
+    ), archive_interval, archive_lock_path) if archive_interval > 0 else None
+    flask_app.before_request(_start_archiver)
+
+    if warm_connections:
+        transport.warm_up()
+
+
+def clients_by_name() -> dict[str, LLMClient]:
+    """
+    Maps each configured client's display name (e.g. "CHATGPT") to the client.
+    """
+    return dict(clients)
+
+
+def _start_archiver() -> None:
+    # Requests only: CLI commands and a preloading master never start the thread
+    if archiver is not None:
+        archiver.start()
+
+
+def _forget_threads(thread_ids: list[int]) -> None:
+    if turn_cache is not None:
+        for thread_id in thread_ids:
+            turn_cache.forget(thread_id)
+
+
+archive.on_removed(_forget_threads)
+
+# Component stats on /metrics; each reads the current instance, or nothing while it's off
+metrics.SnapshotCollector("llm_pool", "Provider connection pool", transport.pool_stats,
+                          counters=("requests_total",), label="host")
+metrics.SnapshotCollector("reply_cache", "Reply cache", lambda: reply_cache and reply_cache.snapshot(),
+                          counters=("hits", "persistent_hits", "misses", "evictions", "expirations", "bypassed", "purged"))
+metrics.SnapshotCollector("user_cache", "Logged-in user cache", lambda: user_cache and user_cache.snapshot(),
+                          counters=("hits", "misses", "expirations", "evictions", "invalidations"))
+metrics.SnapshotCollector("context_cache", "Per-thread context cache", lambda: turn_cache and turn_cache.snapshot(),
+                          counters=("hits", "loads", "rows_decoded", "evictions", "invalidations"))
+metrics.SnapshotCollector("history_writer", "History writer", lambda: history_writer and history_writer.snapshot(),
+                          counters=("writes", "rows", "batches", "failures"))
+metrics.SnapshotCollector("archiver", "Archiver in this process", lambda: archiver and archiver.snapshot(),
+                          counters=("passes", "threads_archived", "messages_archived", "threads_rehydrated",
+                                    "threads_deleted", "pages_vacuumed", "failures"))
+metrics.SnapshotCollector("password_hashing", "Password hashing pool", lambda: pwd_hasher and pwd_hasher.snapshot(),
+                          counters=("completed", "rejected", "timeouts", "rehashed"))
+
+
+def ensure_hot_thread(thread_id: int) -> None:
+    """
+    Rehydrates the thread if it was archived, and moves it to the turn schema if it is still
+    in chat_history, before anything reads or appends to it.
+    """
+    if archive.ensure_hot(db.session, thread_id):
+        if turn_cache is not None:
+            turn_cache.forget(thread_id)
+        if archiver is not None:
+            archiver.note_rehydrated()
+    if turn_migration.ensure_converted(db.session, thread_id) and turn_cache is not None:
+        turn_cache.forget(thread_id)
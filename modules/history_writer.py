@@ -0,0 +1,355 @@
+"""
+Write-behind persistence for chat history.
+
+Request threads hand finished replies to a queue; one writer thread drains it and commits
+everything that arrived within a few milliseconds (or up to a batch size) in a single
+transaction. Under load that turns one SQLite commit per model reply into one per batch,
+so far fewer fsyncs and far less contention on the database write lock.
+"""
+from __future__ import annotations
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from flask import Flask
+from sqlalchemy import insert
+
+from modules import dbms, metrics, search_index
+from modules.dbms import db, ChatResponse, ChatThread, ChatTurn
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ReplyStats:
+    """
+    What the provider call behind a reply took; whatever isn't known stays None.
+    """
+    latency_ms: int | None = None
+    input_tokens: int | None = None
+    output_tokens: int | None = None
+
+
+@dataclass
+class PendingWrite:
+    """
+    One prompt's replies waiting to be saved as a turn. wait() blocks until they are committed.
+    """
+    thread_id: int
+    # (model_name, encoded reply, stats)
+    rows: list[tuple[str, bytes, ReplyStats]]
+    when: datetime
+    # Encoded once for the whole turn
+    prompt: bytes = b""
+    # Set to add the replies to an existing turn; filled in with the new turn's id once committed
+    turn_id: int | None = None
+    # (prompt, reply) per row, plain text for the search index
+    texts: list[tuple[str, str]] = field(default_factory=list)
+    enqueued: float = field(default_factory=time.monotonic)
+    ids: list[int] = field(default_factory=list)
+    error: BaseException | None = None
+    _done: threading.Event = field(default_factory=threading.Event)
+
+    def wait(self, timeout: float | None = None) -> list[int]:
+        """
+        Returns the new response ids once the rows are durable. Raises if the write failed.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("History write was not committed in time")
+        if self.error is not None:
+            raise self.error
+        return self.ids
+
+    def _finish(self, error: BaseException | None = None) -> None:
+        self.error = error
+        self._done.set()
+
+
+@dataclass
+class WriterStats:
+    writes: int = 0
+    rows: int = 0
+    batches: int = 0
+    failures: int = 0
+    last_batch_size: int = 0
+    max_batch_size: int = 0
+    total_flush_ms: float = 0.0
+    max_flush_ms: float = 0.0
+    total_queue_wait_ms: float = 0.0
+
+
+_CLOSE = object()
+
+
+class HistoryWriter:
+    """
+    Group-commit queue in front of the history tables. With enabled=False every write commits
+    synchronously on the caller's thread, which is what CLI commands and tests want.
+
+    The writer thread starts on the first write in each process: a worker forked from a
+    preloaded app inherits the writer but not its thread.
+    """
+    def __init__(self, flask_app: Flask, max_batch: int = 256, max_delay_ms: float = 5.0,
+                 enabled: bool = True, wait_timeout: float = 30.0):
+        self.app = flask_app
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.enabled = enabled
+        # How long save() waits for the commit before giving up on it
+        self.wait_timeout = wait_timeout
+        self.stats = WriterStats()
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        # Process the thread was started in
+        self._pid: int | None = None
+        self._closed = False
+        if enabled:
+            atexit.register(self.close)
+
+    def _running(self) -> bool:
+        """
+        Starts the writer thread in this process if it isn't running yet. Returns False when
+        writes should commit on the caller's thread instead.
+        """
+        if not self.enabled or self._closed:
+            return False
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # Whatever the parent had queued is the parent's to write
+                    self._queue = queue.Queue()
+                    self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                                    name="history-writer", daemon=True)
+                    self._thread.start()
+                    self._pid = pid
+        return True
+
+    def submit(self, thread_id: int, prompt: str, replies: list[tuple[str, str]],
+               stats: dict[str, ReplyStats] | None = None, turn_id: int | None = None) -> PendingWrite:
+        """
+        Queues (model_name, reply) pairs for one prompt, with each model's call stats if
+        known, as a new turn or, given turn_id, as more responses to that turn of the thread.
+        Text is encoded here, on the caller's thread, so the writer only does I/O.
+        """
+        stats = stats or {}
+        pending = PendingWrite(
+            thread_id=thread_id,
+            rows=[(model_name, dbms.db_encode_text(reply), stats.get(model_name, ReplyStats()))
+                  for model_name, reply in replies],
+            when=datetime.now(),
+            prompt=dbms.db_encode_text(prompt) if replies and turn_id is None else b"",
+            turn_id=turn_id,
+            texts=[(prompt, reply) for _, reply in replies],
+        )
+        if not pending.rows:
+            pending._finish()
+            return pending
+        if self._running():
+            self._queue.put(pending)
+        else:
+            self._write_batch([pending])
+        return pending
+
+    def save(self, thread_id: int, prompt: str, replies: list[tuple[str, str]],
+             stats: dict[str, ReplyStats] | None = None, turn_id: int | None = None) -> list[int]:
+        """
+        Queues the replies and waits until they are committed. Returns the new response ids.
+        Raises TimeoutError if that takes longer than wait_timeout.
+        """
+        return self.submit(thread_id, prompt, replies, stats, turn_id).wait(self.wait_timeout)
+
+    def flush(self, timeout: float | None = None) -> None:
+        """
+        Blocks until everything queued before this call is committed.
+        """
+        if self._closed or self._pid != os.getpid():
+            return
+        barrier = PendingWrite(thread_id=0, rows=[], when=datetime.now())
+        self._queue.put(barrier)
+        barrier._done.wait(timeout)
+
+    def close(self) -> None:
+        """
+        Commits whatever is still queued and stops the writer thread. Later writes commit
+        on the caller's thread.
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread if self._pid == os.getpid() else None
+            self._thread, self._pid = None, None
+        if thread is None:
+            return
+        self._queue.put(_CLOSE)
+        thread.join()
+
+    def _run(self, pending_writes: queue.Queue) -> None:
+        while True:
+            item = pending_writes.get()
+            if item is _CLOSE:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            closing = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = pending_writes.get(timeout=remaining) if remaining > 0 else pending_writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                    break
+                batch.append(item)
+
+            self._write_or_fail(batch)
+            if closing:
+                # Drain anything that raced in ahead of the close marker
+                leftovers = []
+                while not pending_writes.empty():
+                    item = pending_writes.get_nowait()
+                    if item is not _CLOSE:
+                        leftovers.append(item)
+                if leftovers:
+                    self._write_or_fail(leftovers)
+                return
+
+    def _write_or_fail(self, batch: list[PendingWrite]) -> None:
+        try:
+            self._write_batch(batch)
+        except Exception as e:
+            # Keep the writer alive; waiters get the error instead of hanging
+            logger.exception("History writer batch failed")
+            for pending in batch:
+                pending._finish(e)
+
+    def _write_batch(self, batch: list[PendingWrite]) -> None:
+        writes = [pending for pending in batch if pending.rows]
+        started = time.monotonic()
+        if writes:
+            with self.app.app_context():
+                try:
+                    self._commit(writes)
+                    error = None
+                except Exception as e:
+                    db.session.rollback()
+                    error = e
+                if error is not None and len(writes) > 1:
+                    # Don't let one bad write (e.g. its thread was deleted) sink the rest
+                    logger.warning("Batched history write failed; retrying individually: %s", error)
+                    for pending in writes:
+                        try:
+                            self._commit([pending])
+                            pending._finish()
+                        except Exception as e:
+                            db.session.rollback()
+                            self._fail(pending, e)
+                elif error is not None:
+                    self._fail(writes[0], error)
+                else:
+                    for pending in writes:
+                        pending._finish()
+        for pending in batch:
+            if not pending.rows:
+                pending._finish()
+        if not writes:
+            return
+
+        flush_ms = (time.monotonic() - started) * 1000
+        metrics.HISTORY_BATCH_SECONDS.observe(flush_ms / 1000)
+        with self._lock:
+            stats = self.stats
+            stats.batches += 1
+            stats.writes += len(writes)
+            stats.rows += sum(len(pending.rows) for pending in writes)
+            stats.last_batch_size = len(writes)
+            stats.max_batch_size = max(stats.max_batch_size, len(writes))
+            stats.total_flush_ms += flush_ms
+            stats.max_flush_ms = max(stats.max_flush_ms, flush_ms)
+            stats.total_queue_wait_ms += sum((started - pending.enqueued) * 1000 for pending in writes)
+
+    def _commit(self, writes: list[PendingWrite]) -> None:
+        # One turn row per prompt, however many models answered it
+        turns = ChatTurn.__table__
+        turn_ids = [pending.turn_id for pending in writes]
+        new_turns = [i for i, turn_id in enumerate(turn_ids) if turn_id is None]
+        if new_turns:
+            inserted = db.session.execute(
+                insert(turns).returning(turns.c.id, sort_by_parameter_order=True),
+                [
+                    {"thread_id": writes[i].thread_id, "user_input": writes[i].prompt, "date_saved": writes[i].when}
+                    for i in new_turns
+                ],
+            ).scalars().all()
+            for i, turn_id in zip(new_turns, inserted):
+                turn_ids[i] = turn_id
+        table = ChatResponse.__table__
+        params = [
+            {
+                "turn_id": turn_id,
+                "thread_id": pending.thread_id,
+                "model_name": model_name,
+                "model_response": model_response,
+                "latency_ms": stats.latency_ms,
+                "input_tokens": stats.input_tokens,
+                "output_tokens": stats.output_tokens,
+            }
+            for turn_id, pending in zip(turn_ids, writes)
+            for model_name, model_response, stats in pending.rows
+        ]
+        ids = db.session.execute(
+            insert(table).returning(table.c.id, sort_by_parameter_order=True), params
+        ).scalars().all()
+
+        activity: dict[int, tuple[list[str], datetime]] = {}
+        offset = 0
+        for pending in writes:
+            pending.ids = list(ids[offset:offset + len(pending.rows)])
+            offset += len(pending.rows)
+            names, when = activity.get(pending.thread_id, ([], pending.when))
+            names.extend(model_name for model_name, _, _ in pending.rows)
+            activity[pending.thread_id] = (names, max(when, pending.when))
+        for thread_id, (names, when) in activity.items():
+            dbms.record_thread_activity(thread_id, names, when)
+
+        owners = dict(db.session.execute(
+            db.select(ChatThread.id, ChatThread.user_id).where(ChatThread.id.in_(activity))
+        ).all())
+        search_index.index_rows(db.session, (
+            (row_id, owners[pending.thread_id], model_name, prompt, reply)
+            for pending in writes
+            for row_id, (model_name, _, _), (prompt, reply) in zip(pending.ids, pending.rows, pending.texts)
+        ))
+        db.session.commit()
+        for pending, turn_id in zip(writes, turn_ids):
+            pending.turn_id = turn_id
+
+    def _fail(self, pending: PendingWrite, error: BaseException) -> None:
+        logger.error("Dropping history write for thread %d: %s", pending.thread_id, error)
+        with self._lock:
+            self.stats.failures += 1
+        pending._finish(error)
+
+    def snapshot(self) -> dict[str, int | float]:
+        with self._lock:
+            stats = self.stats
+            return {
+                "enabled": self.enabled and not self._closed,
+                "queue_depth": self._queue.qsize(),
+                "writes": stats.writes,
+                "rows": stats.rows,
+                "batches": stats.batches,
+                "failures": stats.failures,
+                "last_batch_size": stats.last_batch_size,
+                "max_batch_size": stats.max_batch_size,
+                "avg_batch_size": stats.writes / stats.batches if stats.batches else 0.0,
+                "avg_flush_ms": stats.total_flush_ms / stats.batches if stats.batches else 0.0,
+                "max_flush_ms": stats.max_flush_ms,
+                "avg_queue_wait_ms": stats.total_queue_wait_ms / stats.writes if stats.writes else 0.0,
+            }
@@ -1,12 +1,76 @@
+import threading
 from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, TypeVar
+
+from modules import metrics, transport
+
+# Provider SDKs are imported inside the client that uses them, so a worker only pays the
+# import time and memory for providers that are actually configured
+
+# Upstream hosts; clients for the same host share one connection pool
+OPENAI_URL = "https://api.openai.com/v1"
+DEEPSEEK_URL = "https://api.deepseek.com"
+ANTHROPIC_URL = "https://api.anthropic.com"
+GEMINI_URL = "https://generativelanguage.googleapis.com"
+MISTRAL_URL = "https://api.mistral.ai"
+TOGETHER_URL = "https://api.together.xyz/v1"
+XAI_URL = "https://api.x.ai/v1"
+
+# Retries live in modules/resilience.py; SDK-level retries would multiply with ours
+SDK_MAX_RETRIES = 0
+
+# Anthropic prompt-cache breakpoint; the cached prefix lives for about five minutes
+EPHEMERAL_CACHE = {"type": "ephemeral"}
+
+
+@dataclass
+class UsageStats:
+    calls: int = 0
+    # All prompt tokens, including the ones served from the provider's prompt cache
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    # Tokens written to the prompt cache (billed at a premium by Anthropic)
+    cache_write_tokens: int = 0
+    output_tokens: int = 0
+
+
+T = TypeVar("T")
+
+
+@dataclass
+class CallUsage:
+    """
+    Tokens reported by the provider calls made through call()/stream(), which may
+    run on other threads (retries, hedges). The totals in UsageStats are kept as well.
+    """
+    calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+    def call(self, fn: Callable[[], T]) -> T:
+        token = _call_usage.set(self)
+        try:
+            return fn()
+        finally:
+            _call_usage.reset(token)
+
+    def stream(self, chunks: Iterator[str]) -> Iterator[str]:
+        # Set around each step only: a generator can be resumed from another context
+        while True:
+            token = _call_usage.set(self)
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                _call_usage.reset(token)
+            yield chunk
+
+
+_call_usage: ContextVar[CallUsage | None] = ContextVar("call_usage", default=None)
 
-import openai
-from google import genai
-import anthropic
-import xai_sdk
-from xai_sdk import chat as xai_chat
-from mistralai import Mistral
-from together import Together
 
 class LLMClient(ABC):
     def __init__(self, model: str, max_tokens: int, temperature: float):
@@ -14,25 +78,109 @@ class LLMClient(ABC):
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.name = "LLM"
+        self.usage = UsageStats()
+        self._usage_lock = threading.Lock()
+        self._system_prompt: str | None = None
 
     def system_prompt(self) -> str:
-        return (
-            f"You are a highly intelligent, helpful assistant. "
-            f"Provide a concise answer under {int(float(self.max_tokens) * 0.75)} words."
-        )
+        # Built once: providers only reuse cached prompt prefixes that are byte-identical
+        if self._system_prompt is None:
+            self._system_prompt = (
+                f"You are a highly intelligent, helpful assistant. "
+                f"Provide a concise answer under {int(float(self.max_tokens) * 0.75)} words."
+            )
+        return self._system_prompt
+
+    def record_usage(self, input_tokens: int, cached_input_tokens: int = 0, output_tokens: int = 0,
+                     cache_write_tokens: int = 0) -> None:
+        call = _call_usage.get()
+        with self._usage_lock:
+            usage = self.usage
+            usage.calls += 1
+            usage.input_tokens += input_tokens
+            usage.cached_input_tokens += cached_input_tokens
+            usage.cache_write_tokens += cache_write_tokens
+            usage.output_tokens += output_tokens
+            if call is not None:
+                call.calls += 1
+                call.input_tokens += input_tokens
+                call.output_tokens += output_tokens
+        metrics.LLM_TOKENS.inc(self.name, "input", amount=input_tokens)
+        metrics.LLM_TOKENS.inc(self.name, "cached_input", amount=cached_input_tokens)
+        metrics.LLM_TOKENS.inc(self.name, "cache_write", amount=cache_write_tokens)
+        metrics.LLM_TOKENS.inc(self.name, "output", amount=output_tokens)
+
+    def _record_openai_usage(self, usage: Any) -> None:
+        """
+        Records an OpenAI-style usage block. OpenAI reports prompt-cache hits in
+        prompt_tokens_details, DeepSeek in prompt_cache_hit_tokens; others don't report them.
+        """
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or getattr(usage, "prompt_cache_hit_tokens", None) or 0
+        self.record_usage(usage.prompt_tokens or 0, cached, usage.completion_tokens or 0)
+
+    def usage_snapshot(self) -> dict[str, int | float]:
+        with self._usage_lock:
+            usage = self.usage
+            return {
+                "calls": usage.calls,
+                "input_tokens": usage.input_tokens,
+                "cached_input_tokens": usage.cached_input_tokens,
+                "uncached_input_tokens": usage.input_tokens - usage.cached_input_tokens,
+                "cache_write_tokens": usage.cache_write_tokens,
+                "output_tokens": usage.output_tokens,
+                "cache_hit_rate": usage.cached_input_tokens / usage.input_tokens if usage.input_tokens else 0.0,
+            }
+
+    @staticmethod
+    def chat_messages(system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> list[dict]:
+        """
+        Builds an OpenAI-style message list: optional system message, prior turns, then the prompt.
+        """
+        messages: list[dict] = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        for user_msg, assistant_msg in history:
+            messages.append({"role": "user", "content": user_msg})
+            messages.append({"role": "assistant", "content": assistant_msg})
+        messages.append({"role": "user", "content": user_prompt})
+        return messages
 
     @abstractmethod
     def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
         ...
 
+    def stream_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> Iterator[str]:
+        """
+        Yields the reply in text chunks as the provider generates them.
+        Clients without a streaming API fall back to a single chunk.
+        """
+        yield self.get_reply(system_prompt, user_prompt, history)
+
 
 class GeminiClient(LLMClient):
-    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None):
+    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None,
+                 base_url: str | None = None):
         super().__init__(model, max_tokens, temperature)
         self.name = "GEMINI"
-        self.api = genai.Client(api_key=key) if key else None
+        self.base_url = base_url or GEMINI_URL
+        from google import genai
+        from google.genai import types as genai_types
+        self.api = genai.Client(
+            api_key=key,
+            http_options=genai_types.HttpOptions(
+                base_url=self.base_url,
+                httpx_client=transport.http_client(self.base_url),
+                # One attempt: retries live in modules/resilience.py
+                retry_options=genai_types.HttpRetryOptions(attempts=SDK_MAX_RETRIES + 1),
+            ),
+        ) if key else None
 
-    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
+
+    @staticmethod
+    def _full_prompt(system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> str:
         parts: list[str] = []
 
         if system_prompt:
@@ -43,67 +191,151 @@ class GeminiClient(LLMClient):
             parts.append(f"Assistant: {assistant_msg}\n")
         parts.append(f"User: {user_prompt}\nAssistant:")
 
-        full_prompt = "\n".join(parts)
+        return "\n".join(parts)
+
+    def _record_gemini_usage(self, metadata: Any) -> None:
+        if metadata is None:
+            return
+        self.record_usage(
+            metadata.prompt_token_count or 0,
+            metadata.cached_content_token_count or 0,
+            metadata.candidates_token_count or 0,
+        )
 
+    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
         resp = self.api.models.generate_content(  # type: ignore[union-attr]
             model=self.model,
-            contents=full_prompt,
+            contents=self._full_prompt(system_prompt, user_prompt, history),
         )
+        self._record_gemini_usage(resp.usage_metadata)
         return resp.text
 
+    def stream_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> Iterator[str]:
+        stream = self.api.models.generate_content_stream(  # type: ignore[union-attr]
+            model=self.model,
+            contents=self._full_prompt(system_prompt, user_prompt, history),
+        )
+        metadata = None
+        for chunk in stream:
+            # Every chunk carries running totals; the last one has the final counts
+            metadata = chunk.usage_metadata or metadata
+            if chunk.text:
+                yield chunk.text
+        self._record_gemini_usage(metadata)
 
 class GPTClient(LLMClient):
-    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None):
+    """
+    OpenAI's chat completions API, and any provider with a compatible one (DeepSeek) given
+    its base URL.
+    """
+    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None,
+                 base_url: str | None = None):
         super().__init__(model, max_tokens, temperature)
         self.name = "CHATGPT"
-        self.api = openai.OpenAI(api_key=key) if key else None
+        self.base_url = base_url or OPENAI_URL
+        import openai
+        self.api = openai.OpenAI(
+            api_key=key,
+            max_retries=SDK_MAX_RETRIES,
+            base_url=self.base_url,
+            http_client=transport.http_client(self.base_url),
+        ) if key else None
 
-    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
-        messages = [{"role": "system", "content": system_prompt}]
-        for user_msg, assistant_msg in history:
-            messages.append({"role": "user", "content": user_msg})
-            messages.append({"role": "assistant", "content": assistant_msg})
-        messages.append({"role": "user", "content": user_prompt})
 
+    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
         completion = self.api.chat.completions.create(  # type: ignore[union-attr]
             model=self.model,
-            messages=messages,
+            messages=self.chat_messages(system_prompt, user_prompt, history),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
         )
+        self._record_openai_usage(completion.usage)
         return completion.choices[0].message.content
 
+    def stream_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> Iterator[str]:
+        stream = self.api.chat.completions.create(  # type: ignore[union-attr]
+            model=self.model,
+            messages=self.chat_messages(system_prompt, user_prompt, history),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            # Only the final, choice-less chunk carries usage
+            self._record_openai_usage(chunk.usage)
 
 class ClaudeClient(LLMClient):
-    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None):
+    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None,
+                 base_url: str | None = None):
         super().__init__(model, max_tokens, temperature)
         self.name = "CLAUDE"
-        self.api = anthropic.Anthropic(api_key=key) if key else None
+        self.base_url = base_url or ANTHROPIC_URL
+        import anthropic
+        self.api = anthropic.Anthropic(
+            api_key=key,
+            max_retries=SDK_MAX_RETRIES,
+            base_url=self.base_url,
+            http_client=transport.http_client(self.base_url),
+        ) if key else None
 
-    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
-        messages: list[dict] = []
-        for user_msg, assistant_msg in history:
-            messages.append({"role": "user", "content": user_msg})
-            messages.append({"role": "assistant", "content": assistant_msg})
-        messages.append({"role": "user", "content": user_prompt})
 
+    def _request(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> dict:
+        """
+        Messages API arguments with cache breakpoints after the system prompt and after the
+        newest history turn, so everything before the new prompt can be read from the cache.
+        """
+        messages = self.chat_messages("", user_prompt, history)
+        if history:
+            last_reply = messages[-2]
+            last_reply["content"] = [{"type": "text", "text": last_reply["content"], "cache_control": EPHEMERAL_CACHE}]
+        request: dict = {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "messages": messages,
+            "temperature": self.temperature,
+        }
+        if system_prompt:
+            request["system"] = [{"type": "text", "text": system_prompt, "cache_control": EPHEMERAL_CACHE}]
+        return request
+
+    def _record_anthropic_usage(self, usage: Any) -> None:
+        # input_tokens only counts what came after the last cache breakpoint
+        read = usage.cache_read_input_tokens or 0
+        written = usage.cache_creation_input_tokens or 0
+        self.record_usage(usage.input_tokens + read + written, read, usage.output_tokens, written)
+
+    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
         resp = self.api.messages.create(  # type: ignore[union-attr]
-            model=self.model,
-            max_tokens=self.max_tokens,
-            messages=messages,
-            system=system_prompt,
-            temperature=self.temperature,
+            **self._request(system_prompt, user_prompt, history),
         )
+        self._record_anthropic_usage(resp.usage)
         return resp.content[0].text
 
+    def stream_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> Iterator[str]:
+        with self.api.messages.stream(  # type: ignore[union-attr]
+            **self._request(system_prompt, user_prompt, history),
+        ) as stream:
+            yield from stream.text_stream
+            self._record_anthropic_usage(stream.get_final_message().usage)
 
 class GrokClient(LLMClient):
     def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None):
         super().__init__(model, max_tokens, temperature)
         self.name = "GROK"
-        self.api = xai_sdk.Client(api_key=key) if key else None
+        import xai_sdk
+        self.api = xai_sdk.Client(api_key=key, channel_options=self._channel_options()) if key else None
 
-    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
+    @staticmethod
+    def _channel_options() -> list[tuple[str, int]]:
+        # The SDK turns on gRPC's own retries by default
+        return [("grpc.enable_retries", SDK_MAX_RETRIES)]
+
+
+    def _create_chat(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
+        from xai_sdk import chat as xai_chat
         chat = self.api.chat.create(  # type: ignore[union-attr]
             model=self.model,
             max_tokens=self.max_tokens,
@@ -114,60 +346,65 @@ class GrokClient(LLMClient):
             chat.append(xai_chat.user(user_msg))
             chat.append(xai_chat.assistant(assistant_msg))
         chat.append(xai_chat.user(user_prompt))
+        return chat
 
-        response = chat.sample()
-        return response.content if hasattr(response, "content") else str(response)
-
-
-class DeepseekClient(LLMClient):
-    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None):
-        super().__init__(model, max_tokens, temperature)
-        self.name = "DEEPSEEK"
-        self.api = openai.OpenAI(
-            api_key=key,
-            base_url="https://api.deepseek.com",
-        ) if key else None
+    def _record_xai_usage(self, response: Any) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.record_usage(usage.prompt_tokens, usage.cached_prompt_text_tokens, usage.completion_tokens)
 
     def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
-        messages = [{"role": "system", "content": system_prompt}]
-        for user_msg, assistant_msg in history:
-            messages.append({"role": "user", "content": user_msg})
-            messages.append({"role": "assistant", "content": assistant_msg})
-        messages.append({"role": "user", "content": user_prompt})
+        response = self._create_chat(system_prompt, user_prompt, history).sample()
+        self._record_xai_usage(response)
+        return response.content if hasattr(response, "content") else str(response)
 
-        resp = self.api.chat.completions.create(  # type: ignore[union-attr]
-            model=self.model,
-            messages=messages,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-            stream=False,
-        )
-        return resp.choices[0].message.content
+    def stream_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> Iterator[str]:
+        response = None
+        for response, chunk in self._create_chat(system_prompt, user_prompt, history).stream():
+            if chunk.content:
+                yield chunk.content
+        # The response accumulates as chunks arrive; usage is filled in by the last one
+        self._record_xai_usage(response)
+
+class GrokRestClient(GPTClient):
+    """
+    Grok through xAI's OpenAI-compatible REST API. GrokClient speaks gRPC to a fixed host,
+    so this one is used when a base URL is configured (e.g. a local stand-in server).
+    """
+    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None,
+                 base_url: str | None = None):
+        super().__init__(model, max_tokens, temperature, key, base_url or XAI_URL)
+        self.name = "GROK"
 
 
 class MistralClient(LLMClient):
-    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None):
+    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None,
+                 base_url: str | None = None):
         super().__init__(model, max_tokens, temperature)
         self.name = "MISTRAL"
-        self.api = Mistral(api_key=key) if key else None
-
-    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
-        messages: list[dict] = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
+        self.base_url = base_url or MISTRAL_URL
+        from mistralai import Mistral
+        self.api = Mistral(
+            api_key=key,
+            server_url=self.base_url,
+            client=transport.http_client(self.base_url),
+            retry_config=self._retry_config(),
+        ) if key else None
 
-        for user_msg, assistant_msg in history:
-            messages.append({"role": "user", "content": user_msg})
-            messages.append({"role": "assistant", "content": assistant_msg})
+    @staticmethod
+    def _retry_config():
+        from mistralai.utils import RetryConfig
+        return RetryConfig("none", None, False)  # type: ignore[arg-type]
 
-        messages.append({"role": "user", "content": user_prompt})
 
+    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
         resp = self.api.chat.complete(  # type: ignore[union-attr]
             model=self.model,
-            messages=messages,
+            messages=self.chat_messages(system_prompt, user_prompt, history),
             max_tokens=self.max_tokens,
             temperature=self.temperature,
         )
+        self._record_openai_usage(resp.usage)
 
         choice = resp.choices[0]
         content = choice.message.content
@@ -175,54 +412,59 @@ class MistralClient(LLMClient):
             return "".join(part.get("text", "") for part in content)
         return str(content)
 
-class TogetherLlamaClient(LLMClient):
-    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None):
+    def stream_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> Iterator[str]:
+        stream = self.api.chat.stream(  # type: ignore[union-attr]
+            model=self.model,
+            messages=self.chat_messages(system_prompt, user_prompt, history),
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+        for event in stream:
+            delta = event.data.choices[0].delta.content if event.data.choices else None
+            if isinstance(delta, list):
+                delta = "".join(getattr(part, "text", "") for part in delta)
+            if delta:
+                yield delta
+            self._record_openai_usage(event.data.usage)
+
+class TogetherClient(LLMClient):
+    """
+    Any model hosted on Together; the registry sets the model and display name.
+    """
+    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None,
+                 base_url: str | None = None):
         super().__init__(model, max_tokens, temperature)
-        self.name = "LLAMA"
-        self.api = Together(api_key=key) if key else Together()
-
-    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
-        messages: list[dict] = []
-
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-
-        for user_msg, assistant_msg in history:
-            messages.append({"role": "user", "content": user_msg})
-            messages.append({"role": "assistant", "content": assistant_msg})
+        self.name = "TOGETHER"
+        self.base_url = base_url or TOGETHER_URL
+        from together import Together
+        self.api = Together(
+            api_key=key,
+            base_url=self.base_url,
+            http_client=transport.http_client(self.base_url),
+            max_retries=SDK_MAX_RETRIES,
+        ) if key else None
 
-        messages.append({"role": "user", "content": user_prompt})
 
+    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
         completion = self.api.chat.completions.create(
             model=self.model,
-            messages=messages,
+            messages=self.chat_messages(system_prompt, user_prompt, history),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
         )
+        self._record_openai_usage(completion.usage)
         return completion.choices[0].message.content
 
-class TogetherQwenClient(LLMClient):
-    def __init__(self, model: str, max_tokens: int, temperature: float, key: str | None):
-        super().__init__(model, max_tokens, temperature)
-        self.name = "QWEN"
-        self.api = Together(api_key=key) if key else Together()
-
-    def get_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]):
-        messages: list[dict] = []
-
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-
-        for user_msg, assistant_msg in history:
-            messages.append({"role": "user", "content": user_msg})
-            messages.append({"role": "assistant", "content": assistant_msg})
-
-        messages.append({"role": "user", "content": user_prompt})
-
-        completion = self.api.chat.completions.create(
+    def stream_reply(self, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> Iterator[str]:
+        stream = self.api.chat.completions.create(  # type: ignore[union-attr]
             model=self.model,
-            messages=messages,
+            messages=self.chat_messages(system_prompt, user_prompt, history),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
+            stream=True,
         )
-        return completion.choices[0].message.content
\ No newline at end of file
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            # Only the final chunk carries usage
+            self._record_openai_usage(chunk.usage)
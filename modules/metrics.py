@@ -0,0 +1,304 @@
+"""
+In-process metrics, exported in the Prometheus text format at /metrics.
+
+Updates never take a lock. Every metric keeps one shard per thread, a plain dict that only
+its own thread writes to, and a scrape adds the shards up. Shards of threads that have
+exited are folded into a running total at scrape time, so per-request threads don't pile up.
+"""
+from __future__ import annotations
+import bisect
+import threading
+import time
+from typing import Any, Callable
+
+from flask import Flask, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Seconds
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+HASH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REGISTRY: list[_Metric | SnapshotCollector] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._local = threading.local()
+        self._shards: list[tuple[threading.Thread, dict]] = []
+        self._retired: dict = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _combine(self, a: Any, b: Any) -> Any:
+        return a + b
+
+    def collect(self) -> dict:
+        """
+        Sums every thread's shard into {label values: value}.
+        """
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                    continue
+                # Nobody writes to a dead thread's shard any more, so it can be merged for good
+                for key, value in shard.items():
+                    self._retired[key] = self._combine(self._retired[key], value) if key in self._retired else value
+            self._shards = live
+            totals = dict(self._retired)
+            shards = [shard.copy() for _, shard in live]
+        for shard in shards:
+            for key, value in shard.items():
+                totals[key] = self._combine(totals[key], value) if key in totals else value
+        return totals
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """
+    Up/down gauge. Each thread's shard holds its net change, so inc() and dec() may
+    happen on different threads.
+    """
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = HTTP_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        # Per-bucket (not cumulative) counts, then sum and count
+        cells = shard.get(labels)
+        if cells is None:
+            cells = shard[labels] = [0] * (len(self.buckets) + 3)
+        cells[bisect.bisect_left(self.buckets, value)] += 1
+        cells[-2] += value
+        cells[-1] += 1
+
+    def _combine(self, a: list, b: list) -> list:
+        return [x + y for x, y in zip(a, b)]
+
+    def collect(self) -> dict:
+        # Copy the cell lists too; their owners keep updating them in place
+        totals = super().collect()
+        return {key: list(cells) for key, cells in totals.items()}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, cells in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, cells):
+                cumulative += count
+                bucket = _labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            bucket = _labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket} {cells[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(cells[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cells[-1]}")
+        return lines
+
+
+class SnapshotCollector:
+    """
+    Exports a component's snapshot() at scrape time, for stats it already keeps itself.
+    Fields named in `counters` become <prefix>_<field>_total counters, the rest gauges. With
+    a label, snapshot() returns {label value: fields}. None means the component is off.
+    """
+    def __init__(self, prefix: str, documentation: str, snapshot: Callable[[], dict | None],
+                 counters: tuple[str, ...] = (), label: str | None = None):
+        self.prefix = prefix
+        self.documentation = documentation
+        self.snapshot = snapshot
+        self.counters = frozenset(counters)
+        self.labelnames = (label,) if label else ()
+        REGISTRY.append(self)
+
+    def _name(self, field: str) -> str:
+        name = f"{self.prefix}_{field}"
+        return name if field not in self.counters or name.endswith("_total") else name + "_total"
+
+    def render(self) -> list[str]:
+        snapshot = self.snapshot()
+        if not snapshot:
+            return []
+        rows = sorted(((key,), fields) for key, fields in snapshot.items()) if self.labelnames else [((), snapshot)]
+        samples: dict[str, list[str]] = {}
+        for key, fields in rows:
+            for field, value in fields.items():
+                samples.setdefault(field, []).append(
+                    f"{self._name(field)}{_labels(self.labelnames, key)} {_number(value)}"
+                )
+        lines: list[str] = []
+        for field, field_samples in samples.items():
+            kind = "counter" if field in self.counters else "gauge"
+            lines.append(f"# HELP {self._name(field)} {self.documentation}: {field.replace('_', ' ')}.")
+            lines.append(f"# TYPE {self._name(field)} {kind}")
+            lines.extend(field_samples)
+        return lines
+
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being handled.")
+HTTP_SECONDS = Histogram("http_request_seconds", "HTTP request duration by route.", ("route",), HTTP_BUCKETS)
+
+LLM_IN_FLIGHT = Gauge("llm_requests_in_flight", "Provider calls currently running.", ("provider",))
+LLM_REQUESTS = Counter("llm_requests_total", "Provider calls; reply-cache hits are not counted.", ("provider",))
+LLM_ERRORS = Counter("llm_errors_total", "Provider calls that failed, by exception type.", ("provider", "error"))
+LLM_SECONDS = Histogram("llm_request_seconds", "Provider call duration, retries included.", ("provider",), LLM_BUCKETS)
+LLM_FIRST_TOKEN_SECONDS = Histogram(
+    "llm_time_to_first_token_seconds", "Time until a streamed reply's first chunk.", ("provider",), LLM_BUCKETS
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Tokens reported by providers; kind is input, cached_input, cache_write or output.",
+    ("provider", "kind")
+)
+
+DB_QUERIES = Counter("db_queries_total", "SQL statements executed, by route.", ("route",))
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "SQL statement duration, by route.", ("route",), DB_BUCKETS)
+HISTORY_SAVE_SECONDS = Histogram(
+    "history_save_seconds", "Time a request waits for its chat history to be committed.", (), DB_BUCKETS
+)
+HISTORY_BATCH_SECONDS = Histogram(
+    "history_batch_commit_seconds", "Duration of one group commit in the history writer.", (), DB_BUCKETS
+)
+
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_seconds", "Password hash/verify duration, queueing included.", ("operation",), HASH_BUCKETS
+)
+
+
+class LLMCall:
+    """
+    Context manager around one provider call. Streams call first_token() on each chunk.
+    """
+    __slots__ = ("provider", "started", "first_token_seen")
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.started = 0.0
+        self.first_token_seen = False
+
+    def __enter__(self) -> LLMCall:
+        LLM_IN_FLIGHT.inc(self.provider)
+        self.started = time.perf_counter()
+        return self
+
+    def first_token(self) -> None:
+        if not self.first_token_seen:
+            self.first_token_seen = True
+            LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - self.started, self.provider)
+
+    def __exit__(self, exc_type, exc, _tb) -> None:
+        LLM_SECONDS.observe(time.perf_counter() - self.started, self.provider)
+        LLM_IN_FLIGHT.dec(self.provider)
+        LLM_REQUESTS.inc(self.provider)
+        # GeneratorExit (client went away mid-stream) isn't a provider failure
+        if exc_type is not None and issubclass(exc_type, Exception):
+            LLM_ERRORS.inc(self.provider, exc_type.__name__)
+
+
+def current_route() -> str:
+    if not has_request_context():
+        return "background"
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+def instrument_app(flask_app: Flask) -> None:
+    """
+    Tracks in-flight requests and per-route latency.
+    """
+    @flask_app.before_request
+    def start_timer() -> None:
+        g.metrics_started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+
+    @flask_app.teardown_request
+    def stop_timer(_error: BaseException | None) -> None:
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            HTTP_IN_FLIGHT.dec()
+            HTTP_SECONDS.observe(time.perf_counter() - started, current_route())
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Counts and times every statement the engine runs, labelled with the current route.
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, _cursor, _statement, _parameters, _context, _executemany) -> None:
+        conn.info.setdefault("metrics_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, _cursor, _statement, _parameters, _context, _executemany) -> None:
+        started = conn.info["metrics_query_started"].pop()
+        route = current_route()
+        DB_QUERIES.inc(route)
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started, route)
+
+    @event.listens_for(engine, "handle_error")
+    def failed_query(context) -> None:
+        # after_cursor_execute doesn't fire for a failed statement
+        conn = context.connection
+        if conn is not None and conn.info.get("metrics_query_started"):
+            conn.info["metrics_query_started"].pop()
@@ -0,0 +1,158 @@
+"""
+Versioned schema migrations for the SQLite database.
+
+The schema version lives in SQLite's `PRAGMA user_version`. Each migration runs in its own
+transaction and bumps the version when it commits, so a failed upgrade can simply be re-run.
+Migrations run at startup and via `flask migrate-db`.
+"""
+from __future__ import annotations
+import logging
+import sqlite3
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import Connection, Engine, event, text
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SqlitePragmas:
+    # Only takes effect on a new database file; existing ones need `flask vacuum-db --full`
+    auto_vacuum: str = "INCREMENTAL"
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024
+    # Negative values are KiB, per SQLite convention
+    cache_size: int = -64 * 1024
+    busy_timeout_ms: int = 10000
+
+
+def install_pragmas(engine: Engine, pragmas: SqlitePragmas) -> None:
+    """
+    Applies the pragmas to every new connection the engine opens.
+    """
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, _record) -> None:
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        # Must come before journal_mode, which writes the header of a new file
+        cursor.execute(f"PRAGMA auto_vacuum={pragmas.auto_vacuum}")
+        cursor.execute(f"PRAGMA journal_mode={pragmas.journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={pragmas.synchronous}")
+        cursor.execute(f"PRAGMA mmap_size={int(pragmas.mmap_size)}")
+        cursor.execute(f"PRAGMA cache_size={int(pragmas.cache_size)}")
+        cursor.execute(f"PRAGMA busy_timeout={int(pragmas.busy_timeout_ms)}")
+        cursor.close()
+
+
+def _index_foreign_keys(conn: Connection) -> None:
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_history_thread_id_id ON chat_history (thread_id, id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_threads_user_id_date_created "
+        "ON chat_threads (user_id, date_created)"
+    ))
+
+
+def _unique_user_email(conn: Connection) -> None:
+    duplicates = conn.execute(text(
+        "SELECT email, COUNT(*) FROM users GROUP BY email HAVING COUNT(*) > 1"
+    )).all()
+    if duplicates:
+        # Refuse to guess which account is the real one; an operator has to merge them
+        raise RuntimeError(
+            "Cannot add a unique index on users.email; duplicate emails: "
+            + ", ".join(email for email, _ in duplicates)
+        )
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_users_email ON users (email)"))
+
+
+def _analyze(conn: Connection) -> None:
+    # Gives the query planner statistics for the new indexes
+    conn.execute(text("ANALYZE"))
+
+
+def _search_index(conn: Connection) -> None:
+    # Contentless: the text stays compressed in chat_history; see modules/search_index.py
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5("
+        "user_input, model_response, owner, model, content='', tokenize='unicode61 remove_diacritics 2')"
+    ))
+    # Rows up to `upto` predate the index and are left to `flask backfill-search`; the history
+    # writer indexes everything newer
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS search_backfill ("
+        "id INTEGER PRIMARY KEY CHECK (id = 1), last_id INTEGER NOT NULL, upto INTEGER NOT NULL)"
+    ))
+    conn.execute(text(
+        "INSERT OR IGNORE INTO search_backfill (id, last_id, upto) "
+        "SELECT 1, 0, COALESCE(MAX(id), 0) FROM chat_history"
+    ))
+
+
+def _turn_tables(conn: Connection) -> None:
+    # Same DDL db.create_all() emits for ChatTurn and ChatResponse in modules/dbms.py
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS chat_turns (id INTEGER NOT NULL, thread_id INTEGER NOT NULL, "
+        "user_input BLOB NOT NULL, date_saved DATETIME NOT NULL, PRIMARY KEY (id), "
+        "FOREIGN KEY(thread_id) REFERENCES chat_threads (id))"
+    ))
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS chat_responses (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "
+        "turn_id INTEGER NOT NULL, thread_id INTEGER NOT NULL, model_name VARCHAR(100) NOT NULL, "
+        "model_response BLOB NOT NULL, latency_ms INTEGER, input_tokens INTEGER, output_tokens INTEGER, "
+        "FOREIGN KEY(turn_id) REFERENCES chat_turns (id), FOREIGN KEY(thread_id) REFERENCES chat_threads (id))"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_turns_thread_id_id ON chat_turns (thread_id, id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_responses_turn_id ON chat_responses (turn_id)"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_responses_thread_id_id ON chat_responses (thread_id, id)"
+    ))
+    # Rows move over from chat_history under their own ids (modules/turn_migration.py), so
+    # new responses must be numbered above every id chat_history has handed out
+    conn.execute(text(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'chat_responses', 0 "
+        "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'chat_responses')"
+    ))
+    conn.execute(text(
+        "UPDATE sqlite_sequence SET seq = MAX(seq, (SELECT COALESCE(MAX(id), 0) FROM chat_history), "
+        "(SELECT COALESCE(MAX(id), 0) FROM chat_responses)) WHERE name = 'chat_responses'"
+    ))
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "index chat_history.thread_id and chat_threads.user_id", _index_foreign_keys),
+    (2, "unique index on users.email", _unique_user_email),
+    (3, "collect planner statistics", _analyze),
+    (4, "full-text search index over chat history", _search_index),
+    (5, "turn and response tables, numbered above chat_history ids", _turn_tables),
+]
+
+
+def current_version(conn: Connection) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar_one()
+
+
+def pending(engine: Engine) -> list[tuple[int, str]]:
+    with engine.connect() as conn:
+        version = current_version(conn)
+    return [(number, description) for number, description, _ in MIGRATIONS if number > version]
+
+
+def migrate(engine: Engine) -> list[int]:
+    """
+    Applies every migration newer than the database's schema version. Returns the versions applied.
+    """
+    applied: list[int] = []
+    for number, description, apply in MIGRATIONS:
+        with engine.begin() as conn:
+            if current_version(conn) >= number:
+                continue
+            logger.info("Applying migration %d: %s", number, description)
+            apply(conn)
+            conn.execute(text(f"PRAGMA user_version = {int(number)}"))
+        applied.append(number)
+    return applied
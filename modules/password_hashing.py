@@ -0,0 +1,245 @@
+"""
+Password hashing off the request threads.
+
+Argon2 is deliberately slow and CPU bound, so hashing and verification run in a small process
+pool. Only a bounded number of jobs may be queued; once the pool is saturated new requests are
+rejected immediately with HashingBusy instead of queueing behind each other while the web
+workers that serve chat traffic wait.
+
+Workers are started with the spawn method, so a script that imports the app directly must keep
+its own code under `if __name__ == "__main__":` (`flask run` and WSGI servers already do).
+"""
+from __future__ import annotations
+import multiprocessing
+import statistics
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from passlib.hash import argon2
+
+from hashing_examples import UpdatedHasher
+from modules import metrics
+
+
+class HashingBusy(RuntimeError):
+    """Raised when too many hashing jobs are already queued."""
+
+
+@dataclass(frozen=True)
+class Argon2Params:
+    time_cost: int = 10
+    # KiB
+    memory_cost: int = 65536
+    parallelism: int = 4
+
+
+@dataclass
+class HashingStats:
+    completed: int = 0
+    rejected: int = 0
+    timeouts: int = 0
+    rehashed: int = 0
+
+
+# Set in each pool worker by _init_worker (and in this process when running inline)
+_worker_hasher: UpdatedHasher | None = None
+
+
+def _init_worker(pepper: bytes, params: Argon2Params) -> None:
+    global _worker_hasher
+    _worker_hasher = UpdatedHasher(pepper, params.time_cost, params.memory_cost, params.parallelism)
+
+
+def _hash_job(pwd: str) -> bytes:
+    assert _worker_hasher is not None
+    return _worker_hasher.hash(pwd)
+
+
+def _verify_job(pwd: str, pep_hash: bytes) -> tuple[bool, bool]:
+    assert _worker_hasher is not None
+    ok = _worker_hasher.check(pwd, pep_hash)
+    return ok, ok and _worker_hasher.needs_update(pep_hash)
+
+
+class PasswordHashingService:
+    """
+    Drop-in replacement for UpdatedHasher that runs the work in a process pool.
+    With workers=0 the work runs on the calling thread, which is handy for CLI commands.
+    """
+    def __init__(
+        self,
+        pepper: bytes,
+        params: Argon2Params = Argon2Params(),
+        workers: int = 2,
+        max_pending: int = 16,
+        timeout: float = 30.0,
+    ):
+        self.params = params
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.stats = HashingStats()
+        self._pepper = pepper
+        self._executor: ProcessPoolExecutor | None = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        if workers == 0:
+            _init_worker(pepper, params)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn rather than fork: the web process has live threads and sockets by now
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self._pepper, self.params),
+                )
+            return self._executor
+
+    def _release(self, _future: Future | None = None) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def _run(self, job: Callable[..., Any], *args: Any) -> Any:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.stats.rejected += 1
+                raise HashingBusy("Password hashing queue is full")
+            self._pending += 1
+
+        if self.workers == 0:
+            try:
+                result = job(*args)
+            finally:
+                self._release()
+            self._note_completed()
+            return result
+
+        try:
+            pool = self._pool()
+            future = pool.submit(job, *args)
+        except BrokenProcessPool:
+            self._release()
+            self._discard(pool)
+            raise
+        except BaseException:
+            self._release()
+            raise
+        # The slot stays taken until the worker is actually done, even if we stop waiting
+        future.add_done_callback(self._release)
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self.stats.timeouts += 1
+            raise
+        except BrokenProcessPool:
+            self._discard(pool)
+            raise
+        self._note_completed()
+        return result
+
+    def _discard(self, pool: ProcessPoolExecutor) -> None:
+        # A worker died (e.g. OOM killed); start a fresh pool on the next call, unless
+        # another caller already has
+        with self._lock:
+            if self._executor is not pool:
+                return
+            self._executor = None
+        # Reaps the surviving workers and fails whatever was still queued on them
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _note_completed(self) -> None:
+        with self._lock:
+            self.stats.completed += 1
+
+    def hash(self, pwd: str) -> bytes:
+        started = time.perf_counter()
+        pep_hash = self._run(_hash_job, pwd)
+        metrics.PASSWORD_HASH_SECONDS.observe(time.perf_counter() - started, "hash")
+        return pep_hash
+
+    def verify(self, pwd: str, pep_hash: bytes) -> tuple[bool, bool]:
+        """
+        Returns (matches, needs_rehash). needs_rehash is true when the stored hash was made
+        with argon2 parameters other than the current ones.
+        """
+        started = time.perf_counter()
+        result = self._run(_verify_job, pwd, pep_hash)
+        metrics.PASSWORD_HASH_SECONDS.observe(time.perf_counter() - started, "verify")
+        return result
+
+    def check(self, pwd: str, pep_hash: bytes) -> bool:
+        return self.verify(pwd, pep_hash)[0]
+
+    def note_rehash(self) -> None:
+        with self._lock:
+            self.stats.rehashed += 1
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "completed": self.stats.completed,
+                "rejected": self.stats.rejected,
+                "timeouts": self.stats.timeouts,
+                "rehashed": self.stats.rehashed,
+                "time_cost": self.params.time_cost,
+                "memory_cost": self.params.memory_cost,
+            }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def measure(params: Argon2Params, samples: int = 3) -> float:
+    """
+    Median milliseconds for one argon2 hash with the given parameters on this host.
+    """
+    hasher = argon2.using(rounds=params.time_cost, memory_cost=params.memory_cost, parallelism=params.parallelism)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hasher.hash("calibration password")
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def calibrate(
+    target_ms: float,
+    max_memory_cost: int,
+    parallelism: int = 4,
+    samples: int = 3,
+    max_time_cost: int = 50,
+) -> tuple[Argon2Params, float]:
+    """
+    Picks the strongest argon2 parameters whose hash time stays within target_ms.
+    Memory cost is preferred over time cost, as recommended for argon2id: memory is halved
+    from max_memory_cost until a single pass fits, then passes are added while they still fit.
+    """
+    memory_cost = max_memory_cost
+    params = Argon2Params(1, memory_cost, parallelism)
+    elapsed = measure(params, samples)
+    while elapsed > target_ms and memory_cost > 8 * parallelism:
+        memory_cost //= 2
+        params = Argon2Params(1, memory_cost, parallelism)
+        elapsed = measure(params, samples)
+
+    while params.time_cost < max_time_cost:
+        candidate = Argon2Params(params.time_cost + 1, memory_cost, parallelism)
+        candidate_ms = measure(candidate, samples)
+        if candidate_ms > target_ms:
+            break
+        params, elapsed = candidate, candidate_ms
+    return params, elapsed
@@ -0,0 +1,124 @@
+"""
+Declarative registry of the LLM providers the app can talk to.
+
+Each ProviderSpec names a client class in modules.llm_client, its default model and limits,
+and the environment variables its settings come from. Only providers with an API key are
+instantiated, and clients import their SDK when constructed, so a worker never loads an SDK
+it has no key for. LLM_PROVIDERS_FILE may point at a JSON list of specs that override
+built-in ones by name or add new ones, e.g.
+
+    [{"name": "GPT4O", "client": "GPTClient", "env": "GPT4O", "model": "gpt-4o",
+      "base_url_env": "OPENAI_BASE_URL", "max_concurrency": 4},
+     {"name": "GROK", "enabled": false}]
+"""
+from __future__ import annotations
+import dataclasses
+import json
+from dataclasses import dataclass
+from typing import Mapping
+
+from modules import llm_client
+from modules.llm_client import LLMClient
+
+
+@dataclass(frozen=True)
+class ProviderSpec:
+    # Display name, also used in /api/llm/<name> and per-provider settings
+    name: str
+    # Class name in modules.llm_client
+    client: str
+    # Prefix of <env>_API_KEY, <env>_MODEL, <env>_MAX_TOKENS and <env>_TEMPERATURE
+    env: str
+    model: str
+    max_tokens: int = 120
+    temperature: float = 0.2
+    base_url_env: str | None = None
+    # Endpoint when base_url_env isn't set; None uses the client class's own
+    base_url: str | None = None
+    # Cap on this provider's in-flight calls; None uses LLM_MAX_CONCURRENCY
+    max_concurrency: int | None = None
+    enabled: bool = True
+
+
+@dataclass(frozen=True)
+class ProviderConfig:
+    """A spec with its environment applied."""
+    name: str
+    client: str
+    model: str
+    key: str | None
+    max_tokens: int
+    temperature: float
+    base_url: str | None
+    max_concurrency: int | None
+
+
+DEFAULT_PROVIDERS: tuple[ProviderSpec, ...] = (
+    ProviderSpec("CHATGPT", "GPTClient", "OPENAI", "gpt-3.5-turbo", base_url_env="OPENAI_BASE_URL"),
+    ProviderSpec("GEMINI", "GeminiClient", "GEMINI", "gemini-2.0-flash", base_url_env="GEMINI_BASE_URL"),
+    ProviderSpec("CLAUDE", "ClaudeClient", "CLAUDE", "claude-3-haiku-20240307", base_url_env="ANTHROPIC_BASE_URL"),
+    ProviderSpec("GROK", "GrokClient", "GROK", "grok-3-mini", base_url_env="XAI_BASE_URL"),
+    ProviderSpec("DEEPSEEK", "GPTClient", "DEEPSEEK", "deepseek-chat", base_url_env="DEEPSEEK_BASE_URL",
+                 base_url=llm_client.DEEPSEEK_URL),
+    ProviderSpec("MISTRAL", "MistralClient", "MISTRAL", "mistral-large-latest", base_url_env="MISTRAL_BASE_URL"),
+    ProviderSpec("LLAMA", "TogetherClient", "LLAMA", "meta-llama/Llama-3.3-70B-Instruct-Turbo",
+                 base_url_env="TOGETHER_BASE_URL"),
+    ProviderSpec("QWEN", "TogetherClient", "QWEN", "Qwen/Qwen2.5-7B-Instruct-Turbo",
+                 base_url_env="TOGETHER_BASE_URL"),
+)
+
+
+def load_specs(path: str | None = None) -> list[ProviderSpec]:
+    """
+    The built-in specs, with the entries of the JSON file at path merged in by name.
+    """
+    specs = {spec.name: spec for spec in DEFAULT_PROVIDERS}
+    if path:
+        with open(path, encoding="utf-8") as fin:
+            entries = json.load(fin)
+        for entry in entries:
+            name = str(entry["name"]).upper()
+            fields = {key: value for key, value in entry.items() if key != "name"}
+            unknown = set(fields) - {f.name for f in dataclasses.fields(ProviderSpec)}
+            if unknown:
+                raise ValueError(f"Unknown provider settings for {name}: {', '.join(sorted(unknown))}")
+            if name in specs:
+                specs[name] = dataclasses.replace(specs[name], **fields)
+            else:
+                specs[name] = ProviderSpec(name=name, **fields)
+    return [spec for spec in specs.values() if spec.enabled]
+
+
+def resolve(specs: list[ProviderSpec], environ: Mapping[str, str]) -> list[ProviderConfig]:
+    """
+    Applies environment overrides to each spec. Providers without an API key are kept, with
+    key=None, so callers can tell "not configured" apart from "unknown".
+    """
+    return [
+        ProviderConfig(
+            name=spec.name,
+            client=spec.client,
+            model=environ.get(f"{spec.env}_MODEL") or spec.model,
+            key=environ.get(f"{spec.env}_API_KEY") or None,
+            max_tokens=int(environ.get(f"{spec.env}_MAX_TOKENS") or spec.max_tokens),
+            temperature=float(environ.get(f"{spec.env}_TEMPERATURE") or spec.temperature),
+            base_url=(environ.get(spec.base_url_env) if spec.base_url_env else None) or spec.base_url,
+            max_concurrency=spec.max_concurrency,
+        )
+        for spec in specs
+    ]
+
+
+def create_client(config: ProviderConfig) -> LLMClient:
+    client_class = getattr(llm_client, config.client, None)
+    if not (isinstance(client_class, type) and issubclass(client_class, LLMClient)):
+        raise ValueError(f"{config.name}: {config.client} is not an LLM client class")
+    if client_class is llm_client.GrokClient and config.base_url:
+        # The xAI SDK only speaks gRPC to its own host; other endpoints go through the REST API
+        client_class = llm_client.GrokRestClient
+    if client_class is llm_client.GrokClient:
+        client = client_class(config.model, config.max_tokens, config.temperature, config.key)
+    else:
+        client = client_class(config.model, config.max_tokens, config.temperature, config.key, config.base_url)
+    client.name = config.name
+    return client
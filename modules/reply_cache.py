@@ -0,0 +1,161 @@
+from __future__ import annotations
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from modules.llm_client import LLMClient
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    persistent_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    bypassed: int = 0
+    purged: int = 0
+
+
+class ReplyCache:
+    """
+    LRU + TTL cache of LLM replies with an optional SQLite tier that survives restarts.
+    Keys cover everything that shapes a reply: provider, model, sampling settings,
+    system prompt, history and prompt. Expired rows of the SQLite tier are purged by put()
+    at most every purge_interval seconds.
+    """
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        db_path: str | None = None,
+        max_temperature: float = 0.5,
+        disabled_providers: set[str] | None = None,
+        purge_interval: float = 300.0,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_temperature = max_temperature
+        self.disabled_providers = {name.upper() for name in (disabled_providers or set())}
+        self.stats = CacheStats()
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+
+        self._db: sqlite3.Connection | None = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS reply_cache ("
+                " key TEXT PRIMARY KEY, reply TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS reply_cache_expires ON reply_cache (expires)")
+
+    def enabled_for(self, client: LLMClient) -> bool:
+        """
+        Providers can opt out by name, and high-temperature configs are never cached since
+        a repeated prompt is expected to give a different answer.
+        """
+        return (
+            self.max_entries > 0
+            and client.name not in self.disabled_providers
+            and client.temperature <= self.max_temperature
+        )
+
+    def note_bypass(self) -> None:
+        with self._lock:
+            self.stats.bypassed += 1
+
+    @staticmethod
+    def key(client: LLMClient, system_prompt: str, user_prompt: str, history: list[tuple[str, str]]) -> str:
+        material = json.dumps([
+            client.name, client.model, client.temperature, client.max_tokens,
+            system_prompt, [list(turn) for turn in history], user_prompt,
+        ])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, reply = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.stats.hits += 1
+                    return reply
+                del self._entries[key]
+                self.stats.expirations += 1
+
+        row = self._db_get(key)
+        with self._lock:
+            if row is None:
+                self.stats.misses += 1
+                return None
+            reply, expires = row
+            self.stats.persistent_hits += 1
+            # Keeps the stored expiry rather than starting a fresh TTL
+            self._insert(key, reply, now + (expires - time.time()))
+        return reply
+
+    def put(self, key: str, reply: str) -> None:
+        with self._lock:
+            self._insert(key, reply, time.monotonic() + self.ttl_seconds)
+        if self._db is not None:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO reply_cache (key, reply, expires) VALUES (?, ?, ?)",
+                    (key, reply, time.time() + self.ttl_seconds),
+                )
+            if time.monotonic() >= self._next_purge:
+                self.purge_expired()
+
+    def _insert(self, key: str, reply: str, expires: float) -> None:
+        # Caller holds the lock; expires is on the monotonic clock
+        self._entries[key] = (expires, reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def _db_get(self, key: str) -> tuple[str, float] | None:
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT reply, expires FROM reply_cache WHERE key = ? AND expires > ?",
+                (key, time.time()),
+            ).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def purge_expired(self) -> int:
+        """
+        Drops expired rows from the persistent tier. Returns how many were removed.
+        """
+        if self._db is None:
+            return 0
+        with self._lock:
+            self._next_purge = time.monotonic() + self.purge_interval
+            cur = self._db.execute("DELETE FROM reply_cache WHERE expires <= ?", (time.time(),))
+            self.stats.purged += cur.rowcount
+        return cur.rowcount
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.stats.hits,
+                "persistent_hits": self.stats.persistent_hits,
+                "misses": self.stats.misses,
+                "evictions": self.stats.evictions,
+                "expirations": self.stats.expirations,
+                "bypassed": self.stats.bypassed,
+                "purged": self.stats.purged,
+            }
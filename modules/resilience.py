@@ -0,0 +1,426 @@
+"""
+Per-provider guard rails around LLM calls.
+
+Every provider gets its own concurrency limit, deadline, retry policy and circuit breaker,
+so a slow or failing vendor only ever uses its own share of workers: callers wait a bounded
+time for a slot, retry 429/5xx with jittered exponential backoff, and fail fast with
+ProviderUnavailable while the provider's breaker is open. Optionally a duplicate (hedged)
+request is sent when the first one is slower than the provider's recent p95.
+"""
+from __future__ import annotations
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ProviderUnavailable(RuntimeError):
+    """The provider is degraded (breaker open, no free slot, or out of time); try again later."""
+    def __init__(self, provider: str, reason: str):
+        super().__init__(f"{provider} is temporarily unavailable: {reason}")
+        self.provider = provider
+        self.reason = reason
+
+
+@dataclass
+class ResiliencePolicy:
+    max_concurrency: int = 8
+    # How long a call may wait for a free slot before failing fast
+    acquire_timeout: float = 2.0
+    # Total time budget for a call, retries included
+    deadline: float = 45.0
+    max_retries: int = 2
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    breaker_failures: int = 5
+    breaker_reset: float = 30.0
+    hedge: bool = False
+    hedge_min_delay: float = 1.0
+    # Latency samples needed before hedging kicks in
+    hedge_min_samples: int = 20
+
+
+def status_code_of(error: BaseException) -> int | None:
+    """
+    Best-effort HTTP status of a provider SDK error. The SDKs disagree on where they keep it.
+    """
+    for attr in ("status_code", "code", "status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Rate limits, server errors, timeouts and dropped connections are worth retrying;
+    anything else (bad request, auth) will fail the same way again.
+    """
+    if isinstance(error, ProviderUnavailable):
+        return False
+    status = status_code_of(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # SDK-specific timeout/connection errors don't share a base class beyond Exception
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def _retry_after(error: BaseException) -> float | None:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive retryable failures; after `reset` seconds one probe
+    call is let through (half-open) and its outcome closes or re-opens the breaker.
+    """
+    def __init__(self, failures: int, reset: float):
+        self.failures = failures
+        self.reset = reset
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.reset else "open"
+
+    def admit(self) -> bool | None:
+        """
+        None if the call must be rejected, otherwise whether it is the half-open probe.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at < self.reset or self._probe_in_flight:
+                return None
+            self._probe_in_flight = True
+            return True
+
+    def allow(self) -> bool:
+        return self.admit() is not None
+
+    def release_probe(self) -> None:
+        """
+        Gives up a half-open probe that never reached the provider or was abandoned
+        before it had an outcome.
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.opened_at is not None or self.consecutive_failures >= self.failures:
+                self.opened_at = time.monotonic()
+
+
+@dataclass
+class GuardStats:
+    calls: int = 0
+    successes: int = 0
+    failures: int = 0
+    retries: int = 0
+    rejected: int = 0
+    deadline_exceeded: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=200))
+
+
+# Runs sync attempts so the caller can stop waiting at the deadline or race a hedge
+_attempt_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="llm-attempt")
+
+
+class ProviderGuard:
+    def __init__(self, name: str, policy: ResiliencePolicy):
+        self.name = name
+        self.policy = policy
+        self.breaker = CircuitBreaker(policy.breaker_failures, policy.breaker_reset)
+        self.stats = GuardStats()
+        self._slots = threading.BoundedSemaphore(policy.max_concurrency)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    # --- bookkeeping ---
+
+    def _acquire(self, timeout: float) -> bool:
+        if not self._slots.acquire(timeout=max(0.0, timeout)):
+            return False
+        with self._lock:
+            self._in_flight += 1
+        return True
+
+    def _release(self, _future: Any = None) -> None:
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _admit(self) -> bool:
+        """
+        Counts the call and checks the breaker. Returns whether the call is the half-open probe.
+        """
+        with self._lock:
+            self.stats.calls += 1
+        probe = self.breaker.admit()
+        if probe is None:
+            with self._lock:
+                self.stats.rejected += 1
+            raise ProviderUnavailable(self.name, "circuit breaker is open")
+        return probe
+
+    def _reject_busy(self) -> ProviderUnavailable:
+        with self._lock:
+            self.stats.rejected += 1
+        # A saturated provider isn't necessarily failing, so this doesn't trip the breaker
+        self.breaker.release_probe()
+        return ProviderUnavailable(self.name, "too many requests in flight")
+
+    def _succeeded(self, elapsed: float) -> None:
+        self.breaker.record_success()
+        with self._lock:
+            self.stats.successes += 1
+            self.stats.latencies.append(elapsed)
+
+    def _failed(self, error: BaseException) -> None:
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            # The provider answered; it just didn't like the request
+            self.breaker.record_success()
+        with self._lock:
+            self.stats.failures += 1
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        delay = min(self.policy.backoff_max, self.policy.backoff_base * (2 ** attempt))
+        # Full jitter spreads retries from many callers across the window
+        delay = random.uniform(0, delay)
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.policy.backoff_max))
+        return delay
+
+    def p95(self) -> float | None:
+        with self._lock:
+            samples = sorted(self.stats.latencies)
+        if len(samples) < self.policy.hedge_min_samples:
+            return None
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def _hedge_delay(self) -> float | None:
+        if not self.policy.hedge:
+            return None
+        p95 = self.p95()
+        return None if p95 is None else max(self.policy.hedge_min_delay, p95)
+
+    # --- sync calls ---
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """
+        Runs fn under this provider's limits. Raises ProviderUnavailable when the provider is
+        degraded, otherwise the last error once retries or the deadline run out.
+        """
+        self._admit()
+        deadline = time.monotonic() + self.policy.deadline
+        attempt = 0
+        while True:
+            try:
+                return self._attempt(fn, deadline)
+            except ProviderUnavailable:
+                raise
+            except Exception as e:
+                self._failed(e)
+                remaining = deadline - time.monotonic()
+                if attempt >= self.policy.max_retries or not is_retryable(e):
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay >= remaining:
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.stats.retries += 1
+                logger.info("%s call failed (%s); retry %d in %.2fs", self.name, e, attempt, delay)
+                time.sleep(delay)
+
+    def _start(self, fn: Callable[[], T], timeout: float) -> Future | None:
+        if not self._acquire(timeout):
+            return None
+        started = time.monotonic()
+        future = _attempt_executor.submit(fn)
+        future.started = started  # type: ignore[attr-defined]
+        # The slot is held until the provider call really ends, even if we stop waiting
+        future.add_done_callback(self._release)
+        return future
+
+    def _attempt(self, fn: Callable[[], T], deadline: float) -> T:
+        remaining = deadline - time.monotonic()
+        first = self._start(fn, min(self.policy.acquire_timeout, remaining))
+        if first is None:
+            raise self._reject_busy()
+        futures = [first]
+
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is not None and hedge_delay < remaining:
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                # Only hedge with a spare slot; never queue behind our own traffic
+                hedge = self._start(fn, 0)
+                if hedge is not None:
+                    futures.append(hedge)
+                    with self._lock:
+                        self.stats.hedges += 1
+
+        error: BaseException | None = None
+        pending = list(futures)
+        while pending:
+            done, not_done = wait(pending, timeout=deadline - time.monotonic(), return_when=FIRST_COMPLETED)
+            if not done:
+                with self._lock:
+                    self.stats.deadline_exceeded += 1
+                self.breaker.record_failure()
+                raise ProviderUnavailable(self.name, f"no reply within {self.policy.deadline:.0f}s")
+            for future in done:
+                if future.exception() is None:
+                    for other in not_done:
+                        other.cancel()
+                    self._succeeded(time.monotonic() - future.started)  # type: ignore[attr-defined]
+                    if future is not first:
+                        with self._lock:
+                            self.stats.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+            pending = list(not_done)
+        assert error is not None
+        raise error
+
+    def stream(self, open_stream: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        Streams under this provider's limits. Failures before the first chunk are retried;
+        once text has been sent a failure is final. The slot is held for the whole stream,
+        and the deadline covers all of it.
+        """
+        probe = self._admit()
+        deadline = time.monotonic() + self.policy.deadline
+        if not self._acquire(min(self.policy.acquire_timeout, self.policy.deadline)):
+            raise self._reject_busy()
+        try:
+            attempt = 0
+            while True:
+                started = time.monotonic()
+                sent_any = False
+                try:
+                    for chunk in open_stream():
+                        if time.monotonic() > deadline:
+                            with self._lock:
+                                self.stats.deadline_exceeded += 1
+                            self.breaker.record_failure()
+                            raise ProviderUnavailable(self.name, f"reply not finished within {self.policy.deadline:.0f}s")
+                        sent_any = True
+                        yield chunk
+                    self._succeeded(time.monotonic() - started)
+                    return
+                except ProviderUnavailable:
+                    raise
+                except Exception as e:
+                    self._failed(e)
+                    delay = self._backoff(attempt, e)
+                    if (sent_any or attempt >= self.policy.max_retries or not is_retryable(e)
+                            or delay >= deadline - time.monotonic()):
+                        raise
+                    attempt += 1
+                    with self._lock:
+                        self.stats.retries += 1
+                    time.sleep(delay)
+        finally:
+            self._release()
+            # A consumer that stops reading (GeneratorExit) leaves no outcome to record
+            if probe:
+                self.breaker.release_probe()
+
+    # --- reporting ---
+
+    def status(self) -> str:
+        # A single failed call isn't an outage; only an open or probing breaker is
+        return {"closed": "ok", "open": "down", "half-open": "recovering"}[self.breaker.state]
+
+    def snapshot(self) -> dict[str, Any]:
+        p95 = self.p95()
+        with self._lock:
+            return {
+                "status": self.status(),
+                "breaker": self.breaker.state,
+                "in_flight": self._in_flight,
+                "max_concurrency": self.policy.max_concurrency,
+                "calls": self.stats.calls,
+                "successes": self.stats.successes,
+                "failures": self.stats.failures,
+                "retries": self.stats.retries,
+                "rejected": self.stats.rejected,
+                "deadline_exceeded": self.stats.deadline_exceeded,
+                "hedges": self.stats.hedges,
+                "hedge_wins": self.stats.hedge_wins,
+                "p95_ms": None if p95 is None else round(p95 * 1000, 1),
+            }
+
+
+_default_policy = ResiliencePolicy()
+_overrides: dict[str, ResiliencePolicy] = {}
+_guards: dict[str, ProviderGuard] = {}
+_guards_lock = threading.Lock()
+
+
+def configure(default: ResiliencePolicy, overrides: dict[str, ResiliencePolicy] | None = None) -> None:
+    """
+    Sets the policy for every provider, with optional per-provider overrides keyed by client name.
+    """
+    global _default_policy, _overrides
+    with _guards_lock:
+        _default_policy = default
+        _overrides = {name.upper(): policy for name, policy in (overrides or {}).items()}
+        _guards.clear()
+
+
+def guard(provider: str) -> ProviderGuard:
+    with _guards_lock:
+        existing = _guards.get(provider)
+        if existing is None:
+            existing = ProviderGuard(provider, _overrides.get(provider, _default_policy))
+            _guards[provider] = existing
+        return existing
+
+
+def provider_status() -> dict[str, dict[str, Any]]:
+    with _guards_lock:
+        guards = list(_guards.values())
+    return {g.name: g.snapshot() for g in guards}
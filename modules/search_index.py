@@ -0,0 +1,334 @@
+"""
+Full-text search over chat history.
+
+History text is stored compressed, so SQLite can't search the history tables themselves.
+Instead a contentless FTS5 table, chat_history_fts, is kept next to them with the response id
+as its rowid: it holds the inverted index but no second copy of the text, and snippets are cut from
+the decoded rows of the page being returned. Every row is also indexed under its owner
+("u<user id>") and model, so a query intersects with one user's postings instead of
+filtering everybody's matches afterwards.
+
+A contentless table can only forget a row when given the text it was indexed with, so
+history must be deleted through remove_threads(), which decodes the rows first. Messages of
+archived threads (modules/archive.py) stay searchable: they are indexed at the negated id of
+their archived_messages row, and hits on them are served from the thread's segment.
+"""
+from __future__ import annotations
+import html
+import re
+from dataclasses import dataclass
+from typing import Iterable
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from modules import dbms
+from modules.dbms import ArchivedMessage, ArchivedThread, ChatHistory, ChatResponse, ChatThread, ChatTurn
+
+TABLE = "chat_history_fts"
+
+# (response id, user id, model name, prompt, reply)
+IndexRow = tuple[int, int, str, str, str]
+
+_INSERT = text(
+    f"INSERT INTO {TABLE} (rowid, user_input, model_response, owner, model) "
+    "VALUES (:id, :user_input, :model_response, :owner, :model)"
+)
+_DELETE = text(
+    f"INSERT INTO {TABLE} ({TABLE}, rowid, user_input, model_response, owner, model) "
+    "VALUES ('delete', :id, :user_input, :model_response, :owner, :model)"
+)
+# Owner and model only filter; they shouldn't move the ranking
+_SEARCH = text(
+    f"SELECT rowid, bm25({TABLE}, 1.0, 1.0, 0.0, 0.0) AS score FROM {TABLE} "
+    f"WHERE {TABLE} MATCH :match ORDER BY score LIMIT :limit OFFSET :offset"
+)
+
+# Characters of context kept around the first hit in a snippet
+SNIPPET_CHARS = 160
+
+_QUERY_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def _params(rows: Iterable[IndexRow]) -> list[dict]:
+    return [
+        {"id": row_id, "user_input": prompt, "model_response": reply, "owner": f"u{user_id}", "model": model_name}
+        for row_id, user_id, model_name, prompt, reply in rows
+    ]
+
+
+def index_rows(session: Session, rows: Iterable[IndexRow]) -> None:
+    """
+    Adds history rows to the index inside the caller's transaction.
+    """
+    params = _params(rows)
+    if params:
+        session.execute(_INSERT, params)
+
+
+def remove_rows(session: Session, rows: Iterable[IndexRow]) -> None:
+    """
+    Drops rows from the index. They must carry exactly the text they were indexed with.
+    """
+    params = _params(rows)
+    if params:
+        session.execute(_DELETE, params)
+
+
+def archived_rows(session: Session, thread_ids: list[int]) -> list[IndexRow]:
+    """
+    Index entries of archived threads, which live at -(archived_messages id).
+    """
+    entries = session.execute(
+        dbms.db.select(ArchivedMessage.id, ArchivedMessage.thread_id, ArchivedMessage.position)
+        .where(ArchivedMessage.thread_id.in_(thread_ids))
+    ).all()
+    if not entries:
+        return []
+    segments = _segments(session, {thread_id for _, thread_id, _ in entries})
+    rows = []
+    for message_id, thread_id, position in entries:
+        user_id, _, messages = segments[thread_id]
+        _, model_name, prompt, reply, _, _ = messages[position]
+        rows.append((-message_id, user_id, model_name, prompt, reply))
+    return rows
+
+
+def remove_threads(session: Session, thread_ids: list[int]) -> None:
+    """
+    Drops the threads' rows, hot or archived, from the index inside the caller's
+    transaction. Call it before the rows themselves are deleted.
+    """
+    hot = session.execute(
+        dbms.db.select(ChatResponse.id, ChatResponse.turn_id, ChatThread.user_id, ChatResponse.model_name,
+                       ChatTurn._user_input, ChatResponse._model_response)
+        .join(ChatTurn, ChatTurn.id == ChatResponse.turn_id)
+        .join(ChatThread, ChatThread.id == ChatResponse.thread_id)
+        .where(ChatResponse.thread_id.in_(thread_ids))
+    ).all()
+    legacy = session.execute(
+        dbms.db.select(ChatHistory.id, ChatThread.user_id, ChatHistory.model_name,
+                       ChatHistory._user_input, ChatHistory._model_response)
+        .join(ChatThread, ChatThread.id == ChatHistory.thread_id)
+        .where(ChatHistory.thread_id.in_(thread_ids))
+    ).all()
+    # Rows the backfill hasn't reached aren't in the index, and deleting them would corrupt it
+    last_id, upto = backfill_progress(session)
+    prompt_of = dbms.PromptDecoder()
+    remove_rows(session, (
+        (row.id, row.user_id, row.model_name, prompt_of(row), dbms.db_decode_text(row._model_response))
+        for row in hot
+        if row.id <= last_id or row.id > upto
+    ))
+    remove_rows(session, (
+        (row_id, user_id, model_name, dbms.db_decode_text(prompt), dbms.db_decode_text(reply))
+        for row_id, user_id, model_name, prompt, reply in legacy
+        if row_id <= last_id or row_id > upto
+    ))
+    remove_rows(session, archived_rows(session, thread_ids))
+
+
+def _segments(session: Session, thread_ids: Iterable[int]) -> dict[int, tuple[int, str, list[dbms.SegmentMessage]]]:
+    """
+    Decoded segments of archived threads: {thread id: (user id, thread name, messages)}.
+    """
+    rows = session.execute(
+        dbms.db.select(ArchivedThread.thread_id, ChatThread.user_id, ChatThread.thread_name, ArchivedThread.segment)
+        .join(ChatThread, ChatThread.id == ArchivedThread.thread_id)
+        .where(ArchivedThread.thread_id.in_(list(thread_ids)))
+    ).all()
+    return {
+        thread_id: (user_id, thread_name, dbms.decode_segment(segment))
+        for thread_id, user_id, thread_name, segment in rows
+    }
+
+
+@dataclass(frozen=True)
+class Term:
+    words: tuple[str, ...]
+    prefix: bool
+
+
+def parse_query(query: str) -> list[Term]:
+    """
+    Splits a search box query into terms. "Quoted text" is a phrase and a trailing * makes
+    the last word a prefix; every other character is only a word separator, so user input
+    can never reach FTS5's query syntax.
+    """
+    terms = []
+    for phrase, word in _QUERY_TERM.findall(query):
+        raw = phrase or word
+        words = tuple(re.findall(r"\w+", raw.lower()))
+        if words:
+            terms.append(Term(words, prefix=raw.endswith("*") and not phrase))
+    return terms
+
+
+def match_expression(terms: list[Term], user_id: int, model: str | None = None) -> str:
+    def quoted(term: Term) -> str:
+        return '"' + " ".join(term.words) + '"' + ("*" if term.prefix else "")
+
+    parts = [f'owner : "u{user_id}"']
+    if model:
+        parts.append('model : "' + " ".join(re.findall(r"\w+", model.lower())) + '"')
+    parts.append("{user_input model_response} : (" + " AND ".join(quoted(term) for term in terms) + ")")
+    return " AND ".join(parts)
+
+
+def _highlighter(terms: list[Term]) -> re.Pattern:
+    patterns = []
+    for term in terms:
+        pattern = r"\W+".join(re.escape(word) for word in term.words)
+        patterns.append(r"\b" + pattern + (r"\w*" if term.prefix else r"\b"))
+    return re.compile("|".join(patterns), re.IGNORECASE)
+
+
+def snippet(value: str, highlighter: re.Pattern, width: int = SNIPPET_CHARS) -> str:
+    """
+    HTML-escaped excerpt of value around its first hit, with hits wrapped in <mark>.
+    """
+    first = highlighter.search(value)
+    start = 0
+    if first is not None and first.start() > width // 3:
+        start = value.rfind(" ", 0, first.start() - width // 3) + 1
+    end = min(len(value), start + width)
+    if end < len(value):
+        space = value.rfind(" ", start, end)
+        if space > start:
+            end = space
+    window = value[start:end]
+
+    parts = ["…" if start > 0 else ""]
+    last = 0
+    for hit in highlighter.finditer(window):
+        parts.append(html.escape(window[last:hit.start()]))
+        parts.append("<mark>" + html.escape(hit.group()) + "</mark>")
+        last = hit.end()
+    parts.append(html.escape(window[last:]))
+    parts.append("…" if end < len(value) else "")
+    return "".join(parts)
+
+
+def search(session: Session, user_id: int, query: str, model: str | None = None,
+           limit: int = 20, offset: int = 0) -> tuple[list[dict], int | None]:
+    """
+    One page of the user's history rows matching query, best first. Returns the results
+    and the offset of the next page, or None on the last one.
+    """
+    terms = parse_query(query)
+    if not terms:
+        return [], None
+    ranked = session.execute(_SEARCH, {
+        "match": match_expression(terms, user_id, model), "limit": limit + 1, "offset": offset,
+    }).all()
+    next_offset = offset + limit if len(ranked) > limit else None
+    scores = {row_id: score for row_id, score in ranked[:limit]}
+    if not scores:
+        return [], next_offset
+
+    hot_ids = [row_id for row_id in scores if row_id > 0]
+    rows = session.execute(
+        dbms.db.select(ChatResponse.id, ChatResponse.turn_id, ChatResponse.thread_id, ChatThread.thread_name,
+                       ChatResponse.model_name, ChatTurn._user_input, ChatResponse._model_response,
+                       ChatTurn.date_saved)
+        .join(ChatTurn, ChatTurn.id == ChatResponse.turn_id)
+        .join(ChatThread, ChatThread.id == ChatResponse.thread_id)
+        .where(ChatResponse.id.in_(hot_ids), ChatThread.user_id == user_id)
+    ).all()
+    prompt_of = dbms.PromptDecoder()
+    hits = [
+        (row.id, row.id, row.thread_id, row.thread_name, row.model_name,
+         prompt_of(row), dbms.db_decode_text(row._model_response), row.date_saved, False)
+        for row in rows
+    ]
+    if len(rows) < len(hot_ids):
+        # Rows of threads not yet moved to the turn schema
+        legacy = session.execute(
+            dbms.db.select(ChatHistory.id, ChatHistory.thread_id, ChatThread.thread_name, ChatHistory.model_name,
+                           ChatHistory._user_input, ChatHistory._model_response, ChatHistory.date_saved)
+            .join(ChatThread, ChatThread.id == ChatHistory.thread_id)
+            .where(ChatHistory.id.in_(hot_ids), ChatThread.user_id == user_id)
+        ).all()
+        hits.extend(
+            (row.id, row.id, row.thread_id, row.thread_name, row.model_name,
+             dbms.db_decode_text(row._user_input), dbms.db_decode_text(row._model_response), row.date_saved, False)
+            for row in legacy
+        )
+
+    archived = session.execute(
+        dbms.db.select(ArchivedMessage.id, ArchivedMessage.thread_id, ArchivedMessage.position)
+        .where(ArchivedMessage.id.in_([-row_id for row_id in scores if row_id < 0]))
+    ).all()
+    if archived:
+        segments = _segments(session, {thread_id for _, thread_id, _ in archived})
+        for message_id, thread_id, position in archived:
+            owner, thread_name, messages = segments[thread_id]
+            if owner == user_id:
+                original_id, model_name, prompt, reply, saved, _ = messages[position]
+                hits.append((-message_id, original_id, thread_id, thread_name, model_name, prompt, reply, saved, True))
+
+    highlighter = _highlighter(terms)
+    results = [
+        {
+            "id": row_id,
+            "thread_id": thread_id,
+            "thread_name": thread_name,
+            "model_name": model_name,
+            "date_saved": saved.strftime('%Y-%m-%d %H:%M:%S'),
+            "archived": is_archived,
+            "score": -scores[key],
+            "prompt_snippet": snippet(prompt, highlighter),
+            "response_snippet": snippet(reply, highlighter),
+        }
+        for key, row_id, thread_id, thread_name, model_name, prompt, reply, saved, is_archived in hits
+    ]
+    results.sort(key=lambda result: result["score"], reverse=True)
+    return results, next_offset
+
+
+def backfill_progress(session: Session) -> tuple[int, int]:
+    """
+    (last id backfilled, last id to backfill). Rows in between aren't indexed yet.
+    """
+    last_id, upto = session.execute(text("SELECT last_id, upto FROM search_backfill")).one()
+    return last_id, upto
+
+
+def backfill_batch(session: Session, batch_size: int) -> tuple[int, int, int]:
+    """
+    Indexes the next batch of rows written before the index existed and commits. Returns
+    (rows indexed, last id done, last id to do); progress is kept in search_backfill, so an
+    interrupted backfill continues where it stopped.
+    """
+    last_id, upto = backfill_progress(session)
+    # A row in range may have been moved to the turn schema or not yet; it keeps its id either way
+    rows = session.execute(
+        dbms.db.select(ChatResponse.id, ChatThread.user_id, ChatResponse.model_name,
+                       ChatTurn._user_input, ChatResponse._model_response)
+        .join(ChatTurn, ChatTurn.id == ChatResponse.turn_id)
+        .join(ChatThread, ChatThread.id == ChatResponse.thread_id)
+        .where(ChatResponse.id > last_id, ChatResponse.id <= upto)
+        .order_by(ChatResponse.id)
+        .limit(batch_size)
+    ).all()
+    rows += session.execute(
+        dbms.db.select(ChatHistory.id, ChatThread.user_id, ChatHistory.model_name,
+                       ChatHistory._user_input, ChatHistory._model_response)
+        .join(ChatThread, ChatThread.id == ChatHistory.thread_id)
+        .where(ChatHistory.id > last_id, ChatHistory.id <= upto)
+        .order_by(ChatHistory.id)
+        .limit(batch_size)
+    ).all()
+    rows = sorted(rows, key=lambda row: row[0])[:batch_size]
+    if rows:
+        # Rows are decoded one batch at a time, so memory stays flat however big the table is
+        index_rows(session, (
+            (row_id, user_id, model_name, dbms.db_decode_text(prompt), dbms.db_decode_text(reply))
+            for row_id, user_id, model_name, prompt, reply in rows
+        ))
+        last_id = rows[-1][0]
+    else:
+        last_id = upto
+    session.execute(text("UPDATE search_backfill SET last_id = :last_id"), {"last_id": last_id})
+    session.commit()
+    return len(rows), last_id, upto
@@ -0,0 +1,215 @@
+"""
+Fingerprinted, precompressed static assets.
+
+`flask build-assets` has esbuild bundle each page script with its imports and minify the
+scripts and styles, and writes them to static/dist under names carrying a hash of their
+content, next to gzip and brotli copies and a manifest mapping "scripts/app.js" to
+"dist/scripts/app.<hash>.js".
+Templates keep calling url_for('static', filename='scripts/app.js'); a url_defaults hook
+swaps in the hashed name. A changed file gets a new URL, so the hashed files are served as
+immutable for a year and repeat page loads don't request them at all.
+
+esbuild is required: it compiles the TypeScript sources directly, so the checked-in
+JavaScript only matters when assets are served unbuilt (STATIC_ASSETS=0).
+"""
+from __future__ import annotations
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import subprocess
+from dataclasses import dataclass
+
+from flask import Flask, Response, abort, request, send_file
+
+try:
+    import brotli
+except ImportError:  # Brotli copies are optional; gzip is always written
+    brotli = None
+
+DIST_DIR = "dist"
+MANIFEST = "manifest.json"
+# Seconds; hashed names never change content
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# Relative imports between page scripts; an imported script isn't a page of its own
+_IMPORT = re.compile(r"""^import\b[^;]*?["'](?P<path>\.{1,2}/[^"']+)["']""", re.M)
+
+
+@dataclass(frozen=True)
+class BuiltAsset:
+    name: str
+    path: str
+    source_bytes: int
+    size: int
+    gzip_size: int
+    brotli_size: int | None
+
+
+class EsbuildMissing(RuntimeError):
+    pass
+
+
+def find_esbuild(esbuild: str | None = None) -> str:
+    found = esbuild or shutil.which("esbuild")
+    if found is None:
+        raise EsbuildMissing("esbuild not found; install it (npm install -g esbuild) or pass --esbuild")
+    return found
+
+
+def _esbuild(esbuild: str, entry: str, *options: str) -> str:
+    output = subprocess.run(
+        [esbuild, entry, "--minify", "--log-level=warning", *options],
+        check=True, capture_output=True, text=True,
+    )
+    return output.stdout
+
+
+def _imported_scripts(scripts_dir: str) -> set[str]:
+    """
+    Compiled names ("aiService.js") of the scripts some other script imports.
+    """
+    imported = set()
+    for name in os.listdir(scripts_dir):
+        if name.endswith(".ts"):
+            with open(os.path.join(scripts_dir, name), encoding="utf-8") as fin:
+                for match in _IMPORT.finditer(fin.read()):
+                    imported.add(os.path.normpath(match.group("path")))
+    return imported
+
+
+def _write_variants(path: str, data: bytes) -> tuple[int, int | None]:
+    with open(path, "wb") as fout:
+        fout.write(data)
+    # mtime=0 keeps the .gz byte-identical between builds of the same content
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    with open(path + ".gz", "wb") as fout:
+        fout.write(compressed)
+    if brotli is None:
+        return len(compressed), None
+    squeezed = brotli.compress(data, quality=11)
+    with open(path + ".br", "wb") as fout:
+        fout.write(squeezed)
+    return len(compressed), len(squeezed)
+
+
+def build(static_dir: str, esbuild: str | None = None, prune: bool = False) -> list[BuiltAsset]:
+    """
+    Builds every page script and stylesheet into static_dir/dist and writes the manifest.
+    Files from earlier builds are kept, so pages already open can still load them, unless
+    prune is set. Raises EsbuildMissing if esbuild can't be found.
+    """
+    esbuild = find_esbuild(esbuild)
+    scripts_dir = os.path.join(static_dir, "scripts")
+    out_dir = os.path.join(static_dir, DIST_DIR)
+    sources: dict[str, tuple[int, str]] = {}
+
+    imported = _imported_scripts(scripts_dir)
+    for name in sorted(os.listdir(scripts_dir)):
+        if not name.endswith(".js") or name in imported:
+            continue
+        path = os.path.join(scripts_dir, name)
+        typescript = path[:-3] + ".ts"
+        code = _esbuild(esbuild, typescript if os.path.exists(typescript) else path,
+                        "--bundle", "--format=esm", "--target=es2017")
+        sources[f"scripts/{name}"] = os.path.getsize(path), code
+
+    styles_dir = os.path.join(static_dir, "styles")
+    for name in sorted(os.listdir(styles_dir)):
+        if name.endswith(".css"):
+            path = os.path.join(styles_dir, name)
+            sources[f"styles/{name}"] = os.path.getsize(path), _esbuild(esbuild, path)
+
+    built, manifest = [], {}
+    for name, (source_bytes, code) in sources.items():
+        data = code.encode()
+        stem, extension = os.path.splitext(name)
+        hashed = f"{DIST_DIR}/{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+        path = os.path.join(static_dir, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        gzip_size, brotli_size = _write_variants(path, data)
+        manifest[name] = hashed
+        built.append(BuiltAsset(name, hashed, source_bytes, len(data), gzip_size, brotli_size))
+
+    # Swapped in last, so a running app never reads a manifest naming files not yet written
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as fout:
+        json.dump(manifest, fout, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    if prune:
+        keep = {os.path.join(static_dir, hashed) + suffix
+                for hashed in manifest.values() for suffix in ("", ".gz", ".br")}
+        keep.add(manifest_path)
+        for folder, _, files in os.walk(out_dir):
+            for file in files:
+                if os.path.join(folder, file) not in keep:
+                    os.remove(os.path.join(folder, file))
+    return built
+
+
+class AssetManifest:
+    """
+    The manifest of the last build, used to hand out hashed URLs and serve the files.
+    """
+    def __init__(self, static_dir: str):
+        self.static_dir = static_dir
+        self.urls: dict[str, str] = {}
+        # Hashed path under dist -> content encodings it has a precompressed copy for
+        self.files: dict[str, tuple[str, ...]] = {}
+        self.load()
+
+    def load(self) -> None:
+        path = os.path.join(self.static_dir, DIST_DIR, MANIFEST)
+        if not os.path.exists(path):
+            self.urls, self.files = {}, {}
+            return
+        with open(path, encoding="utf-8") as fin:
+            urls = json.load(fin)
+        files = {}
+        for hashed in urls.values():
+            full = os.path.join(self.static_dir, hashed)
+            files[hashed[len(DIST_DIR) + 1:]] = tuple(
+                encoding for encoding, suffix in ENCODINGS if os.path.exists(full + suffix)
+            )
+        self.urls, self.files = urls, files
+
+    def url_defaults(self, endpoint: str, values: dict) -> None:
+        if endpoint == "static":
+            filename = values.get("filename")
+            if filename in self.urls:
+                values["filename"] = self.urls[filename]
+
+    def send(self, filename: str) -> Response:
+        if filename not in self.files:
+            abort(404)
+        path = os.path.join(self.static_dir, DIST_DIR, filename)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        for encoding, suffix in ENCODINGS:
+            if encoding in self.files[filename] and request.accept_encodings[encoding]:
+                response = send_file(path + suffix, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+                response.headers["Content-Encoding"] = encoding
+                break
+        else:
+            response = send_file(path, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+def install(flask_app: Flask) -> AssetManifest:
+    """
+    Points url_for('static', ...) at the built files, when there are any, and serves them.
+    """
+    assets = AssetManifest(flask_app.static_folder or os.path.join(flask_app.root_path, "static"))
+    flask_app.url_defaults(assets.url_defaults)
+    # More specific than the static route, so it wins for everything under dist/
+    flask_app.add_url_rule(f"{flask_app.static_url_path}/{DIST_DIR}/<path:filename>",
+                           endpoint="static_dist", view_func=assets.send)
+    return assets
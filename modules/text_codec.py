@@ -0,0 +1,338 @@
+"""
+Self-describing compression for text stored as BLOBs.
+
+Every blob written by this module starts with a one byte codec tag. Blobs from before the
+tag existed are still readable: anything starting with the xz magic is legacy LZMA, and
+anything else without a known tag is legacy raw UTF-8.
+"""
+from __future__ import annotations
+import lzma
+import os
+import struct
+import threading
+import zlib
+from abc import ABC, abstractmethod
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; zlib is always available
+    zstandard = None
+
+TAG_RAW = 0x01
+TAG_ZLIB = 0x02
+TAG_ZSTD = 0x03
+TAG_ZSTD_DICT = 0x04
+
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+
+# Below this many bytes compression can't win back its own framing
+MIN_COMPRESS_BYTES = 48
+
+
+class TextCodec(ABC):
+    tag: int
+    name: str
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        ...
+
+    @abstractmethod
+    def decompress(self, payload: bytes) -> bytes:
+        ...
+
+
+class RawCodec(TextCodec):
+    tag = TAG_RAW
+    name = "raw"
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, payload: bytes) -> bytes:
+        return payload
+
+
+class ZlibCodec(TextCodec):
+    tag = TAG_ZLIB
+    name = "zlib"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        # Raw deflate: the zlib header and checksum are overhead we don't need
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, payload: bytes) -> bytes:
+        return zlib.decompress(payload, -15)
+
+
+class ZstdCodec(TextCodec):
+    tag = TAG_ZSTD
+    name = "zstd"
+
+    def __init__(self, level: int = 3):
+        if zstandard is None:
+            raise RuntimeError("The zstd codec needs the 'zstandard' package")
+        self.level = level
+        # zstandard compressor objects are not safe to share between threads
+        self._local = threading.local()
+
+    def _compressor(self):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(  # type: ignore[union-attr]
+                level=self.level, write_content_size=True, write_checksum=False,
+            )
+            self._local.compressor = compressor
+        return compressor
+
+    def _decompressor(self):
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = zstandard.ZstdDecompressor()  # type: ignore[union-attr]
+            self._local.decompressor = decompressor
+        return decompressor
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor().compress(data)
+
+    def decompress(self, payload: bytes) -> bytes:
+        return self._decompressor().decompress(payload)
+
+
+class ZstdDictCodec(TextCodec):
+    """
+    zstd with a dictionary trained on our own chat history. The payload starts with the
+    4 byte dictionary id so a blob can always find the dictionary it was written with.
+    """
+    tag = TAG_ZSTD_DICT
+    name = "zstd-dict"
+
+    def __init__(self, dict_data: bytes, level: int = 3):
+        if zstandard is None:
+            raise RuntimeError("The zstd-dict codec needs the 'zstandard' package")
+        self.level = level
+        self.dictionary = zstandard.ZstdCompressionDict(dict_data)
+        self.dict_id = self.dictionary.dict_id()
+        self._local = threading.local()
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(  # type: ignore[union-attr]
+                level=self.level, dict_data=self.dictionary,
+                write_content_size=True, write_checksum=False, write_dict_id=False,
+            )
+            self._local.compressor = compressor
+        return struct.pack(">I", self.dict_id) + compressor.compress(data)
+
+    def decompress(self, payload: bytes) -> bytes:
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary)  # type: ignore[union-attr]
+            self._local.decompressor = decompressor
+        return decompressor.decompress(payload[4:])
+
+
+_raw = RawCodec()
+_codecs: dict[int, TextCodec] = {TAG_RAW: _raw, TAG_ZLIB: ZlibCodec()}
+if zstandard is not None:
+    _codecs[TAG_ZSTD] = ZstdCodec()
+_dict_codecs: dict[int, ZstdDictCodec] = {}
+# Trained dictionaries are kept as <dict id>.bin in this directory and never overwritten,
+# since every blob written with one needs it to be read back; CURRENT names the one for new writes
+_dict_dir: str | None = None
+_default: TextCodec = _codecs[TAG_ZLIB]
+
+
+def current_codec() -> TextCodec:
+    return _default
+
+
+def available_codecs() -> list[str]:
+    names = ["raw", "zlib"]
+    if zstandard is not None:
+        names.append("zstd")
+        if _dict_codecs:
+            names.append("zstd-dict")
+    return names
+
+
+def register_dictionary(codec: ZstdDictCodec) -> ZstdDictCodec:
+    """
+    Makes blobs written with the codec's dictionary decodable.
+    """
+    _dict_codecs[codec.dict_id] = codec
+    return codec
+
+
+def load_dictionary(path: str) -> ZstdDictCodec | None:
+    """
+    Registers a trained zstd dictionary so blobs written with it can be decoded.
+    """
+    if zstandard is None or not os.path.exists(path):
+        return None
+    with open(path, "rb") as fin:
+        return register_dictionary(ZstdDictCodec(fin.read()))
+
+
+def dictionary_dir() -> str | None:
+    return _dict_dir
+
+
+def _dictionary_path(directory: str, dict_id: int) -> str:
+    return os.path.join(directory, f"{dict_id}.bin")
+
+
+def load_dictionaries(directory: str) -> ZstdDictCodec | None:
+    """
+    Registers every dictionary in the directory. Returns the current one: the one named by
+    CURRENT, else the newest.
+    """
+    if zstandard is None or not os.path.isdir(directory):
+        return None
+    loaded: list[tuple[float, ZstdDictCodec]] = []
+    for name in os.listdir(directory):
+        if name.endswith(".bin"):
+            path = os.path.join(directory, name)
+            loaded.append((os.path.getmtime(path), load_dictionary(path)))
+    if not loaded:
+        return None
+    try:
+        with open(os.path.join(directory, "CURRENT")) as fin:
+            current = _dict_codecs.get(int(fin.read().strip()))
+    except (OSError, ValueError):
+        current = None
+    return current or max(loaded, key=lambda item: item[0])[1]
+
+
+def save_dictionary(directory: str, dict_data: bytes) -> ZstdDictCodec:
+    """
+    Stores a newly trained dictionary next to the earlier ones and makes it the current one.
+    """
+    codec = register_dictionary(ZstdDictCodec(dict_data))
+    os.makedirs(directory, exist_ok=True)
+    path = _dictionary_path(directory, codec.dict_id)
+    if not os.path.exists(path):
+        with open(path + ".tmp", "wb") as fout:
+            fout.write(dict_data)
+        os.replace(path + ".tmp", path)
+    with open(os.path.join(directory, "CURRENT.tmp"), "w") as fout:
+        fout.write(str(codec.dict_id))
+    os.replace(os.path.join(directory, "CURRENT.tmp"), os.path.join(directory, "CURRENT"))
+    return codec
+
+
+def _find_dictionary(dict_id: int) -> ZstdDictCodec | None:
+    codec = _dict_codecs.get(dict_id)
+    if codec is None and _dict_dir is not None:
+        # Trained after this process started
+        codec = load_dictionary(_dictionary_path(_dict_dir, dict_id))
+    return codec
+
+
+def configure(codec_name: str, dict_path: str | None = None, dict_dir: str | None = None) -> TextCodec:
+    """
+    Chooses the codec for new writes. "auto" picks the best one available:
+    zstd-dict if a dictionary is present, then zstd, then zlib. dict_path is a single
+    dictionary file from before dict_dir existed; it stays readable but the directory's
+    current dictionary wins.
+    """
+    global _default, _dict_dir
+    _dict_dir = dict_dir
+    dict_codec = load_dictionary(dict_path) if dict_path else None
+    if dict_dir:
+        dict_codec = load_dictionaries(dict_dir) or dict_codec
+
+    if codec_name == "auto":
+        if dict_codec is not None:
+            _default = dict_codec
+        else:
+            _default = _codecs.get(TAG_ZSTD, _codecs[TAG_ZLIB])
+    elif codec_name == "zstd-dict":
+        if dict_codec is None:
+            raise RuntimeError(f"zstd-dict codec requested but no dictionary could be loaded from "
+                               f"{dict_dir or dict_path}")
+        _default = dict_codec
+    else:
+        matches = [codec for codec in _codecs.values() if codec.name == codec_name]
+        if not matches:
+            raise RuntimeError(f"Unknown or unavailable text codec '{codec_name}'")
+        _default = matches[0]
+    return _default
+
+
+def use(codec: TextCodec) -> None:
+    """
+    Switches new writes to the codec, e.g. a dictionary that was just trained.
+    """
+    global _default
+    _default = codec
+
+
+def encode(text: str, codec: TextCodec | None = None) -> bytes:
+    """
+    Encodes text with the configured codec, storing it raw whenever compression doesn't help.
+    """
+    data = text.encode("utf-8")
+    codec = codec or _default
+    if codec.tag != TAG_RAW and len(data) >= MIN_COMPRESS_BYTES:
+        compressed = codec.compress(data)
+        if len(compressed) < len(data):
+            return bytes((codec.tag,)) + compressed
+    return bytes((TAG_RAW,)) + data
+
+
+def decode(blob: bytes) -> str:
+    if blob.startswith(_XZ_MAGIC):
+        return lzma.decompress(blob).decode("utf-8")
+    if not blob:
+        return ""
+
+    tag = blob[0]
+    if tag == TAG_ZSTD_DICT:
+        (dict_id,) = struct.unpack(">I", blob[1:5])
+        codec = _find_dictionary(dict_id)
+        if codec is None:
+            raise RuntimeError(f"zstd dictionary {dict_id} is not loaded")
+        return codec.decompress(blob[1:]).decode("utf-8")
+    codec = _codecs.get(tag)
+    if codec is not None:
+        return codec.decompress(blob[1:]).decode("utf-8")
+    if tag == TAG_ZSTD:
+        raise RuntimeError("This blob is zstd compressed; install the 'zstandard' package")
+
+    # Untagged short blobs predate the codec tag and were stored as plain UTF-8
+    return blob.decode("utf-8")
+
+
+def codec_of(blob: bytes) -> str:
+    """
+    Name of the codec a stored blob was written with.
+    """
+    if blob.startswith(_XZ_MAGIC):
+        return "lzma"
+    tags = {TAG_RAW: "raw", TAG_ZLIB: "zlib", TAG_ZSTD: "zstd", TAG_ZSTD_DICT: "zstd-dict"}
+    if blob and blob[0] in tags:
+        return tags[blob[0]]
+    return "legacy-raw"
+
+
+def is_current(blob: bytes) -> bool:
+    """
+    Whether the blob was written with the codec new writes use, including its dictionary.
+    """
+    if codec_of(blob) != _default.name:
+        return False
+    if isinstance(_default, ZstdDictCodec):
+        return struct.unpack(">I", blob[1:5])[0] == _default.dict_id
+    return True
+
+
+def train_dictionary(samples: list[bytes], dict_size: int = 112640) -> bytes:
+    if zstandard is None:
+        raise RuntimeError("Training a dictionary needs the 'zstandard' package")
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
@@ -0,0 +1,183 @@
+from __future__ import annotations
+import logging
+import threading
+import weakref
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TransportConfig:
+    max_connections: int = 20
+    max_keepalive: int = 10
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+
+
+@dataclass
+class HostStats:
+    """Counters for one upstream host"""
+    in_flight: int = 0
+    peak_in_flight: int = 0
+    requests_total: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def started(self) -> None:
+        with self.lock:
+            self.in_flight += 1
+            self.requests_total += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finished(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+
+config = TransportConfig()
+_clients: dict[str, httpx.Client] = {}
+_stats: dict[str, HostStats] = {}
+_pools: weakref.WeakSet = weakref.WeakSet()
+_lock = threading.Lock()
+
+
+def configure(cfg: TransportConfig) -> None:
+    """
+    Sets pool limits and timeouts. Must run before any provider client is constructed.
+    """
+    global config
+    config = cfg
+
+
+def _origin(base_url: str) -> str:
+    parts = urlsplit(base_url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _host_stats(origin: str) -> HostStats:
+    with _lock:
+        return _stats.setdefault(origin, HostStats())
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=config.max_connections,
+        max_keepalive_connections=config.max_keepalive,
+        keepalive_expiry=config.keepalive_expiry,
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(config.read_timeout, connect=config.connect_timeout)
+
+
+class _TrackedStream(httpx.SyncByteStream):
+    """Keeps a request counted as in flight until its response body is closed"""
+    def __init__(self, stream: httpx.SyncByteStream, stats: HostStats):
+        self._stream = stream
+        self._stats = stats
+        self._closed = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._stats.finished()
+
+
+class _CountingTransport(httpx.HTTPTransport):
+    def __init__(self, stats: HostStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+        _pools.add(self)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.stats.started()
+        try:
+            response = super().handle_request(request)
+        except BaseException:
+            self.stats.finished()
+            raise
+        response.stream = _TrackedStream(response.stream, self.stats)  # type: ignore[arg-type]
+        return response
+
+
+def http_client(base_url: str) -> httpx.Client:
+    """
+    Returns the shared, pooled sync client for the host behind base_url.
+    Every SDK that talks to the same host gets the same pool.
+    """
+    origin = _origin(base_url)
+    with _lock:
+        client = _clients.get(origin)
+    if client is not None:
+        return client
+
+    stats = _host_stats(origin)
+    client = httpx.Client(
+        transport=_CountingTransport(stats, limits=_limits()),
+        timeout=_timeout(),
+        follow_redirects=True,
+    )
+    with _lock:
+        return _clients.setdefault(origin, client)
+
+
+def _warm(origin: str, client: httpx.Client) -> None:
+    try:
+        # Any response at all means DNS, TCP and TLS are done and the connection is pooled
+        client.head(origin + "/")
+    except httpx.HTTPError as e:
+        logger.warning("Connection warm-up for %s failed: %s", origin, e)
+
+
+def warm_up() -> None:
+    """
+    Opens one connection to every registered host in the background, so the first prompt
+    after startup doesn't pay for connection setup.
+    """
+    with _lock:
+        clients = list(_clients.items())
+    for origin, client in clients:
+        threading.Thread(target=_warm, args=(origin, client), name=f"warm-{origin}", daemon=True).start()
+
+
+def _open_connections(transport: _CountingTransport) -> int:
+    # httpcore doesn't expose pool occupancy publicly; treat it as best-effort
+    pool = getattr(transport, "_pool", None)
+    return len(getattr(pool, "connections", ()))
+
+
+def pool_stats() -> dict[str, dict[str, int | float]]:
+    """
+    Per-host pool utilization for capacity planning.
+    """
+    open_by_host: dict[int, int] = {}
+    for transport in list(_pools):
+        key = id(transport.stats)
+        open_by_host[key] = open_by_host.get(key, 0) + _open_connections(transport)
+
+    with _lock:
+        stats = list(_stats.items())
+    report: dict[str, dict[str, int | float]] = {}
+    for origin, host in stats:
+        with host.lock:
+            in_flight, peak, total = host.in_flight, host.peak_in_flight, host.requests_total
+        report[origin] = {
+            "max_connections": config.max_connections,
+            "open_connections": open_by_host.get(id(host), 0),
+            "in_flight": in_flight,
+            "peak_in_flight": peak,
+            "requests_total": total,
+            "utilization": in_flight / config.max_connections if config.max_connections else 0.0,
+        }
+    return report
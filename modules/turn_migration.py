@@ -0,0 +1,126 @@
+"""
+Online move of chat history from chat_history, one row per reply with its own copy of the
+prompt, into chat_turns and chat_responses.
+
+Rows keep their ids as response ids, so the search index, archived segments, history page
+cursors and browser caches stay valid and nothing has to be re-indexed. A thread is
+converted in one transaction the first time it is opened or written to (through
+extensions.ensure_hot_thread); `flask migrate-turns` converts the rest in small batches
+while the app keeps serving.
+
+Replies are regrouped into turns per thread: a row joins an earlier turn if it has the
+same prompt text, was saved within TURN_WINDOW of that turn's first row and its model
+hasn't answered the turn yet. Before the history writer each model's reply was saved as it
+finished, so the rows of one prompt can be many seconds apart.
+"""
+from __future__ import annotations
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, TypeVar
+
+from sqlalchemy import delete, insert
+from sqlalchemy.orm import Session
+
+from modules import dbms
+from modules.dbms import db, ChatHistory, ChatResponse, ChatTurn
+
+TURN_WINDOW = timedelta(minutes=5)
+
+T = TypeVar("T")
+
+
+def group_turns(items: Iterable[T], key: Callable[[T], tuple[int, str, str, datetime]]) -> list[list[T]]:
+    """
+    Groups replies, ordered by thread and id, into turns. key(item) gives the reply's
+    (thread id, prompt, model name, date saved).
+    """
+    turns: list[list[T]] = []
+    # The current thread's turns by prompt text, with their first reply's date and models
+    open_turns: dict[str, tuple[list[T], datetime, set[str]]] = {}
+    current_thread = None
+    for item in items:
+        thread_id, prompt, model_name, saved = key(item)
+        if thread_id != current_thread:
+            current_thread = thread_id
+            open_turns = {}
+        turn = open_turns.get(prompt)
+        if turn is None or model_name in turn[2] or saved - turn[1] > TURN_WINDOW:
+            turn = open_turns[prompt] = ([], saved, set())
+            turns.append(turn[0])
+        turn[0].append(item)
+        turn[2].add(model_name)
+    return turns
+
+
+def convert_threads(session: Session, thread_ids: list[int]) -> int:
+    """
+    Moves the threads' chat_history rows into turns and responses inside the caller's
+    transaction. Returns the number of rows moved.
+    """
+    rows = session.execute(
+        db.select(ChatHistory.id, ChatHistory.thread_id, ChatHistory._user_input, ChatHistory.model_name,
+                  ChatHistory._model_response, ChatHistory.date_saved)
+        .where(ChatHistory.thread_id.in_(thread_ids))
+        .order_by(ChatHistory.thread_id, ChatHistory.id)
+    ).all()
+    if not rows:
+        return 0
+    texts: dict[bytes, str] = {}
+
+    def key(row) -> tuple[int, str, str, datetime]:
+        prompt = texts.get(row._user_input)
+        if prompt is None:
+            prompt = texts[row._user_input] = dbms.db_decode_text(row._user_input)
+        return row.thread_id, prompt, row.model_name, row.date_saved
+
+    # The blobs move as they are; prompts are only decoded to compare them
+    turns = group_turns(rows, key)
+    turn_table = ChatTurn.__table__
+    turn_ids = session.execute(
+        insert(turn_table).returning(turn_table.c.id, sort_by_parameter_order=True),
+        [{"thread_id": turn[0].thread_id, "user_input": turn[0]._user_input, "date_saved": turn[0].date_saved}
+         for turn in turns],
+    ).scalars().all()
+    session.execute(insert(ChatResponse.__table__), [
+        {"id": row.id, "turn_id": turn_id, "thread_id": row.thread_id, "model_name": row.model_name,
+         "model_response": row._model_response}
+        for turn_id, turn in zip(turn_ids, turns)
+        for row in turn
+    ])
+    session.execute(delete(ChatHistory).where(ChatHistory.id.in_([row.id for row in rows])))
+    return len(rows)
+
+
+def ensure_converted(session: Session, thread_id: int) -> bool:
+    """
+    Converts and commits the thread if it still has chat_history rows. Returns whether it had.
+    """
+    legacy = session.execute(
+        db.select(ChatHistory.id).filter_by(thread_id=thread_id).limit(1)
+    ).scalar_one_or_none()
+    if legacy is None:
+        return False
+    convert_threads(session, [thread_id])
+    session.commit()
+    return True
+
+
+def convert_batch(session: Session, batch_size: int) -> tuple[int, int]:
+    """
+    Converts up to batch_size threads and commits. Returns (threads, rows) converted;
+    (0, 0) once chat_history is empty.
+    """
+    thread_ids = session.execute(
+        db.select(ChatHistory.thread_id).distinct().limit(batch_size)
+    ).scalars().all()
+    if not thread_ids:
+        return 0, 0
+    moved = convert_threads(session, list(thread_ids))
+    session.commit()
+    return len(thread_ids), moved
+
+
+def remaining(session: Session) -> int:
+    """
+    chat_history rows still to convert.
+    """
+    return session.execute(db.select(db.func.count()).select_from(ChatHistory)).scalar_one()
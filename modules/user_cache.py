@@ -0,0 +1,138 @@
+from __future__ import annotations
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+
+@dataclass(frozen=True, eq=False)
+class UserSnapshot(UserMixin):
+    """
+    Read-only copy of the columns request handlers need from a User. It isn't bound to a
+    session, so caching it doesn't keep connections or identity maps alive.
+    """
+    id: int
+    email: str
+    status: str
+
+    @classmethod
+    def of(cls, user: Any) -> UserSnapshot:
+        return cls(id=user.id, email=user.email, status=user.status)
+
+
+@dataclass
+class UserCacheStats:
+    hits: int = 0
+    misses: int = 0
+    expirations: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+class UserCache:
+    """
+    Per-process LRU + TTL cache of UserSnapshots keyed by user id, used by Flask-Login's
+    user_loader so authenticated requests don't query the users table.
+
+    ORM updates and deletes of watched models invalidate the entry once the session commits.
+    Bulk UPDATE/DELETE statements bypass the ORM and must call invalidate() themselves.
+    The TTL bounds how stale other processes can be.
+    """
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = UserCacheStats()
+        self._entries: OrderedDict[int, tuple[float, UserSnapshot]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, user_id: int, loader: Callable[[int], UserSnapshot | None]) -> UserSnapshot | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                expires, snapshot = entry
+                if expires > now:
+                    self._entries.move_to_end(user_id)
+                    self.stats.hits += 1
+                    return snapshot
+                del self._entries[user_id]
+                self.stats.expirations += 1
+            self.stats.misses += 1
+
+        snapshot = loader(user_id)
+        # Unknown ids aren't cached so a new account is visible immediately
+        if snapshot is not None:
+            self.put(snapshot)
+        return snapshot
+
+    def put(self, snapshot: UserSnapshot) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[snapshot.id] = (time.monotonic() + self.ttl_seconds, snapshot)
+            self._entries.move_to_end(snapshot.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.stats.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def watch(self, model: type) -> None:
+        """
+        Invalidates a user's entry whenever an instance of model is updated or deleted
+        through the ORM and the session commits. A later cache watching the same model
+        takes over from this one.
+        """
+        if model not in _watched:
+            event.listen(model, "after_update", _note_write)
+            event.listen(model, "after_delete", _note_write)
+        _watched[model] = self
+
+    def snapshot(self) -> dict[str, int | float]:
+        with self._lock:
+            lookups = self.stats.hits + self.stats.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.stats.hits,
+                "misses": self.stats.misses,
+                "hit_rate": self.stats.hits / lookups if lookups else 0.0,
+                "expirations": self.stats.expirations,
+                "evictions": self.stats.evictions,
+                "invalidations": self.stats.invalidations,
+            }
+
+
+# The cache currently watching each model. The listeners below are registered once per
+# process, however many caches are created, and look the cache up when they fire.
+_watched: dict[type, UserCache] = {}
+
+
+def _note_write(mapper, _connection, target) -> None:
+    cache = _watched.get(mapper.class_)
+    session = object_session(target)
+    if cache is not None and session is not None:
+        session.info.setdefault("user_cache_dirty", set()).add((cache, target.id))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session: Session) -> None:
+    for cache, user_id in session.info.pop("user_cache_dirty", ()):
+        cache.invalidate(user_id)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_rolled_back(session: Session, _previous_transaction) -> None:
+    session.info.pop("user_cache_dirty", None)
@@ -1,23 +1,9 @@
-const MODEL_ENDPOINTS: Record<string, string> = {
-    CHATGPT: "/api/chatgpt",
-    GEMINI: "/api/gemini",
-    CLAUDE: "/api/claude",
-    GROK: "/api/grok",
-    DEEPSEEK: "/api/deepseek",
-    MISTRAL: "/api/mistral",
-    LLAMA: "/api/llama",
-    QWEN: "/api/qwen"
-};
-
 // Declare 'marked' because it is loaded via CDN in home.html
 declare const marked: any;
 
 export async function fetchLLMResponse(model: string, prompt: string): Promise<string> {
     const upper = model.toUpperCase();
-    const endpoint = MODEL_ENDPOINTS[upper];
-    if (!endpoint) throw new Error(`Unsupported model: ${model}`);
-
-    const res = await fetch(endpoint, {
+    const res = await fetch(`/api/llm/${encodeURIComponent(model.toLowerCase())}`, {
         method: "POST",
         headers: {"Content-Type": "application/json"},
         body: JSON.stringify({ prompt })
@@ -40,85 +26,290 @@ export async function fetchLLMResponse(model: string, prompt: string): Promise<s
     return data.reply;
 }
 
-// Helper function to recursively traverse HTML nodes, tokenize text, and apply the typing effect
-function processTextNodes(node: Node, targetContainer: HTMLElement, delay: number, currentPromise: Promise<void>): Promise<void> {
-    if (node.nodeType === Node.TEXT_NODE && node.textContent && node.textContent.trim().length > 0) {
-        // Split text by words and whitespace, keeping whitespace in the tokens array
-        const tokens = node.textContent.split(/(\s+)/);
-
-        for (const token of tokens) {
-            if (!token) continue;
-
-            if (/^\s+$/.test(token)) {
-                // Handle pure whitespace (spaces, tabs, newlines)
-                if (token.includes("\n")) {
-                    const parts = token.split(/(\n)/);
-                    for (const part of parts) {
-                        if (part === "\n") targetContainer.appendChild(document.createElement("br"));
-                        else if (part.length > 0) targetContainer.appendChild(document.createTextNode(part));
-                    }
-                } else {
-                    targetContainer.appendChild(document.createTextNode(token));
-                }
-            } else {
-                // This is a word: wrap it and chain the animation promise
-                const span = document.createElement("span");
-                span.className = "word";
-                span.textContent = token;
-                targetContainer.appendChild(span);
-
-                currentPromise = currentPromise.then(() => {
-                    span.offsetWidth; // Trigger reflow for transition
-                    span.classList.add("show");
-                    return new Promise(resolve => setTimeout(resolve, delay));
-                });
-            }
+export interface ModelResult {
+    model: string;
+    reply?: string;
+    error?: string;
+}
+
+// Sends the prompt to every model in one request; onResult fires as each model finishes
+export async function fetchMultiResponse(models: string[], prompt: string, onResult: (result: ModelResult) => void): Promise<void> {
+    const res = await fetch("/api/multi", {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({ prompt, models: models.map(m => m.toUpperCase()) })
+    });
+
+    if (!res.ok || !res.body) {
+        const text = await res.text();
+        throw new Error(text || "Multi-model request failed");
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffered = "";
+    while (true) {
+        const { done, value } = await reader.read();
+        if (value) buffered += decoder.decode(value, { stream: true });
+
+        // Each completed line is one model's result
+        let newline = buffered.indexOf("\n");
+        while (newline >= 0) {
+            const line = buffered.slice(0, newline).trim();
+            buffered = buffered.slice(newline + 1);
+            if (line) onResult(JSON.parse(line) as ModelResult);
+            newline = buffered.indexOf("\n");
         }
-    } else if (node.nodeType === Node.ELEMENT_NODE) {
-        // It's an element node (e.g., <b>, <li>, <p>, <code>), clone it to preserve tags
-        const clonedElement = node.cloneNode(false) as HTMLElement;
-        targetContainer.appendChild(clonedElement);
-
-        // Recursively process its children to find the text nodes
-        let child = node.firstChild;
-        while (child) {
-            currentPromise = processTextNodes(child, clonedElement, delay, currentPromise);
-            child = child.nextSibling;
+        if (done) break;
+    }
+}
+
+export interface StreamEvent {
+    event: string;
+    model?: string;
+    delta?: string;
+    error?: string;
+    // Set when the provider itself is struggling (circuit open, overloaded, timed out)
+    degraded?: boolean;
+}
+
+export interface ProviderStatus {
+    status: string;
+    breaker: string;
+    p95_ms: number | null;
+}
+
+// Health of every provider as seen by the server's resilience layer
+export async function fetchProviderStatus(): Promise<Record<string, ProviderStatus>> {
+    const res = await fetch("/api/provider_status");
+    if (!res.ok) throw new Error("Failed to load provider status");
+    return await res.json();
+}
+
+// Reads a Server-Sent-Events response body and calls onEvent for every event
+async function readEventStream(res: Response, onEvent: (e: StreamEvent) => void): Promise<void> {
+    const reader = res.body!.getReader();
+    const decoder = new TextDecoder();
+    let buffered = "";
+    while (true) {
+        const { done, value } = await reader.read();
+        if (value) buffered += decoder.decode(value, { stream: true });
+
+        let boundary = buffered.indexOf("\n\n");
+        while (boundary >= 0) {
+            const block = buffered.slice(0, boundary);
+            buffered = buffered.slice(boundary + 2);
+            boundary = buffered.indexOf("\n\n");
+
+            let event = "message";
+            let data = "";
+            block.split("\n").forEach(line => {
+                if (line.startsWith("event:")) event = line.slice(6).trim();
+                else if (line.startsWith("data:")) data += line.slice(5).trim();
+            });
+            onEvent({ event, ...(data ? JSON.parse(data) : {}) });
         }
+        if (done) break;
     }
+}
 
-    return currentPromise;
+// Streams tokens from every model over one SSE connection
+export async function streamMultiResponse(models: string[], prompt: string, onEvent: (e: StreamEvent) => void): Promise<void> {
+    const res = await fetch("/api/multi/stream", {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({ prompt, models: models.map(m => m.toUpperCase()) })
+    });
+
+    if (!res.ok || !res.body) {
+        const text = await res.text();
+        throw new Error(text || "Streaming request failed");
+    }
+    await readEventStream(res, onEvent);
 }
 
+// Work every typing renderer together may do per frame, in ms; the rest waits a frame
+const FRAME_BUDGET_MS = 8;
+// However much text has arrived, it is revealed over about this long
+const CATCH_UP_MS = 300;
+// Slowest reveal pace, in characters per second
+const MIN_CHARS_PER_SECOND = 400;
 
-export async function typeWords(outContainer: HTMLDivElement, text: string, delay = 30) {
-    if (typeof marked === 'undefined') {
-        // Fallback if marked.js didn't load
-        outContainer.textContent = text;
-        return;
+// Renderers with text left to draw, in the order they get the next frame
+const pendingRenderers = new Set<StreamingRenderer>();
+let scheduledFrame = 0;
+
+function scheduleRenderer(renderer: StreamingRenderer) {
+    pendingRenderers.add(renderer);
+    if (!scheduledFrame) scheduledFrame = requestAnimationFrame(drawFrame);
+}
+
+// One callback draws every renderer: layout is read once before the DOM writes and once after
+function drawFrame(now: number) {
+    scheduledFrame = 0;
+    const deadline = performance.now() + FRAME_BUDGET_MS;
+    const batch = [...pendingRenderers];
+    const pinned = batch.map(renderer => renderer.isScrolledToEnd());
+    let drawn = 0;
+    for (const renderer of batch) {
+        if (drawn > 0 && performance.now() > deadline) break;
+        // Re-adding moves it behind the ones that missed this frame
+        pendingRenderers.delete(renderer);
+        if (renderer.step(now)) pendingRenderers.add(renderer);
+        drawn++;
     }
+    for (let i = 0; i < drawn; i++) {
+        if (pinned[i]) batch[i].scrollToEnd();
+    }
+    if (pendingRenderers.size) scheduledFrame = requestAnimationFrame(drawFrame);
+}
 
-    const modelDiv = document.createElement("div");
-    modelDiv.className = "model-response";
-    outContainer.appendChild(modelDiv);
+const observedRenderers = new WeakMap<Element, StreamingRenderer>();
+const visibility = typeof IntersectionObserver === "undefined" ? null : new IntersectionObserver(entries => {
+    for (const entry of entries) {
+        const renderer = observedRenderers.get(entry.target);
+        if (renderer) renderer.setVisible(entry.isIntersecting);
+    }
+});
+
+function renderMarkdown(text: string): string {
+    return marked.parse(text);
+}
+
+// Counts ``` fences, so a block boundary inside a code block isn't taken for a real one
+function fenceCount(text: string): number {
+    return (text.match(/^\s*```/gm) || []).length;
+}
+
+// Draws a reply as its tokens arrive. Arrived text is revealed a chunk per frame; paragraphs
+// that are complete are parsed once and kept, and only the one still being written is
+// re-parsed. Off-screen columns skip the animation and are drawn once when they scroll into
+// view or the reply ends.
+export class StreamingRenderer {
+    private text = "";
+    private shown = 0;
+    // Length of text already drawn as finished blocks
+    private settled = 0;
+    private lastStep = 0;
+    private finished = false;
+    private visible = true;
+    private onDrawn: (() => void) | null = null;
+    private element: HTMLDivElement;
+    private tail: HTMLDivElement;
+
+    constructor(private outContainer: HTMLDivElement) {
+        this.element = document.createElement("div");
+        this.element.className = "model-response";
+        this.tail = document.createElement("div");
+        this.element.appendChild(this.tail);
+        outContainer.appendChild(this.element);
+        if (visibility) {
+            observedRenderers.set(outContainer, this);
+            visibility.observe(outContainer);
+        }
+    }
+
+    append(delta: string) {
+        this.text += delta;
+        if (this.visible) scheduleRenderer(this);
+    }
+
+    // Resolves once the whole reply is on screen
+    finish(): Promise<void> {
+        this.finished = true;
+        return new Promise(resolve => {
+            this.onDrawn = resolve;
+            scheduleRenderer(this);
+        });
+    }
+
+    setVisible(visible: boolean) {
+        this.visible = visible;
+        if (visible && this.shown < this.text.length) scheduleRenderer(this);
+    }
+
+    isScrolledToEnd(): boolean {
+        const out = this.outContainer;
+        return out.scrollHeight - out.scrollTop - out.clientHeight < 8;
+    }
 
-    // 1. Convert Markdown to full HTML structure
-    const htmlContent = marked.parse(text);
+    scrollToEnd() {
+        this.outContainer.scrollTop = this.outContainer.scrollHeight;
+    }
+
+    // Draws this frame's chunk; returns true while there is more to reveal
+    step(now: number): boolean {
+        if (!this.visible && !this.finished) return false;
+        const elapsed = this.lastStep ? now - this.lastStep : 16;
+        this.lastStep = now;
 
-    // 2. Create a temporary container to hold the HTML structure
-    const tempContainer = document.createElement('div');
-    tempContainer.innerHTML = htmlContent;
+        if (!this.visible || document.hidden) {
+            this.shown = this.text.length;
+        } else {
+            const backlog = this.text.length - this.shown;
+            let target = this.shown + Math.max(Math.ceil(backlog * elapsed / CATCH_UP_MS),
+                                               Math.ceil(MIN_CHARS_PER_SECOND * elapsed / 1000));
+            // End the chunk on a word boundary rather than mid-word
+            const space = this.text.indexOf(" ", target);
+            if (space !== -1 && space - target < 16) target = space;
+            this.shown = Math.min(target, this.text.length);
+        }
 
-    // 3. Start the recursive typing/tokenization process
-    let currentPromise = Promise.resolve();
-    let child = tempContainer.firstChild;
-    while (child) {
-        currentPromise = processTextNodes(child, modelDiv, delay, currentPromise);
-        child = child.nextSibling;
+        if (this.shown < this.text.length) {
+            this.draw();
+            return true;
+        }
+        if (this.finished) {
+            this.drawFinal();
+        } else {
+            this.draw();
+            // Caught up; the next token starts a fresh reveal
+            this.lastStep = 0;
+        }
+        return false;
     }
 
-    await currentPromise;
+    private draw() {
+        if (typeof marked === 'undefined') {
+            this.tail.textContent = this.text.slice(0, this.shown);
+            return;
+        }
+        const boundary = this.text.lastIndexOf("\n\n", this.shown);
+        if (boundary > this.settled) {
+            const block = this.text.slice(this.settled, boundary);
+            if (fenceCount(block) % 2 === 0) {
+                this.tail.insertAdjacentHTML("beforebegin", renderMarkdown(block));
+                this.settled = boundary;
+            }
+        }
+        this.tail.innerHTML = renderMarkdown(this.text.slice(this.settled, this.shown));
+    }
 
-    // Scroll to bottom after typing is finished
-    outContainer.scrollTop = outContainer.scrollHeight;
-}
\ No newline at end of file
+    // One parse of the whole reply, so markdown spanning paragraphs comes out right
+    private drawFinal() {
+        // A later reply in the same column may have taken the observer over already
+        if (visibility && observedRenderers.get(this.outContainer) === this) {
+            visibility.unobserve(this.outContainer);
+            observedRenderers.delete(this.outContainer);
+        }
+        if (typeof marked === 'undefined') {
+            this.element.textContent = this.text;
+        } else {
+            this.element.innerHTML = renderMarkdown(this.text);
+        }
+        if (this.onDrawn) this.onDrawn();
+    }
+}
+
+// Draws a complete reply at once, for replies that are already on screen elsewhere or in history
+export function renderReply(outContainer: Node, text: string): HTMLDivElement {
+    const element = document.createElement("div");
+    element.className = "model-response";
+    if (typeof marked === 'undefined') {
+        element.textContent = text;
+    } else {
+        element.innerHTML = renderMarkdown(text);
+    }
+    outContainer.appendChild(element);
+    return element;
+}
@@ -8,7 +8,8 @@ var __awaiter = (this && this.__awaiter) || function (thisArg, _arguments, P, ge
     });
 };
 var _a;
-import { fetchLLMResponse, typeWords } from "./aiService.js";
+import { fetchProviderStatus, renderReply, streamMultiResponse, StreamingRenderer } from "./aiService.js";
+import * as threadCache from "./threadCache.js";
 const addColumnBtn = document.getElementById("addColumnBtn");
 const addColumnContainer = document.getElementById("addColumnContainer");
 const modelDropdown = document.getElementById("modelDropdown");
@@ -23,6 +24,8 @@ const userStatusInput = document.getElementById("userStatus");
 const userStatus = (_a = userStatusInput === null || userStatusInput === void 0 ? void 0 : userStatusInput.value) !== null && _a !== void 0 ? _a : "Free";
 const MAX_FREE_MODELS = 3;
 let promptAlertTimeout;
+// The thread on screen, whose cached copy new replies are added to
+let activeThreadId = null;
 // --- Sidebar Logic ---
 sidebarToggle.addEventListener("click", () => {
     // Check if we are in mobile view
@@ -33,12 +36,13 @@ sidebarToggle.addEventListener("click", () => {
         document.body.classList.toggle("sidebar-collapsed");
     }
 });
-function addThreadToSidebar(id, name, date, models) {
+function addThreadToSidebar(id, name, date, models, atEnd = false) {
     const threadList = document.getElementById("threadList");
     if (!threadList)
         return;
     const div = document.createElement("div");
     div.className = "chat-thread";
+    div.tabIndex = 0;
     div.setAttribute("data-thread-id", id.toString());
     div.innerHTML = `
         <div class="thread-header">
@@ -56,6 +60,7 @@ function addThreadToSidebar(id, name, date, models) {
         }
         loadThreadHistory(id);
     });
+    prefetchOnIntent(div, id);
     const deleteBtn = div.querySelector(".delete-thread-btn");
     if (deleteBtn) {
         deleteBtn.addEventListener("click", (e) => {
@@ -63,8 +68,74 @@ function addThreadToSidebar(id, name, date, models) {
             deleteThread(id, div);
         });
     }
-    threadList.prepend(div);
+    if (atEnd) {
+        // Older pages go above the scroll sentinel, which stays last
+        threadList.insertBefore(div, document.getElementById("threadListSentinel"));
+    }
+    else {
+        threadList.prepend(div);
+    }
+}
+// Hovering or focusing an entry fetches the thread ahead of the click
+const PREFETCH_HOVER_MS = 80;
+const PREFETCH_AGAIN_MS = 30000;
+const prefetchedAt = new Map();
+function prefetchThread(id) {
+    const last = prefetchedAt.get(id);
+    if (id === activeThreadId || (last !== undefined && performance.now() - last < PREFETCH_AGAIN_MS))
+        return;
+    prefetchedAt.set(id, performance.now());
+    threadCache.refresh(id, true).catch(err => console.error("Error prefetching thread:", err));
+}
+function prefetchOnIntent(entry, id) {
+    let hoverTimer;
+    entry.addEventListener("mouseenter", () => {
+        hoverTimer = window.setTimeout(() => prefetchThread(id), PREFETCH_HOVER_MS);
+    });
+    entry.addEventListener("mouseleave", () => window.clearTimeout(hoverTimer));
+    entry.addEventListener("focus", () => prefetchThread(id));
+    entry.addEventListener("keydown", e => {
+        if (e.key === "Enter" && e.target === entry)
+            entry.click();
+    });
+}
+// --- Sidebar infinite scroll ---
+const threadListSentinel = document.getElementById("threadListSentinel");
+let loadingThreads = false;
+const threadObserver = new IntersectionObserver(entries => {
+    if (entries.some(e => e.isIntersecting))
+        loadMoreThreads();
+}, { root: document.getElementById("threadList") });
+function loadMoreThreads() {
+    return __awaiter(this, void 0, void 0, function* () {
+        var _a;
+        const cursor = threadListSentinel === null || threadListSentinel === void 0 ? void 0 : threadListSentinel.dataset.nextCursor;
+        if (!threadListSentinel || !cursor || loadingThreads)
+            return;
+        loadingThreads = true;
+        try {
+            const response = yield fetch(`/api/threads?cursor=${encodeURIComponent(cursor)}`);
+            if (!response.ok)
+                throw new Error("Failed to fetch threads");
+            const data = yield response.json();
+            data.threads.forEach((t) => addThreadToSidebar(t.id, t.name, t.date, t.models, true));
+            threadListSentinel.dataset.nextCursor = (_a = data.next_cursor) !== null && _a !== void 0 ? _a : "";
+        }
+        catch (err) {
+            console.error("Error loading threads:", err);
+        }
+        finally {
+            loadingThreads = false;
+        }
+        // Re-observing re-checks visibility, in case one page didn't fill the list
+        if (threadListSentinel.dataset.nextCursor) {
+            threadObserver.unobserve(threadListSentinel);
+            threadObserver.observe(threadListSentinel);
+        }
+    });
 }
+if (threadListSentinel)
+    threadObserver.observe(threadListSentinel);
 // Close mobile sidebar when clicking overlay
 mobileOverlay.addEventListener("click", () => {
     document.body.classList.remove("sidebar-mobile-open");
@@ -97,6 +168,40 @@ function showPromptAlert(message) {
         setTimeout(() => alert === null || alert === void 0 ? void 0 : alert.remove(), 300);
     }, 4000);
 }
+// --- Provider health ---
+const PROVIDER_STATUS_INTERVAL_MS = 30000;
+const providerStatus = new Map();
+// Flags a model's column header and dropdown entry while its provider is degraded
+function applyProviderStatus(model) {
+    var _a;
+    const status = (_a = providerStatus.get(model)) !== null && _a !== void 0 ? _a : "ok";
+    const degraded = status !== "ok";
+    const title = degraded ? `${model} is having problems right now (${status})` : "";
+    const targets = [
+        ...Array.from(llmContainer.querySelectorAll(`.column-header[data-model="${model}"]`)),
+        ...Array.from(modelDropdown.querySelectorAll(".dropdown-item"))
+            .filter(item => { var _a; return ((_a = item.textContent) === null || _a === void 0 ? void 0 : _a.trim()) === model; }),
+    ];
+    targets.forEach(el => {
+        el.classList.toggle("degraded", degraded);
+        el.title = title;
+    });
+}
+function setProviderStatus(model, status) {
+    providerStatus.set(model, status);
+    applyProviderStatus(model);
+}
+function refreshProviderStatus() {
+    return __awaiter(this, void 0, void 0, function* () {
+        try {
+            const statuses = yield fetchProviderStatus();
+            Object.entries(statuses).forEach(([model, s]) => setProviderStatus(model, s.status));
+        }
+        catch (err) {
+            console.error("Error loading provider status:", err);
+        }
+    });
+}
 function getColumnsFor(model) {
     return Array.from(llmContainer.querySelectorAll(".llm-column"))
         .filter(col => { var _a; return ((_a = col.querySelector(".column-header")) === null || _a === void 0 ? void 0 : _a.dataset.model) === model; });
@@ -131,6 +236,7 @@ submitPromptBtn.addEventListener("click", () => __awaiter(void 0, void 0, void 0
             })
         });
         const data = yield response.json();
+        activeThreadId = data.id;
         // Only update sidebar if the server says it created a NEW thread
         if (data.status === "created") {
             addThreadToSidebar(data.id, data.name, data.date, data.models);
@@ -163,33 +269,72 @@ submitPromptBtn.addEventListener("click", () => __awaiter(void 0, void 0, void 0
     });
     promptInput.value = "";
     promptInput.focus();
-    presentModels.forEach(model => {
-        const p = fetchLLMResponse(model, prompt);
-        p.then(reply => {
-            const columns = getColumnsFor(model);
-            columns.forEach(col => {
-                const out = col.querySelector(".llm-output");
-                const spinner = out.querySelector(".loading-spinner");
-                if (spinner)
-                    spinner.remove();
-                // Now uses the updated typeWords function for markdown typing
-                typeWords(out, reply);
-            });
-        }).catch(err => {
-            const error = err;
-            const columns = getColumnsFor(model);
-            columns.forEach(col => {
+    function showError(model, message) {
+        getColumnsFor(model).forEach(col => {
+            const out = col.querySelector(".llm-output");
+            const spinner = out.querySelector(".loading-spinner");
+            if (spinner)
+                spinner.remove();
+            const errDiv = document.createElement("div");
+            errDiv.className = "error";
+            errDiv.textContent = `Error: ${message}`;
+            out.appendChild(errDiv);
+        });
+    }
+    const pending = new Set(presentModels.map(model => model.toUpperCase()));
+    const replyThreadId = activeThreadId;
+    const replies = new Map();
+    const renderers = new Map();
+    // Swaps the spinner for live renderers the first time a model sends a token
+    function renderersFor(model) {
+        let list = renderers.get(model);
+        if (!list) {
+            list = getColumnsFor(model).map(col => {
                 const out = col.querySelector(".llm-output");
                 const spinner = out.querySelector(".loading-spinner");
                 if (spinner)
                     spinner.remove();
-                const errDiv = document.createElement("div");
-                errDiv.className = "error";
-                errDiv.textContent = `Error: ${error.message}`;
-                out.appendChild(errDiv);
+                return new StreamingRenderer(out);
             });
+            renderers.set(model, list);
+        }
+        return list;
+    }
+    try {
+        yield streamMultiResponse(presentModels, prompt, e => {
+            var _a, _b, _c;
+            const model = e.model;
+            if (!model)
+                return;
+            if (e.event === "token" && e.delta !== undefined) {
+                const delta = e.delta;
+                replies.set(model, ((_a = replies.get(model)) !== null && _a !== void 0 ? _a : "") + delta);
+                renderersFor(model).forEach(r => r.append(delta));
+            }
+            else if (e.event === "done") {
+                pending.delete(model);
+                renderersFor(model).forEach(r => r.finish());
+                if (replyThreadId !== null) {
+                    threadCache.appendReply(replyThreadId, {
+                        user_input: prompt, model_name: model, model_response: (_b = replies.get(model)) !== null && _b !== void 0 ? _b : "",
+                    });
+                }
+            }
+            else if (e.event === "error") {
+                pending.delete(model);
+                if (e.degraded)
+                    setProviderStatus(model, "degraded");
+                showError(model, (_c = e.error) !== null && _c !== void 0 ? _c : "Request failed");
+            }
         });
-    });
+    }
+    catch (err) {
+        const error = err;
+        pending.forEach(model => showError(model, error.message));
+        pending.clear();
+    }
+    // Any model the server never answered for
+    pending.forEach(model => showError(model, "No response"));
 }));
 promptInput.addEventListener("keydown", e => {
     if (e.key === "Enter") {
@@ -229,6 +374,7 @@ function createLLMColumn(name) {
     col.appendChild(header);
     col.appendChild(output);
     llmContainer.insertBefore(col, addColumnContainer);
+    applyProviderStatus(name);
     const alert = document.getElementById("promptAlert");
     if (alert) {
         alert.classList.add("hide");
@@ -236,6 +382,8 @@ function createLLMColumn(name) {
     }
 }
 defaultLLMs.forEach(createLLMColumn);
+refreshProviderStatus();
+setInterval(refreshProviderStatus, PROVIDER_STATUS_INTERVAL_MS);
 addColumnBtn.addEventListener("click", e => {
     e.stopPropagation();
     const currentCount = getAllPresentModels().length;
@@ -261,6 +409,16 @@ modelDropdown.querySelectorAll(".dropdown-item").forEach(item => {
         modelDropdown.style.display = "none";
     });
 });
+// Cached history stays on this device only while its user is logged in, so the cache is
+// deleted before following the logout link
+const logoutLink = document.querySelector(".logout-link");
+if (logoutLink) {
+    logoutLink.addEventListener("click", (e) => __awaiter(void 0, void 0, void 0, function* () {
+        e.preventDefault();
+        yield threadCache.clearCache();
+        window.location.href = logoutLink.href;
+    }));
+}
 // New Chat Button
 const newChatBtn = document.getElementById("newChat");
 if (newChatBtn) {
@@ -269,6 +427,7 @@ if (newChatBtn) {
             // starts a new session
             yield fetch('/api/new_thread', { method: 'POST' });
             // Clear the UI and resets to default
+            activeThreadId = null;
             document.querySelectorAll(".llm-column").forEach(col => col.remove());
             defaultLLMs.forEach(createLLMColumn);
         }
@@ -287,6 +446,7 @@ document.querySelectorAll(".chat-thread").forEach(thread => {
         if (threadId)
             loadThreadHistory(parseInt(threadId));
     });
+    prefetchOnIntent(thread, parseInt(thread.getAttribute("data-thread-id")));
     const deleteBtn = thread.querySelector(".delete-thread-btn");
     if (deleteBtn) {
         deleteBtn.addEventListener("click", (e) => {
@@ -297,45 +457,65 @@ document.querySelectorAll(".chat-thread").forEach(thread => {
         });
     }
 });
-// Loads the chat history given the threadID
+// Adds one page of history bubbles; older pages are inserted above what is already shown
+function renderHistory(history, prepend) {
+    // Find which models in the chat thread history and make sure each has a column
+    const uniqueModels = new Set();
+    history.forEach((h) => uniqueModels.add(h.model_name));
+    uniqueModels.forEach(model => createLLMColumn(model));
+    uniqueModels.forEach(model => {
+        getColumnsFor(model).forEach(col => {
+            const out = col.querySelector(".llm-output");
+            if (!out)
+                return;
+            //removes the "Waiting for prompt" placeholder
+            const placeholder = out.querySelector(".placeholder");
+            if (placeholder)
+                placeholder.remove();
+            const fragment = document.createDocumentFragment();
+            history.filter((item) => item.model_name === model).forEach((item) => {
+                // Makes the user Bubble
+                const userBubble = document.createElement("div");
+                userBubble.className = "user-bubble";
+                userBubble.textContent = item.user_input;
+                fragment.appendChild(userBubble);
+                // History is drawn at once, without the typing animation
+                renderReply(fragment, item.model_response);
+            });
+            if (prepend)
+                out.insertBefore(fragment, out.firstChild);
+            else
+                out.appendChild(fragment);
+        });
+    });
+}
+function showThread(thread) {
+    document.querySelectorAll(".llm-column").forEach(col => col.remove());
+    renderHistory(thread.history.concat(thread.pending), false);
+}
+// Shows the cached copy of a thread at once, then asks the server only for newer messages.
+// Without a cached copy, the newest page is drawn first and older ones behind it.
 function loadThreadHistory(threadId) {
     return __awaiter(this, void 0, void 0, function* () {
+        activeThreadId = threadId;
+        const cached = yield threadCache.getThread(threadId);
+        if (cached)
+            showThread(cached);
         try {
-            const response = yield fetch(`/api/thread/${threadId}`);
-            if (!response.ok)
-                throw new Error("Failed to fetch history");
-            const data = yield response.json();
-            const history = data.history; // Array of {user_input, model_name, model_response, date_saved}
-            // Clears the current existing columns
-            document.querySelectorAll(".llm-column").forEach(col => col.remove());
-            // Find which models in the chat thread history and load them into new columns
-            const uniqueModels = new Set();
-            history.forEach((h) => uniqueModels.add(h.model_name));
-            uniqueModels.forEach(model => createLLMColumn(model));
-            // Iterate through history and fill in the chat bubbles
-            history.forEach((item) => {
-                const columns = getColumnsFor(item.model_name); //finds the column for the specific model
-                columns.forEach(col => {
-                    const out = col.querySelector(".llm-output");
-                    if (!out)
-                        return;
-                    //removes the "Waiting for prompt" placeholder
-                    const placeholder = out.querySelector(".placeholder");
-                    if (placeholder)
-                        placeholder.remove();
-                    // Makes the user Bubble
-                    const userBubble = document.createElement("div");
-                    userBubble.className = "user-bubble";
-                    userBubble.textContent = item.user_input;
-                    out.appendChild(userBubble);
-                    // Make the AI response bubble
-                    const responseDiv = document.createElement("div");
-                    responseDiv.className = "model-response";
-                    // @ts-ignore (reads marked library so html elements are rendered properly)
-                    responseDiv.innerHTML = marked.parse(item.model_response);
-                    out.appendChild(responseDiv);
-                });
+            const refreshed = yield threadCache.refresh(threadId, false, (items, older) => {
+                if (activeThreadId !== threadId)
+                    return;
+                if (!older)
+                    document.querySelectorAll(".llm-column").forEach(col => col.remove());
+                renderHistory(items, older);
             });
+            if (activeThreadId !== threadId)
+                return;
+            if (!refreshed)
+                throw new Error("Thread not found");
+            // A full fetch has drawn itself page by page already
+            if (cached && refreshed.changed)
+                showThread(refreshed.thread);
         }
         catch (error) {
             console.error("Error loading history:", error);
@@ -353,6 +533,9 @@ function deleteThread(threadId, element) {
             });
             if (response.ok) {
                 element.remove();
+                threadCache.dropThread(threadId);
+                if (activeThreadId === threadId)
+                    activeThreadId = null;
             }
             else {
                 alert("Failed to delete thread.");
@@ -363,4 +546,3 @@ function deleteThread(threadId, element) {
         }
     });
 }
-//# sourceMappingURL=app.js.map
\ No newline at end of file
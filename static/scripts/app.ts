@@ -1,4 +1,5 @@
-import { fetchLLMResponse, typeWords } from "./aiService.js";
+import { fetchProviderStatus, renderReply, streamMultiResponse, StreamingRenderer } from "./aiService.js";
+import * as threadCache from "./threadCache.js";
 
 const addColumnBtn = document.getElementById("addColumnBtn") as HTMLButtonElement;
 const addColumnContainer = document.getElementById("addColumnContainer") as HTMLDivElement;
@@ -17,6 +18,8 @@ const userStatus = userStatusInput?.value ?? "Free";
 const MAX_FREE_MODELS = 3;
 
 let promptAlertTimeout: number | undefined;
+// The thread on screen, whose cached copy new replies are added to
+let activeThreadId: number | null = null;
 
 // --- Sidebar Logic ---
 sidebarToggle.addEventListener("click", () => {
@@ -28,12 +31,13 @@ sidebarToggle.addEventListener("click", () => {
     }
 });
 
-function addThreadToSidebar(id: number, name: string, date: string, models: string) {
+function addThreadToSidebar(id: number, name: string, date: string, models: string, atEnd = false) {
     const threadList = document.getElementById("threadList");
     if (!threadList) return;
 
     const div = document.createElement("div");
     div.className = "chat-thread";
+    div.tabIndex = 0;
     div.setAttribute("data-thread-id", id.toString());
     
     div.innerHTML = `
@@ -53,6 +57,7 @@ function addThreadToSidebar(id: number, name: string, date: string, models: stri
         }
         loadThreadHistory(id);
     });
+    prefetchOnIntent(div, id);
 
     const deleteBtn = div.querySelector(".delete-thread-btn");
     if (deleteBtn) {
@@ -62,9 +67,69 @@ function addThreadToSidebar(id: number, name: string, date: string, models: stri
         });
     }
 
-    threadList.prepend(div);
+    if (atEnd) {
+        // Older pages go above the scroll sentinel, which stays last
+        threadList.insertBefore(div, document.getElementById("threadListSentinel"));
+    } else {
+        threadList.prepend(div);
+    }
+}
+
+// Hovering or focusing an entry fetches the thread ahead of the click
+const PREFETCH_HOVER_MS = 80;
+const PREFETCH_AGAIN_MS = 30000;
+const prefetchedAt = new Map<number, number>();
+
+function prefetchThread(id: number) {
+    const last = prefetchedAt.get(id);
+    if (id === activeThreadId || (last !== undefined && performance.now() - last < PREFETCH_AGAIN_MS)) return;
+    prefetchedAt.set(id, performance.now());
+    threadCache.refresh(id, true).catch(err => console.error("Error prefetching thread:", err));
+}
+
+function prefetchOnIntent(entry: HTMLElement, id: number) {
+    let hoverTimer: number | undefined;
+    entry.addEventListener("mouseenter", () => {
+        hoverTimer = window.setTimeout(() => prefetchThread(id), PREFETCH_HOVER_MS);
+    });
+    entry.addEventListener("mouseleave", () => window.clearTimeout(hoverTimer));
+    entry.addEventListener("focus", () => prefetchThread(id));
+    entry.addEventListener("keydown", e => {
+        if (e.key === "Enter" && e.target === entry) entry.click();
+    });
 }
 
+// --- Sidebar infinite scroll ---
+const threadListSentinel = document.getElementById("threadListSentinel") as HTMLDivElement | null;
+let loadingThreads = false;
+const threadObserver = new IntersectionObserver(entries => {
+    if (entries.some(e => e.isIntersecting)) loadMoreThreads();
+}, { root: document.getElementById("threadList") });
+
+async function loadMoreThreads() {
+    const cursor = threadListSentinel?.dataset.nextCursor;
+    if (!threadListSentinel || !cursor || loadingThreads) return;
+    loadingThreads = true;
+    try {
+        const response = await fetch(`/api/threads?cursor=${encodeURIComponent(cursor)}`);
+        if (!response.ok) throw new Error("Failed to fetch threads");
+        const data = await response.json();
+        data.threads.forEach((t: any) => addThreadToSidebar(t.id, t.name, t.date, t.models, true));
+        threadListSentinel.dataset.nextCursor = data.next_cursor ?? "";
+    } catch (err) {
+        console.error("Error loading threads:", err);
+    } finally {
+        loadingThreads = false;
+    }
+    // Re-observing re-checks visibility, in case one page didn't fill the list
+    if (threadListSentinel.dataset.nextCursor) {
+        threadObserver.unobserve(threadListSentinel);
+        threadObserver.observe(threadListSentinel);
+    }
+}
+
+if (threadListSentinel) threadObserver.observe(threadListSentinel);
+
 // Close mobile sidebar when clicking overlay
 mobileOverlay.addEventListener("click", () => {
     document.body.classList.remove("sidebar-mobile-open");
@@ -101,6 +166,40 @@ function showPromptAlert(message: string) {
     }, 4000);
 }
 
+// --- Provider health ---
+const PROVIDER_STATUS_INTERVAL_MS = 30000;
+const providerStatus = new Map<string, string>();
+
+// Flags a model's column header and dropdown entry while its provider is degraded
+function applyProviderStatus(model: string) {
+    const status = providerStatus.get(model) ?? "ok";
+    const degraded = status !== "ok";
+    const title = degraded ? `${model} is having problems right now (${status})` : "";
+    const targets = [
+        ...Array.from(llmContainer.querySelectorAll<HTMLDivElement>(`.column-header[data-model="${model}"]`)),
+        ...Array.from(modelDropdown.querySelectorAll<HTMLDivElement>(".dropdown-item"))
+            .filter(item => item.textContent?.trim() === model),
+    ];
+    targets.forEach(el => {
+        el.classList.toggle("degraded", degraded);
+        el.title = title;
+    });
+}
+
+function setProviderStatus(model: string, status: string) {
+    providerStatus.set(model, status);
+    applyProviderStatus(model);
+}
+
+async function refreshProviderStatus() {
+    try {
+        const statuses = await fetchProviderStatus();
+        Object.entries(statuses).forEach(([model, s]) => setProviderStatus(model, s.status));
+    } catch (err) {
+        console.error("Error loading provider status:", err);
+    }
+}
+
 function getColumnsFor(model: string): HTMLDivElement[] {
     return Array.from(llmContainer.querySelectorAll<HTMLDivElement>(".llm-column"))
         .filter(col => col.querySelector<HTMLDivElement>(".column-header")?.dataset.model === model);
@@ -137,6 +236,7 @@ submitPromptBtn.addEventListener("click", async () => {
         });
 
         const data = await response.json();
+        activeThreadId = data.id;
         
         // Only update sidebar if the server says it created a NEW thread
         if (data.status === "created") {
@@ -173,33 +273,68 @@ submitPromptBtn.addEventListener("click", async () => {
     promptInput.value = "";
     promptInput.focus();
 
-    presentModels.forEach(model => {
-        const p = fetchLLMResponse(model, prompt);
-        p.then(reply => {
-            const columns = getColumnsFor(model);
-            columns.forEach(col => {
-                const out = col.querySelector<HTMLDivElement>(".llm-output")!;
-                const spinner = out.querySelector<HTMLSpanElement>(".loading-spinner");
-                if (spinner) spinner.remove();
+    function showError(model: string, message: string) {
+        getColumnsFor(model).forEach(col => {
+            const out = col.querySelector<HTMLDivElement>(".llm-output")!;
+            const spinner = out.querySelector<HTMLSpanElement>(".loading-spinner");
+            if (spinner) spinner.remove();
 
-                // Now uses the updated typeWords function for markdown typing
-                typeWords(out, reply);
-            });
-        }).catch(err => {
-            const error = err as Error;
-            const columns = getColumnsFor(model);
-            columns.forEach(col => {
+            const errDiv = document.createElement("div");
+            errDiv.className = "error";
+            errDiv.textContent = `Error: ${message}`;
+            out.appendChild(errDiv);
+        });
+    }
+
+    const pending = new Set(presentModels.map(model => model.toUpperCase()));
+    const replyThreadId = activeThreadId;
+    const replies = new Map<string, string>();
+    const renderers = new Map<string, StreamingRenderer[]>();
+
+    // Swaps the spinner for live renderers the first time a model sends a token
+    function renderersFor(model: string): StreamingRenderer[] {
+        let list = renderers.get(model);
+        if (!list) {
+            list = getColumnsFor(model).map(col => {
                 const out = col.querySelector<HTMLDivElement>(".llm-output")!;
                 const spinner = out.querySelector<HTMLSpanElement>(".loading-spinner");
                 if (spinner) spinner.remove();
-
-                const errDiv = document.createElement("div");
-                errDiv.className = "error";
-                errDiv.textContent = `Error: ${error.message}`;
-                out.appendChild(errDiv);
+                return new StreamingRenderer(out);
             });
+            renderers.set(model, list);
+        }
+        return list;
+    }
+
+    try {
+        await streamMultiResponse(presentModels, prompt, e => {
+            const model = e.model;
+            if (!model) return;
+            if (e.event === "token" && e.delta !== undefined) {
+                const delta = e.delta;
+                replies.set(model, (replies.get(model) ?? "") + delta);
+                renderersFor(model).forEach(r => r.append(delta));
+            } else if (e.event === "done") {
+                pending.delete(model);
+                renderersFor(model).forEach(r => r.finish());
+                if (replyThreadId !== null) {
+                    threadCache.appendReply(replyThreadId, {
+                        user_input: prompt, model_name: model, model_response: replies.get(model) ?? "",
+                    });
+                }
+            } else if (e.event === "error") {
+                pending.delete(model);
+                if (e.degraded) setProviderStatus(model, "degraded");
+                showError(model, e.error ?? "Request failed");
+            }
         });
-    });
+    } catch (err) {
+        const error = err as Error;
+        pending.forEach(model => showError(model, error.message));
+        pending.clear();
+    }
+    // Any model the server never answered for
+    pending.forEach(model => showError(model, "No response"));
 });
 
 promptInput.addEventListener("keydown", e => {
@@ -247,6 +382,7 @@ function createLLMColumn(name: string) {
     col.appendChild(header);
     col.appendChild(output);
     llmContainer.insertBefore(col, addColumnContainer);
+    applyProviderStatus(name);
 
     const alert = document.getElementById("promptAlert");
     if (alert) {
@@ -257,6 +393,9 @@ function createLLMColumn(name: string) {
 
 defaultLLMs.forEach(createLLMColumn);
 
+refreshProviderStatus();
+setInterval(refreshProviderStatus, PROVIDER_STATUS_INTERVAL_MS);
+
 addColumnBtn.addEventListener("click", e => {
     e.stopPropagation();
     const currentCount = getAllPresentModels().length;
@@ -283,6 +422,17 @@ modelDropdown.querySelectorAll<HTMLDivElement>(".dropdown-item").forEach(item =>
     });
 });
 
+// Cached history stays on this device only while its user is logged in, so the cache is
+// deleted before following the logout link
+const logoutLink = document.querySelector<HTMLAnchorElement>(".logout-link");
+if (logoutLink) {
+    logoutLink.addEventListener("click", async e => {
+        e.preventDefault();
+        await threadCache.clearCache();
+        window.location.href = logoutLink.href;
+    });
+}
+
 // New Chat Button
 const newChatBtn = document.getElementById("newChat");
 if (newChatBtn) {
@@ -292,6 +442,7 @@ if (newChatBtn) {
             await fetch('/api/new_thread', { method: 'POST' });
 
             // Clear the UI and resets to default
+            activeThreadId = null;
             document.querySelectorAll(".llm-column").forEach(col => col.remove());
             defaultLLMs.forEach(createLLMColumn);
         } catch (err) {
@@ -310,6 +461,7 @@ document.querySelectorAll(".chat-thread").forEach(thread => {
         const threadId = thread.getAttribute("data-thread-id");
         if (threadId) loadThreadHistory(parseInt(threadId));
     });
+    prefetchOnIntent(thread as HTMLElement, parseInt(thread.getAttribute("data-thread-id")!));
 
     const deleteBtn = thread.querySelector(".delete-thread-btn");
     if (deleteBtn) {
@@ -320,48 +472,60 @@ document.querySelectorAll(".chat-thread").forEach(thread => {
         });
     }
 });
-// Loads the chat history given the threadID
-async function loadThreadHistory(threadId: number) {
-    try {
-        const response = await fetch(`/api/thread/${threadId}`);
-        if (!response.ok) throw new Error("Failed to fetch history");
-        
-        const data = await response.json();
-        const history = data.history; // Array of {user_input, model_name, model_response, date_saved}
-
-        // Clears the current existing columns
-        document.querySelectorAll(".llm-column").forEach(col => col.remove());
-
-        // Find which models in the chat thread history and load them into new columns
-        const uniqueModels = new Set<string>();
-        history.forEach((h: any) => uniqueModels.add(h.model_name));
-        uniqueModels.forEach(model => createLLMColumn(model));
-
-        // Iterate through history and fill in the chat bubbles
-        history.forEach((item: any) => {
-            const columns = getColumnsFor(item.model_name); //finds the column for the specific model
-            columns.forEach(col => {
-                const out = col.querySelector(".llm-output");
-                if (!out) return;
-                //removes the "Waiting for prompt" placeholder
-                const placeholder = out.querySelector(".placeholder");
-                if (placeholder) placeholder.remove();
+// Adds one page of history bubbles; older pages are inserted above what is already shown
+function renderHistory(history: any[], prepend: boolean) {
+    // Find which models in the chat thread history and make sure each has a column
+    const uniqueModels = new Set<string>();
+    history.forEach((h: any) => uniqueModels.add(h.model_name));
+    uniqueModels.forEach(model => createLLMColumn(model));
+
+    uniqueModels.forEach(model => {
+        getColumnsFor(model).forEach(col => {
+            const out = col.querySelector(".llm-output");
+            if (!out) return;
+            //removes the "Waiting for prompt" placeholder
+            const placeholder = out.querySelector(".placeholder");
+            if (placeholder) placeholder.remove();
 
+            const fragment = document.createDocumentFragment();
+            history.filter((item: any) => item.model_name === model).forEach((item: any) => {
                 // Makes the user Bubble
                 const userBubble = document.createElement("div");
                 userBubble.className = "user-bubble";
                 userBubble.textContent = item.user_input;
-                out.appendChild(userBubble);
-                
-                // Make the AI response bubble
-                const responseDiv = document.createElement("div");
-                responseDiv.className = "model-response";
-                 // @ts-ignore (reads marked library so html elements are rendered properly)
-                responseDiv.innerHTML = marked.parse(item.model_response);
-                out.appendChild(responseDiv);
+                fragment.appendChild(userBubble);
+
+                // History is drawn at once, without the typing animation
+                renderReply(fragment, item.model_response);
             });
+
+            if (prepend) out.insertBefore(fragment, out.firstChild);
+            else out.appendChild(fragment);
         });
+    });
+}
+
+function showThread(thread: threadCache.CachedThread) {
+    document.querySelectorAll(".llm-column").forEach(col => col.remove());
+    renderHistory(thread.history.concat(thread.pending), false);
+}
 
+// Shows the cached copy of a thread at once, then asks the server only for newer messages.
+// Without a cached copy, the newest page is drawn first and older ones behind it.
+async function loadThreadHistory(threadId: number) {
+    activeThreadId = threadId;
+    const cached = await threadCache.getThread(threadId);
+    if (cached) showThread(cached);
+    try {
+        const refreshed = await threadCache.refresh(threadId, false, (items, older) => {
+            if (activeThreadId !== threadId) return;
+            if (!older) document.querySelectorAll(".llm-column").forEach(col => col.remove());
+            renderHistory(items, older);
+        });
+        if (activeThreadId !== threadId) return;
+        if (!refreshed) throw new Error("Thread not found");
+        // A full fetch has drawn itself page by page already
+        if (cached && refreshed.changed) showThread(refreshed.thread);
     } catch (error) {
         console.error("Error loading history:", error);
         showPromptAlert("Could not load chat history.");
@@ -377,6 +541,8 @@ async function deleteThread(threadId: number, element: HTMLElement) {
         });
         if (response.ok) {
             element.remove();
+            threadCache.dropThread(threadId);
+            if (activeThreadId === threadId) activeThreadId = null;
         } else {
             alert("Failed to delete thread.");
         }
@@ -0,0 +1,224 @@
+// Thread histories kept in IndexedDB, so reopening a thread draws at once and the server is
+// only asked for messages saved after the cached copy's last one
+var __awaiter = (this && this.__awaiter) || function (thisArg, _arguments, P, generator) {
+    function adopt(value) { return value instanceof P ? value : new P(function (resolve) { resolve(value); }); }
+    return new (P || (P = Promise))(function (resolve, reject) {
+        function fulfilled(value) { try { step(generator.next(value)); } catch (e) { reject(e); } }
+        function rejected(value) { try { step(generator["throw"](value)); } catch (e) { reject(e); } }
+        function step(result) { result.done ? resolve(result.value) : adopt(result.value).then(fulfilled, rejected); }
+        step((generator = generator.apply(thisArg, _arguments || [])).next());
+    });
+};
+const STORE = "threads";
+const DELTA_PAGE_SIZE = 200;
+let database = null;
+// One refresh per thread at a time
+const inFlight = new Map();
+// The server declined a prefetch: an archived thread is only restored by opening it
+class PrefetchDeclined extends Error {
+}
+// One database per user, so a shared browser never shows one user's history to another
+function databaseName() {
+    var _a, _b;
+    const userId = (_b = (_a = document.getElementById("userId")) === null || _a === void 0 ? void 0 : _a.value) !== null && _b !== void 0 ? _b : "";
+    return `thread-cache-${userId}`;
+}
+function openDatabase() {
+    if (!database) {
+        database = new Promise(resolve => {
+            if (typeof indexedDB === "undefined")
+                return resolve(null);
+            const request = indexedDB.open(databaseName(), 1);
+            request.onupgradeneeded = () => {
+                request.result.createObjectStore(STORE, { keyPath: "threadId" });
+            };
+            request.onsuccess = () => {
+                // Let clearCache in another tab delete the database
+                request.result.onversionchange = () => request.result.close();
+                resolve(request.result);
+            };
+            // Private windows may refuse storage; everything then comes from the server
+            request.onerror = () => resolve(null);
+            request.onblocked = () => resolve(null);
+        });
+    }
+    return database;
+}
+function withStore(mode, use) {
+    return __awaiter(this, void 0, void 0, function* () {
+        const db = yield openDatabase();
+        if (!db)
+            return undefined;
+        return new Promise(resolve => {
+            const request = use(db.transaction(STORE, mode).objectStore(STORE));
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => resolve(undefined);
+        });
+    });
+}
+export function getThread(threadId) {
+    return withStore("readonly", store => store.get(threadId));
+}
+function putThread(thread) {
+    return __awaiter(this, void 0, void 0, function* () {
+        yield withStore("readwrite", store => store.put(thread));
+    });
+}
+export function dropThread(threadId) {
+    return __awaiter(this, void 0, void 0, function* () {
+        yield withStore("readwrite", store => store.delete(threadId));
+    });
+}
+// Deletes this user's cache. Resolves once it is gone, or blocked by a tab that hasn't let go yet
+export function clearCache() {
+    return __awaiter(this, void 0, void 0, function* () {
+        if (typeof indexedDB === "undefined")
+            return;
+        // Our own open connection would keep the delete waiting
+        const db = database ? yield database : null;
+        database = null;
+        db === null || db === void 0 ? void 0 : db.close();
+        yield new Promise(resolve => {
+            const request = indexedDB.deleteDatabase(databaseName());
+            request.onsuccess = () => resolve();
+            request.onerror = () => resolve();
+            request.onblocked = () => resolve();
+        });
+    });
+}
+// Adds a reply that just finished streaming to the cached copy of its thread
+export function appendReply(threadId, item) {
+    return __awaiter(this, void 0, void 0, function* () {
+        const thread = yield getThread(threadId);
+        if (!thread)
+            return;
+        thread.pending.push(item);
+        yield putThread(thread);
+    });
+}
+function fetchPage(url) {
+    return __awaiter(this, void 0, void 0, function* () {
+        const response = yield fetch(url);
+        // The thread was deleted or isn't this user's
+        if (response.status === 403 || response.status === 404)
+            return null;
+        if (response.status === 204)
+            throw new PrefetchDeclined();
+        if (!response.ok)
+            throw new Error("Failed to fetch history");
+        return response.json();
+    });
+}
+function threadUrl(threadId, prefetch, extra = {}) {
+    const params = new URLSearchParams();
+    Object.entries(extra).forEach(([key, value]) => params.set(key, String(value)));
+    if (prefetch)
+        params.set("prefetch", "1");
+    const query = params.toString();
+    return `/api/thread/${threadId}` + (query ? `?${query}` : "");
+}
+// Newest page first, then older ones; onPage sees each as it arrives
+function fetchWhole(threadId, prefetch, onPage) {
+    return __awaiter(this, void 0, void 0, function* () {
+        const first = yield fetchPage(threadUrl(threadId, prefetch));
+        if (!first)
+            return null;
+        let history = first.history;
+        if (onPage)
+            onPage(first.history, false);
+        let before = first.next_before_id;
+        while (before !== null && before !== undefined) {
+            const page = yield fetchPage(threadUrl(threadId, prefetch, { before_id: before }));
+            if (!page)
+                return null;
+            history = page.history.concat(history);
+            if (onPage)
+                onPage(page.history, true);
+            before = page.next_before_id;
+        }
+        return {
+            threadId,
+            lastId: history.length ? history[history.length - 1].id : 0,
+            messageCount: first.message_count,
+            history,
+            pending: [],
+        };
+    });
+}
+function sameReplies(saved, pending) {
+    return saved.length === pending.length && saved.every((item, i) => item.user_input === pending[i].user_input && item.model_response === pending[i].model_response);
+}
+// Only messages newer than the cached tail; null if the cache can't be brought up to date
+function fetchDelta(cached, prefetch) {
+    return __awaiter(this, void 0, void 0, function* () {
+        const added = [];
+        let after = cached.lastId;
+        let messageCount = cached.messageCount;
+        while (after !== null && after !== undefined) {
+            const page = yield fetchPage(threadUrl(cached.threadId, prefetch, { after_id: after, limit: DELTA_PAGE_SIZE }));
+            if (!page)
+                return null;
+            added.push(...page.history);
+            messageCount = page.message_count;
+            after = page.next_after_id;
+        }
+        const history = cached.history.concat(added);
+        // Anything but appends (a message removed or renumbered) means starting over
+        if (history.length !== messageCount)
+            return null;
+        const thread = {
+            threadId: cached.threadId,
+            lastId: history.length ? history[history.length - 1].id : 0,
+            messageCount,
+            history,
+            // Saved replies replace the local copies of them
+            pending: added.length ? [] : cached.pending,
+        };
+        return { thread, changed: added.length > 0 && !sameReplies(added, cached.pending) };
+    });
+}
+function refreshThread(threadId, prefetch, onPage) {
+    return __awaiter(this, void 0, void 0, function* () {
+        const cached = yield getThread(threadId);
+        if (cached) {
+            const refreshed = yield fetchDelta(cached, prefetch);
+            if (refreshed) {
+                yield putThread(refreshed.thread);
+                return refreshed;
+            }
+        }
+        const thread = yield fetchWhole(threadId, prefetch, onPage);
+        if (!thread) {
+            yield dropThread(threadId);
+            return null;
+        }
+        yield putThread(thread);
+        return { thread, changed: true };
+    });
+}
+// Brings the cached copy up to date. Returns null if the thread is gone, or if a prefetch was declined.
+export function refresh(threadId, prefetch, onPage) {
+    return __awaiter(this, void 0, void 0, function* () {
+        const running = inFlight.get(threadId);
+        if (running) {
+            // A prefetch already on its way is enough for another prefetch; opening the thread
+            // still asks once more, since that request is what makes it the current thread
+            if (prefetch)
+                return running;
+            yield running.catch(() => null);
+        }
+        const refreshing = refreshThread(threadId, prefetch, onPage).catch(err => {
+            if (err instanceof PrefetchDeclined)
+                return null;
+            throw err;
+        });
+        inFlight.set(threadId, refreshing);
+        try {
+            return yield refreshing;
+        }
+        finally {
+            if (inFlight.get(threadId) === refreshing)
+                inFlight.delete(threadId);
+        }
+    });
+}
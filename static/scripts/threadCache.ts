@@ -0,0 +1,221 @@
+// Thread histories kept in IndexedDB, so reopening a thread draws at once and the server is
+// only asked for messages saved after the cached copy's last one
+
+export interface HistoryItem {
+    id?: number;
+    user_input: string;
+    model_name: string;
+    model_response: string;
+    date_saved?: string;
+}
+
+export interface CachedThread {
+    threadId: number;
+    // Id of the newest message the server has confirmed
+    lastId: number;
+    messageCount: number;
+    history: HistoryItem[];
+    // Replies streamed in this browser that the server hadn't saved yet when last asked
+    pending: HistoryItem[];
+}
+
+export interface Refreshed {
+    thread: CachedThread;
+    // False when the refresh only confirmed what the cache already showed
+    changed: boolean;
+}
+
+const STORE = "threads";
+const DELTA_PAGE_SIZE = 200;
+
+let database: Promise<IDBDatabase | null> | null = null;
+// One refresh per thread at a time
+const inFlight = new Map<number, Promise<Refreshed | null>>();
+
+// The server declined a prefetch: an archived thread is only restored by opening it
+class PrefetchDeclined extends Error {}
+
+// One database per user, so a shared browser never shows one user's history to another
+function databaseName(): string {
+    const userId = (document.getElementById("userId") as HTMLInputElement | null)?.value ?? "";
+    return `thread-cache-${userId}`;
+}
+
+function openDatabase(): Promise<IDBDatabase | null> {
+    if (!database) {
+        database = new Promise(resolve => {
+            if (typeof indexedDB === "undefined") return resolve(null);
+            const request = indexedDB.open(databaseName(), 1);
+            request.onupgradeneeded = () => {
+                request.result.createObjectStore(STORE, { keyPath: "threadId" });
+            };
+            request.onsuccess = () => {
+                // Let clearCache in another tab delete the database
+                request.result.onversionchange = () => request.result.close();
+                resolve(request.result);
+            };
+            // Private windows may refuse storage; everything then comes from the server
+            request.onerror = () => resolve(null);
+            request.onblocked = () => resolve(null);
+        });
+    }
+    return database;
+}
+
+async function withStore<T>(mode: IDBTransactionMode, use: (store: IDBObjectStore) => IDBRequest<T>): Promise<T | undefined> {
+    const db = await openDatabase();
+    if (!db) return undefined;
+    return new Promise(resolve => {
+        const request = use(db.transaction(STORE, mode).objectStore(STORE));
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => resolve(undefined);
+    });
+}
+
+export function getThread(threadId: number): Promise<CachedThread | undefined> {
+    return withStore<CachedThread>("readonly", store => store.get(threadId));
+}
+
+async function putThread(thread: CachedThread): Promise<void> {
+    await withStore("readwrite", store => store.put(thread));
+}
+
+export async function dropThread(threadId: number): Promise<void> {
+    await withStore("readwrite", store => store.delete(threadId));
+}
+
+// Deletes this user's cache. Resolves once it is gone, or blocked by a tab that hasn't let go yet
+export async function clearCache(): Promise<void> {
+    if (typeof indexedDB === "undefined") return;
+    // Our own open connection would keep the delete waiting
+    const db = database ? await database : null;
+    database = null;
+    db?.close();
+    await new Promise<void>(resolve => {
+        const request = indexedDB.deleteDatabase(databaseName());
+        request.onsuccess = () => resolve();
+        request.onerror = () => resolve();
+        request.onblocked = () => resolve();
+    });
+}
+
+// Adds a reply that just finished streaming to the cached copy of its thread
+export async function appendReply(threadId: number, item: HistoryItem): Promise<void> {
+    const thread = await getThread(threadId);
+    if (!thread) return;
+    thread.pending.push(item);
+    await putThread(thread);
+}
+
+async function fetchPage(url: string): Promise<any | null> {
+    const response = await fetch(url);
+    // The thread was deleted or isn't this user's
+    if (response.status === 403 || response.status === 404) return null;
+    if (response.status === 204) throw new PrefetchDeclined();
+    if (!response.ok) throw new Error("Failed to fetch history");
+    return response.json();
+}
+
+function threadUrl(threadId: number, prefetch: boolean, extra: Record<string, string | number> = {}): string {
+    const params = new URLSearchParams();
+    Object.entries(extra).forEach(([key, value]) => params.set(key, String(value)));
+    if (prefetch) params.set("prefetch", "1");
+    const query = params.toString();
+    return `/api/thread/${threadId}` + (query ? `?${query}` : "");
+}
+
+// Newest page first, then older ones; onPage sees each as it arrives
+async function fetchWhole(threadId: number, prefetch: boolean,
+                          onPage?: (items: HistoryItem[], older: boolean) => void): Promise<CachedThread | null> {
+    const first = await fetchPage(threadUrl(threadId, prefetch));
+    if (!first) return null;
+    let history: HistoryItem[] = first.history;
+    if (onPage) onPage(first.history, false);
+    let before = first.next_before_id;
+    while (before !== null && before !== undefined) {
+        const page = await fetchPage(threadUrl(threadId, prefetch, { before_id: before }));
+        if (!page) return null;
+        history = page.history.concat(history);
+        if (onPage) onPage(page.history, true);
+        before = page.next_before_id;
+    }
+    return {
+        threadId,
+        lastId: history.length ? history[history.length - 1].id! : 0,
+        messageCount: first.message_count,
+        history,
+        pending: [],
+    };
+}
+
+function sameReplies(saved: HistoryItem[], pending: HistoryItem[]): boolean {
+    return saved.length === pending.length && saved.every((item, i) =>
+        item.user_input === pending[i].user_input && item.model_response === pending[i].model_response);
+}
+
+// Only messages newer than the cached tail; null if the cache can't be brought up to date
+async function fetchDelta(cached: CachedThread, prefetch: boolean): Promise<Refreshed | null> {
+    const added: HistoryItem[] = [];
+    let after: number | null = cached.lastId;
+    let messageCount = cached.messageCount;
+    while (after !== null && after !== undefined) {
+        const page = await fetchPage(threadUrl(cached.threadId, prefetch, { after_id: after, limit: DELTA_PAGE_SIZE }));
+        if (!page) return null;
+        added.push(...page.history);
+        messageCount = page.message_count;
+        after = page.next_after_id;
+    }
+    const history = cached.history.concat(added);
+    // Anything but appends (a message removed or renumbered) means starting over
+    if (history.length !== messageCount) return null;
+    const thread: CachedThread = {
+        threadId: cached.threadId,
+        lastId: history.length ? history[history.length - 1].id! : 0,
+        messageCount,
+        history,
+        // Saved replies replace the local copies of them
+        pending: added.length ? [] : cached.pending,
+    };
+    return { thread, changed: added.length > 0 && !sameReplies(added, cached.pending) };
+}
+
+async function refreshThread(threadId: number, prefetch: boolean,
+                             onPage?: (items: HistoryItem[], older: boolean) => void): Promise<Refreshed | null> {
+    const cached = await getThread(threadId);
+    if (cached) {
+        const refreshed = await fetchDelta(cached, prefetch);
+        if (refreshed) {
+            await putThread(refreshed.thread);
+            return refreshed;
+        }
+    }
+    const thread = await fetchWhole(threadId, prefetch, onPage);
+    if (!thread) {
+        await dropThread(threadId);
+        return null;
+    }
+    await putThread(thread);
+    return { thread, changed: true };
+}
+
+// Brings the cached copy up to date. Returns null if the thread is gone, or if a prefetch was declined.
+export async function refresh(threadId: number, prefetch: boolean,
+                              onPage?: (items: HistoryItem[], older: boolean) => void): Promise<Refreshed | null> {
+    const running = inFlight.get(threadId);
+    if (running) {
+        // A prefetch already on its way is enough for another prefetch; opening the thread
+        // still asks once more, since that request is what makes it the current thread
+        if (prefetch) return running;
+        await running.catch(() => null);
+    }
+    const refreshing = refreshThread(threadId, prefetch, onPage).catch(err => {
+        if (err instanceof PrefetchDeclined) return null;
+        throw err;
+    });
+    inFlight.set(threadId, refreshing);
+    try {
+        return await refreshing;
+    } finally {
+        if (inFlight.get(threadId) === refreshing) inFlight.delete(threadId);
+    }
+}
@@ -0,0 +1,18 @@
+import pytest
+from flask import Flask
+
+import modules.extensions  # noqa: F401  Loads modules.dbms without a circular import
+from modules.dbms import db
+
+
+@pytest.fixture
+def db_app(tmp_path):
+    """An app context on an empty database file with the current models' tables"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'test.db'}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
@@ -0,0 +1,29 @@
+import threading
+
+from flask import Flask
+
+from modules.archive import Archiver, ArchivePolicy
+
+
+def _archiver_threads() -> list[threading.Thread]:
+    return [thread for thread in threading.enumerate() if thread.name == "archiver"]
+
+
+def test_archiver_starts_only_when_asked_and_in_one_process_per_lock(tmp_path):
+    lock_path = str(tmp_path / "archiver.lock")
+    app = Flask(__name__)
+    first = Archiver(app, ArchivePolicy(), 3600, lock_path)
+    # A second worker serving the same database
+    second = Archiver(app, ArchivePolicy(), 3600, lock_path)
+    try:
+        assert _archiver_threads() == []
+
+        assert first.start() is True
+        assert first.start() is True
+        assert second.start() is False
+        assert len(_archiver_threads()) == 1
+    finally:
+        first.close()
+        second.close()
+    first._thread.join(2)
+    assert _archiver_threads() == []
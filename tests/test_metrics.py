@@ -0,0 +1,46 @@
+import pytest
+
+from modules import metrics
+
+
+@pytest.fixture
+def cache_stats():
+    stats = {"size": 3, "hits": 7}
+    collector = metrics.SnapshotCollector("test_cache", "Test cache", lambda: stats, counters=("hits",))
+    yield stats
+    metrics.REGISTRY.remove(collector)
+
+
+def test_snapshot_fields_render_as_counters_and_gauges(cache_stats):
+    lines = metrics.render().splitlines()
+
+    assert "# TYPE test_cache_hits_total counter" in lines
+    assert "test_cache_hits_total 7" in lines
+    assert "# TYPE test_cache_size gauge" in lines
+    assert "test_cache_size 3" in lines
+
+    # Read at scrape time, not when registered
+    cache_stats["hits"] = 8
+    assert "test_cache_hits_total 8" in metrics.render().splitlines()
+
+
+def test_labelled_snapshots_and_disabled_components():
+    pools = {"http://b": {"in_flight": 1, "requests_total": 5}, "http://a": {"in_flight": 0, "requests_total": 2}}
+    labelled = metrics.SnapshotCollector("test_pool", "Test pool", lambda: pools,
+                                         counters=("requests_total",), label="host")
+    disabled = metrics.SnapshotCollector("test_off", "Switched off", lambda: None)
+    try:
+        assert labelled.render() == [
+            "# HELP test_pool_in_flight Test pool: in flight.",
+            "# TYPE test_pool_in_flight gauge",
+            'test_pool_in_flight{host="http://a"} 0',
+            'test_pool_in_flight{host="http://b"} 1',
+            "# HELP test_pool_requests_total Test pool: requests total.",
+            "# TYPE test_pool_requests_total counter",
+            'test_pool_requests_total{host="http://a"} 2',
+            'test_pool_requests_total{host="http://b"} 5',
+        ]
+        assert disabled.render() == []
+    finally:
+        metrics.REGISTRY.remove(labelled)
+        metrics.REGISTRY.remove(disabled)
@@ -0,0 +1,38 @@
+import pytest
+from sqlalchemy import text
+
+from modules import migrations
+from modules.dbms import db
+
+
+def _database_from_before_migration_2(emails: list[str]) -> None:
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP INDEX ux_users_email"))
+        conn.execute(text("PRAGMA user_version = 1"))
+        for email in emails:
+            conn.execute(text("INSERT INTO users (email, pwd_hash, status) VALUES (:email, x'00', 'Free')"),
+                         {"email": email})
+
+
+def _user_indexes() -> set[str]:
+    with db.engine.connect() as conn:
+        return {row.name for row in conn.execute(text("PRAGMA index_list(users)"))}
+
+
+def test_unique_email_migration_refuses_duplicate_emails(db_app):
+    _database_from_before_migration_2(["a@example.com", "b@example.com", "b@example.com"])
+
+    with pytest.raises(RuntimeError, match="duplicate emails: b@example.com"):
+        migrations.migrate(db.engine)
+
+    # Nothing was half applied; the upgrade can be re-run once the accounts are merged
+    with db.engine.connect() as conn:
+        assert migrations.current_version(conn) == 1
+    assert "ux_users_email" not in _user_indexes()
+
+
+def test_unique_email_migration_adds_the_index(db_app):
+    _database_from_before_migration_2(["a@example.com", "b@example.com"])
+
+    assert migrations.migrate(db.engine) == [2, 3, 4, 5]
+    assert "ux_users_email" in _user_indexes()
@@ -0,0 +1,30 @@
+import pytest
+
+import modules.extensions as extensions
+from modules.dbms import User
+from modules.password_hashing import HashingBusy
+
+
+class _SlowRehasher:
+    """Verifies fine but can't produce a new hash in time"""
+    def __init__(self, error: BaseException):
+        self.error = error
+
+    def verify(self, pwd: str, pep_hash: bytes) -> tuple[bool, bool]:
+        return pwd == "right", True
+
+    def hash(self, pwd: str) -> bytes:
+        raise self.error
+
+    def note_rehash(self) -> None:
+        raise AssertionError("no rehash happened")
+
+
+@pytest.mark.parametrize("error", [HashingBusy("full"), TimeoutError("slow")])
+def test_failed_rehash_keeps_old_hash_and_accepts_the_password(monkeypatch, error):
+    monkeypatch.setattr(extensions, "pwd_hasher", _SlowRehasher(error))
+    user = User(email="a@example.com", pwd_hash=b"old")
+
+    assert user.verify_password("right") is True
+    assert user.pwd_hash == b"old"
+    assert user.verify_password("wrong") is False
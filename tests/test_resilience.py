@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from modules.resilience import ProviderGuard, ProviderUnavailable, ResiliencePolicy
+
+
+def _policy(**overrides) -> ResiliencePolicy:
+    defaults = dict(max_concurrency=1, acquire_timeout=0.1, deadline=2.0, max_retries=0,
+                    breaker_failures=1, breaker_reset=0.05)
+    defaults.update(overrides)
+    return ResiliencePolicy(**defaults)
+
+
+def _wait_for(condition, timeout: float = 2.0) -> None:
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "condition not reached in time"
+        time.sleep(0.01)
+
+
+def _blocked_call(guard: ProviderGuard, release: threading.Event) -> threading.Thread:
+    thread = threading.Thread(target=guard.call, args=(release.wait,), daemon=True)
+    thread.start()
+    _wait_for(lambda: guard.snapshot()["in_flight"] == 1)
+    return thread
+
+
+def test_caller_that_gives_up_waiting_takes_no_slot():
+    guard = ProviderGuard("TEST", _policy())
+    release = threading.Event()
+    holder = _blocked_call(guard, release)
+
+    with pytest.raises(ProviderUnavailable, match="too many requests"):
+        guard.call(lambda: "never runs")
+    assert guard.snapshot()["in_flight"] == 1
+
+    release.set()
+    holder.join(2)
+    _wait_for(lambda: guard.snapshot()["in_flight"] == 0)
+    # Every slot is back: the full limit can be used again
+    assert guard.call(lambda: "ok") == "ok"
+
+
+def test_call_abandoned_at_deadline_keeps_its_slot_until_the_provider_returns():
+    guard = ProviderGuard("TEST", _policy(deadline=0.1, breaker_failures=5))
+    release = threading.Event()
+
+    with pytest.raises(ProviderUnavailable, match="no reply within"):
+        guard.call(release.wait)
+    assert guard.snapshot()["in_flight"] == 1
+
+    release.set()
+    _wait_for(lambda: guard.snapshot()["in_flight"] == 0)
+    assert guard.call(lambda: "ok") == "ok"
+
+
+def test_stream_closed_by_its_consumer_frees_slot_and_probe():
+    guard = ProviderGuard("TEST", _policy())
+    guard.breaker.record_failure()
+    time.sleep(0.06)
+    assert guard.breaker.state == "half-open"
+
+    stream = guard.stream(lambda: iter(["a", "b", "c"]))
+    assert next(stream) == "a"
+    stream.close()
+
+    assert guard.snapshot()["in_flight"] == 0
+    # The abandoned probe doesn't block the next one
+    assert guard.breaker.admit() is True
+
+
+def test_stream_past_its_deadline_fails_and_frees_the_slot():
+    guard = ProviderGuard("TEST", _policy(deadline=0.05, breaker_failures=5))
+
+    def slow_chunks():
+        yield "a"
+        time.sleep(0.1)
+        yield "b"
+
+    with pytest.raises(ProviderUnavailable, match="not finished within"):
+        list(guard.stream(slow_chunks))
+    assert guard.snapshot()["in_flight"] == 0
+    assert guard.snapshot()["deadline_exceeded"] == 1
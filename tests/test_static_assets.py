@@ -0,0 +1,39 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from modules import static_assets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def static_dir(tmp_path):
+    target = tmp_path / "static"
+    shutil.copytree(os.path.join(ROOT, "static"), target, ignore=shutil.ignore_patterns("dist"))
+    return str(target)
+
+
+def test_build_refuses_to_run_without_esbuild(static_dir, monkeypatch):
+    monkeypatch.setattr(static_assets.shutil, "which", lambda name: None)
+    with pytest.raises(static_assets.EsbuildMissing):
+        static_assets.build(static_dir)
+    assert not os.path.exists(os.path.join(static_dir, static_assets.DIST_DIR))
+
+
+@pytest.mark.skipif(shutil.which("esbuild") is None or shutil.which("node") is None,
+                    reason="needs esbuild and node")
+def test_built_page_scripts_parse(static_dir, tmp_path):
+    built = static_assets.build(static_dir)
+    names = {asset.name for asset in built}
+    assert "scripts/app.js" in names
+    # Imported modules are bundled into their page, not built on their own
+    assert "scripts/aiService.js" not in names
+    for asset in built:
+        if asset.name.endswith(".js"):
+            # The .mjs extension makes node parse it as the ES module the page loads
+            module = tmp_path / (os.path.basename(asset.path) + ".mjs")
+            shutil.copy(os.path.join(static_dir, asset.path), module)
+            subprocess.run(["node", "--check", str(module)], check=True)
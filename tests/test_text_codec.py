@@ -0,0 +1,55 @@
+import lzma
+
+import pytest
+
+from modules import text_codec
+
+LONG_TEXT = "The quick brown fox jumps over the lazy dog. Ünïcödé ✓ " * 20
+
+
+def _codecs() -> list[text_codec.TextCodec]:
+    codecs: list[text_codec.TextCodec] = [text_codec.RawCodec(), text_codec.ZlibCodec()]
+    if text_codec.zstandard is not None:
+        codecs.append(text_codec.ZstdCodec())
+    return codecs
+
+
+@pytest.mark.parametrize("codec", _codecs(), ids=lambda codec: codec.name)
+def test_tagged_blobs_round_trip(codec):
+    blob = text_codec.encode(LONG_TEXT, codec)
+
+    assert blob[0] == codec.tag
+    assert text_codec.codec_of(blob) == codec.name
+    assert text_codec.decode(blob) == LONG_TEXT
+
+
+@pytest.mark.parametrize("codec", _codecs(), ids=lambda codec: codec.name)
+def test_short_text_is_stored_raw(codec):
+    blob = text_codec.encode("hi ✓", codec)
+
+    assert blob == bytes((text_codec.TAG_RAW,)) + "hi ✓".encode()
+    assert text_codec.decode(blob) == "hi ✓"
+
+
+def test_dictionary_blobs_round_trip_and_carry_their_dictionary_id():
+    if text_codec.zstandard is None:
+        pytest.skip("needs the 'zstandard' package")
+    samples = [f"message {i}: {LONG_TEXT[i:]}".encode() for i in range(200)]
+    codec = text_codec.register_dictionary(
+        text_codec.ZstdDictCodec(text_codec.train_dictionary(samples, dict_size=4096))
+    )
+    blob = text_codec.encode(LONG_TEXT, codec)
+
+    assert text_codec.codec_of(blob) == "zstd-dict"
+    assert int.from_bytes(blob[1:5], "big") == codec.dict_id
+    assert text_codec.decode(blob) == LONG_TEXT
+
+
+@pytest.mark.parametrize("blob, codec_name, expected", [
+    (lzma.compress(LONG_TEXT.encode()), "lzma", LONG_TEXT),
+    ("plain ✓".encode(), "legacy-raw", "plain ✓"),
+    (b"", "legacy-raw", ""),
+])
+def test_blobs_from_before_codec_tags_still_decode(blob, codec_name, expected):
+    assert text_codec.codec_of(blob) == codec_name
+    assert text_codec.decode(blob) == expected
@@ -0,0 +1,107 @@
+import lzma
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from modules import dbms, migrations, turn_migration
+from modules.dbms import db, ChatHistory, ChatResponse, ChatThread, ChatTurn, User
+
+T0 = datetime(2024, 5, 1, 12, 0, 0)
+
+# (id, thread, prompt blob, model, response blob, saved); ids have gaps like a real table
+LEGACY_ROWS = [
+    (3, 1, dbms.db_encode_text("hello"), "CHATGPT", dbms.db_encode_text("hi from gpt " * 20), T0),
+    (4, 1, dbms.db_encode_text("hello"), "CLAUDE", dbms.db_encode_text("hi from claude"), T0 + timedelta(seconds=20)),
+    (7, 1, dbms.db_encode_text("more"), "CHATGPT", dbms.db_encode_text("more from gpt"), T0 + timedelta(minutes=1)),
+    # Same prompt again, but CHATGPT already answered that turn
+    (8, 1, dbms.db_encode_text("hello"), "CHATGPT", dbms.db_encode_text("hi again"), T0 + timedelta(minutes=2)),
+    # Outside the window of the "more" turn
+    (10, 1, dbms.db_encode_text("more"), "CLAUDE", dbms.db_encode_text("late claude"), T0 + timedelta(minutes=10)),
+    # Blobs from before codec tags: xz and plain UTF-8 of the same prompt
+    (15, 2, lzma.compress("old".encode()), "GEMINI", lzma.compress("xz reply".encode()), T0),
+    (16, 2, "old".encode(), "MISTRAL", "raw reply".encode(), T0 + timedelta(seconds=5)),
+]
+EXPECTED = {
+    1: [(3, "hello", "CHATGPT", "hi from gpt " * 20), (4, "hello", "CLAUDE", "hi from claude"),
+        (7, "more", "CHATGPT", "more from gpt"), (8, "hello", "CHATGPT", "hi again"),
+        (10, "more", "CLAUDE", "late claude")],
+    2: [(15, "old", "GEMINI", "xz reply"), (16, "old", "MISTRAL", "raw reply")],
+}
+
+
+def _seed_legacy_database() -> None:
+    db.session.add(User(id=1, email="a@example.com", pwd_hash=b"x"))
+    db.session.add_all([ChatThread(id=1, user_id=1, thread_name="one"), ChatThread(id=2, user_id=1, thread_name="two")])
+    db.session.add_all([
+        ChatHistory(id=row_id, thread_id=thread_id, _user_input=prompt, model_name=model,
+                    _model_response=response, date_saved=saved)
+        for row_id, thread_id, prompt, model, response, saved in LEGACY_ROWS
+    ])
+    db.session.commit()
+    assert migrations.migrate(db.engine) == [1, 2, 3, 4, 5]
+
+
+def _history(thread_id: int, after_id: int = 0) -> list[tuple[int, str, str, str]]:
+    return [
+        (row.id, dbms.db_decode_text(row._user_input), row.model_name, dbms.db_decode_text(row._model_response))
+        for row in dbms.get_history_after(thread_id, after_id)
+    ]
+
+
+def _turns(thread_id: int) -> list[list[int]]:
+    turns: dict[int, list[int]] = {}
+    for row in dbms.get_history_after(thread_id, 0):
+        turns.setdefault(row.turn_id, []).append(row.id)
+    return list(turns.values())
+
+
+def _table_counts() -> tuple[int, int, int]:
+    with db.engine.connect() as conn:
+        return tuple(conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar_one()
+                     for table in ("chat_history", "chat_turns", "chat_responses"))
+
+
+def test_converted_history_keeps_ids_text_models_and_order(db_app):
+    _seed_legacy_database()
+
+    assert turn_migration.ensure_converted(db.session, 1) is True
+    assert turn_migration.convert_batch(db.session, 10) == (1, 2)
+    assert turn_migration.remaining(db.session) == 0
+
+    assert _history(1) == EXPECTED[1]
+    assert _history(2) == EXPECTED[2]
+    assert _turns(1) == [[3, 4], [7], [8], [10]]
+    assert _turns(2) == [[15, 16]]
+    # A client holding a cursor from before the migration gets exactly what followed it
+    assert _history(1, after_id=4) == EXPECTED[1][2:]
+
+
+def test_rerunning_the_migration_changes_nothing(db_app):
+    _seed_legacy_database()
+    assert turn_migration.convert_batch(db.session, 10) == (2, 7)
+    counts = _table_counts()
+
+    assert migrations.migrate(db.engine) == []
+    assert turn_migration.convert_batch(db.session, 10) == (0, 0)
+    assert turn_migration.ensure_converted(db.session, 1) is False
+    assert turn_migration.convert_threads(db.session, [1, 2]) == 0
+    db.session.commit()
+
+    assert _table_counts() == counts == (0, 5, 7)
+    assert _history(1) == EXPECTED[1]
+    assert _history(2) == EXPECTED[2]
+
+
+def test_new_responses_are_numbered_above_legacy_ids(db_app):
+    _seed_legacy_database()
+    # Only one thread converted: the other's ids must still be free when it moves later
+    turn_migration.ensure_converted(db.session, 1)
+
+    turn = ChatTurn(thread_id=1, user_input="new prompt")
+    turn.responses.append(ChatResponse(thread_id=1, model_name="CHATGPT", model_response="new reply"))
+    db.session.add(turn)
+    db.session.commit()
+
+    assert turn.responses[0].id > max(row[0] for row in LEGACY_ROWS)
+    assert turn_migration.convert_batch(db.session, 10) == (1, 2)
+    assert _history(2) == EXPECTED[2]
@@ -0,0 +1,40 @@
+from modules.dbms import db, User
+from modules.user_cache import UserCache, UserSnapshot
+
+
+def test_only_the_latest_watching_cache_is_invalidated_once_per_commit(db_app):
+    user = User(email="a@example.com", pwd_hash=b"x")
+    db.session.add(user)
+    db.session.commit()
+
+    # e.g. the app's extensions being set up twice
+    old_cache = UserCache(max_entries=10, ttl_seconds=60)
+    old_cache.watch(User)
+    cache = UserCache(max_entries=10, ttl_seconds=60)
+    cache.watch(User)
+    for each in (old_cache, cache):
+        each.put(UserSnapshot.of(user))
+
+    user.status = "Pro"
+    db.session.commit()
+
+    assert cache.snapshot()["invalidations"] == 1
+    assert cache.snapshot()["size"] == 0
+    assert old_cache.snapshot()["invalidations"] == 0
+
+
+def test_rolled_back_writes_invalidate_nothing(db_app):
+    user = User(email="a@example.com", pwd_hash=b"x")
+    db.session.add(user)
+    db.session.commit()
+    cache = UserCache(max_entries=10, ttl_seconds=60)
+    cache.watch(User)
+    cache.put(UserSnapshot.of(user))
+
+    user.status = "Pro"
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+
+    assert cache.snapshot()["invalidations"] == 0
+    assert cache.snapshot()["size"] == 1